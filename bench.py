@@ -0,0 +1,279 @@
+import itertools
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import statistics
+import platform
+import unittest.mock
+import click
+
+MDB_DIR = os.path.dirname(os.path.abspath(__file__))
+MDB_PATH = os.path.join(MDB_DIR, "mdb.py")
+
+################################################################################
+# Startup                                                                      #
+################################################################################
+
+# Modules only commands that talk to Spotify or touch audio files should load
+HEAVY_MODULES = ["librespot", "spotipy", "mutagen", "requests", "pydub", "tqdm"]
+
+LOCAL_COMMANDS = [
+    ["tracks", "get"],
+    ["cleanup", "--dry-run"],
+]
+
+
+def create_workspace(path):
+    with open(os.path.join(path, "config.json"), "w") as fh:
+        json.dump({"backend": {"type": "synthetic"}, "track_path": os.path.join(path, "tracks")}, fh)
+
+
+def time_command(args, cwd, runs):
+    """
+    Runs mdb.py with args, returning the median wall time in milliseconds
+    """
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, MDB_PATH, *args], cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def get_imported_heavy_modules():
+    code = f"import sys; sys.path.insert(0, {MDB_DIR!r}); import mdb; print(' '.join(sorted(sys.modules)))"
+    modules = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True).stdout.split()
+    return sorted({x.split(".")[0] for x in modules} & set(HEAVY_MODULES))
+
+
+@click.group()
+def main():
+    pass
+
+
+@main.command()
+@click.option("--runs", default=5, help="Runs per command, the median is reported")
+@click.option("--threshold", default=200, help="Slowest allowed startup in milliseconds")
+def startup(runs, threshold):
+    """
+    Times local-only commands and checks importing mdb stays light
+    """
+    failed = False
+
+    heavy_modules = get_imported_heavy_modules()
+    if heavy_modules:
+        print(f"  Importing mdb loads {', '.join(heavy_modules)}")
+        failed = True
+
+    with tempfile.TemporaryDirectory() as workspace:
+        create_workspace(workspace)
+        for args in LOCAL_COMMANDS:
+            median = time_command(args, workspace, runs)
+            print(f"  {' '.join(args)}: {median:.0f} ms")
+            if median > threshold:
+                print(f"  {' '.join(args)} is slower than {threshold} ms")
+                failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+################################################################################
+# Suite                                                                        #
+################################################################################
+
+SIZES = [1000, 10000, 100000]
+PLAYLIST_SIZE = 500
+DOWNLOAD_TRACKS = 50
+
+
+def create_catalog(size):
+    """
+    Generates tracks from SyntheticClient's catalog until there are size of
+    them, returning them and the ids of the artists they are by
+    """
+    import mdb
+    import mdb_backends
+    client = mdb_backends.SyntheticClient(artist_count=size)
+    tracks = []
+    artist_ids = []
+    for artist in itertools.count():
+        artist_ids.append(client.get_artist(artist)["id"])
+        for album in range(client.album_count):
+            tracks += mdb.Album.from_api(client.get_album(artist, album)).tracks
+        if len(tracks) >= size:
+            return tracks[:size], artist_ids
+
+
+def measure(func, repeat=1, setup=None):
+    """
+    Returns the fastest of repeat runs of func in seconds, each after an
+    untimed call to setup
+    """
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def split_artist_tracks(tracks, artist_ids):
+    """
+    Splits tracks like process_artists does, into those on each artist's own
+    albums and those they only feature on
+    """
+    artist_tracks = {x: ([], []) for x in artist_ids}
+    for track in tracks:
+        album_artist_ids = [x.id for x in track.album.artists]
+        for artist in track.artists:
+            if artist.id in artist_tracks:
+                artist_tracks[artist.id][artist.id not in album_artist_ids].append(track)
+    return artist_tracks
+
+
+def bench_track_actions(artist_tracks):
+    import mdb
+    for own_tracks, other_tracks in artist_tracks.values():
+        mdb.get_track_actions(own_tracks, other_tracks, [])
+
+
+# The transcode is ffmpeg's work rather than mdb's, so it is stubbed out of
+# the download loop: the Vorbis decodes to silence as long as the synthetic
+# backend's, and encodes to silent 128 kbps MPEG frames of 26 ms each
+STUB_MP3_FRAME = b"\xff\xfb\x90\x64" + bytes(413)
+
+
+def stub_decode(cls, path):
+    return cls.silent(duration=5000, frame_rate=44100)
+
+
+def stub_encode(segment, path, format=None, **kwargs):
+    with open(path, "wb") as fh:
+        fh.write(STUB_MP3_FRAME * (len(segment) // 26))
+
+
+def reset_downloads(tracks):
+    import mdb
+    shutil.rmtree(mdb.MyMelody.get_track_path(), ignore_errors=True)
+    for track in tracks:
+        mdb.LibraryIndex.remove(track.id)
+
+
+def bench_download_loop(tracks):
+    """
+    Downloads tracks with download_tracks_safely from the synthetic backend,
+    claiming, streaming, tagging and recording each one
+    """
+    import mdb
+    import pydub
+    with unittest.mock.patch.object(pydub.AudioSegment, "from_ogg", classmethod(stub_decode)), unittest.mock.patch.object(pydub.AudioSegment, "export", stub_encode):
+        mdb.download_tracks_safely(tracks)
+
+
+def run_suite(size, workspace, repeat):
+    import mdb
+    import mdb_backends
+    mdb.MyMelody.CONFIG = {
+        "backend": {"type": "synthetic"},
+        "track_path": os.path.join(workspace, "tracks"),
+        "index_path": os.path.join(workspace, "library_index.json"),
+        "artwork_cache_path": os.path.join(workspace, "artwork"),
+    }
+    mdb.MusicDatabase.create_db(os.path.join(workspace, "z.db"))
+    mdb.LibraryIndex.LOADED = False
+    tracks, artist_ids = create_catalog(size)
+    playlist = {"id": "0p0", "name": "Playlist 0", "artwork_url": None, "tracks": random.Random(size).sample(tracks, min(PLAYLIST_SIZE, size))}
+
+    results = {}
+    results["add_track"] = measure(lambda: [mdb.MusicDatabase.add_track(x) for x in tracks])
+    mdb.MusicDatabase.add_playlist(playlist)
+    results["get_all_tracks"] = measure(mdb.MusicDatabase.get_all_tracks, repeat)
+    results["tracks_to_download"] = measure(mdb.tracks_to_download, repeat)
+    results["get_playlist"] = measure(lambda: mdb.MusicDatabase.get_playlist(playlist["id"]), repeat)
+    artist_tracks = split_artist_tracks(tracks, artist_ids)
+    results["get_track_actions"] = measure(lambda: bench_track_actions(artist_tracks), repeat)
+    # Every track streams SyntheticBackend's 5 s of 160 kbps Vorbis from two
+    # sessions, without antiban pauses or a request budget meant for Spotify.
+    # Artwork comes from the disk cache, as it does after an album's first
+    # track
+    download_tracks = tracks[:DOWNLOAD_TRACKS]
+    mdb.MyMelody.BACKEND = mdb_backends.SyntheticBackend(None)
+    mdb.SessionPool.configure(["synthetic-0", "synthetic-1"])
+    mdb.RequestScheduler.configure(rate=1000, concurrency=16)
+    mdb.ANTIBAN_SCHEDULE = []
+    for url in {x.album.artwork_url for x in download_tracks}:
+        os.makedirs(os.path.dirname(mdb.ArtworkCache.get_cache_path(url)), exist_ok=True)
+        with open(mdb.ArtworkCache.get_cache_path(url), "wb") as fh:
+            fh.write(b"\xff\xd8\xff\xe0")
+    results["download_loop"] = measure(lambda: bench_download_loop(download_tracks), repeat, setup=lambda: reset_downloads(download_tracks))
+    mdb.MusicDatabase.close()
+    return results
+
+
+@main.command()
+@click.option("--sizes", default=",".join(str(x) for x in SIZES), help="Comma separated list of catalog sizes in tracks")
+@click.option("--repeat", default=3, help="Runs of each read benchmark, the fastest is reported")
+@click.option("--output", default="bench_results.json", help="File to write results to")
+def suite(sizes, repeat, output):
+    """
+    Times MusicDatabase and the processing pipeline on synthetic catalogs
+    """
+    import mdb
+    # Keep progress events out of the way of the results
+    mdb.Progress.MODE = "jsonl"
+    mdb.Progress.STREAM = open(os.devnull, "w")
+
+    results = {}
+    for size in [int(x) for x in sizes.split(",")]:
+        print(f"Catalog of {size} tracks:")
+        with tempfile.TemporaryDirectory() as workspace:
+            results[str(size)] = run_suite(size, workspace, repeat)
+        for name, seconds in results[str(size)].items():
+            print(f"  {name}: {seconds:.3f} s")
+
+    with open(output, "w") as fh:
+        json.dump({"python": platform.python_version(), "time": time.time(), "results": results}, fh, indent=2)
+    print(f"Results written to {output}")
+
+
+@main.command()
+@click.argument("baseline", type=click.Path(exists=True))
+@click.argument("current", type=click.Path(exists=True))
+@click.option("--threshold", default=0.1, help="Slowdown, as a fraction, that counts as a regression")
+def compare(baseline, current, threshold):
+    """
+    Compares two suite results, failing if any benchmark regressed
+    """
+    from tabulate import tabulate
+    with open(baseline, "r") as fh:
+        baseline_results = json.load(fh)["results"]
+    with open(current, "r") as fh:
+        current_results = json.load(fh)["results"]
+
+    rows = []
+    regressions = 0
+    for size, benchmarks in current_results.items():
+        for name, seconds in benchmarks.items():
+            if name not in baseline_results.get(size, {}):
+                continue
+            change = seconds / baseline_results[size][name] - 1
+            regressed = change > threshold
+            regressions += regressed
+            rows.append([size, name, f"{baseline_results[size][name]:.3f}", f"{seconds:.3f}", f"{change:+.1%}", "REGRESSED" if regressed else ""])
+    print(tabulate(rows, headers=["size", "benchmark", "baseline", "current", "change", ""]))
+
+    if regressions:
+        print(f"{regressions} benchmark(s) regressed by more than {threshold:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
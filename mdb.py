@@ -2,39 +2,51 @@ import json
 import os
 import click
 import pathlib
-from librespot.metadata import TrackId
-from librespot.audio.decoders import AudioQuality, VorbisOnlyAudioQuality
-from librespot.core import Session
-from spotipy import Spotify, SpotifyOAuth
-from mutagen.easyid3 import EasyID3
-from mutagen.id3 import APIC, ID3
-from mutagen.mp3 import MP3
-import requests
 import tempfile
-import pydub
-from tqdm import tqdm
 import time
 import sqlite3
-from tabulate import tabulate
 import subprocess
 import re
+import math
+import hashlib
+import threading
+import itertools
+import heapq
+import concurrent.futures
+import shutil
+import filecmp
+import socket
+import socketserver
+import functools
+import bisect
+import sys
+import datetime
+import collections
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+import dataclasses
+from dataclasses import dataclass, field
 
 ################################################################################
 # Main class containing config, credentials, and sessions                      #
 ################################################################################
 
 class MyMelody:
+    BACKEND = None
     CLIENT = None
-    SESSION = None
     CREDENTIALS = None
     CONFIG = None
     DATA = None
+    LOCK = threading.Lock()
 
     def __init__(self):
         MyMelody.get_credentials_path()
-        MyMelody.create_session()
-        MyMelody.create_client()
         MyMelody.load_config()
+        MyMelody.create_backend()
+        MyMelody.create_scheduler()
+        MyMelody.create_session_pool()
 
     # Spotify sessions
     @classmethod
@@ -42,30 +54,61 @@ class MyMelody:
         cls.CREDENTIALS = path
 
     @classmethod
-    def create_session(cls):
-        conf = Session.Configuration.Builder().set_store_credentials(False).build()
-        cls.SESSION = Session.Builder(conf).stored_file(cls.CREDENTIALS).create()
+    def create_backend(cls):
+        backend_config = dict(cls.CONFIG.get("backend", {}))
+        backend_type = backend_config.pop("type", "live")
+        cls.BACKEND = LiveBackend(cls.CREDENTIALS)
+        if backend_type != "live":
+            # Backends for working without Spotify are kept out of the CLI
+            import mdb_backends
+            cls.BACKEND = mdb_backends.BACKENDS[backend_type](cls.BACKEND, **backend_config)
+
+    @classmethod
+    def create_scheduler(cls):
+        RequestScheduler.configure(**cls.CONFIG.get("scheduler", {}))
+
+    @classmethod
+    def create_session_pool(cls):
+        pool_config = dict(cls.CONFIG.get("session_pool", {}))
+        SessionPool.configure(pool_config.pop("credentials", [cls.CREDENTIALS]), **pool_config)
 
     @classmethod
     def create_client(cls):
-        with open(cls.CREDENTIALS, "r") as fh:
-            cred_data = json.load(fh)
-        params = {k: cred_data[k] for k in ("client_id", "client_secret", "redirect_uri", "scope")}
-        cls.CLIENT = Spotify(auth_manager=SpotifyOAuth(**params))
+        cls.CLIENT = ScheduledClient(cls.BACKEND.create_client())
+
+    # Sessions are only created on first use so local commands start quickly
+    @classmethod
+    def get_client(cls):
+        with cls.LOCK:
+            if cls.CLIENT is None:
+                cls.create_client()
+        return cls.CLIENT
 
     @classmethod
-    def get_content_stream(cls, content_id):
-        return cls.SESSION.content_feeder().load(content_id, VorbisOnlyAudioQuality(AudioQuality.HIGH), False, None)
+    def get_content_stream(cls, content_id, session=None, quality="HIGH"):
+        from librespot.audio.decoders import AudioQuality, VorbisOnlyAudioQuality
+        with Metrics.time("stream_open"):
+            return SessionPool.load(content_id, VorbisOnlyAudioQuality(AudioQuality[quality]), preferred=session)
     
     @classmethod
     def get_content_metadata(cls, content_type, content_id, args={}):
-        return getattr(cls.CLIENT, content_type)(content_id, **args)
+        return getattr(cls.get_client(), content_type)(content_id, **args)
 
     # Config
     @classmethod
     def load_config(cls, path="config.json"):
         with open(path, "r") as fh:
             cls.CONFIG = json.load(fh)
+        cls.check_qualities()
+
+    @classmethod
+    def check_qualities(cls):
+        # Checked once here rather than by every track that needs them
+        qualities = {"quality": cls.CONFIG.get("quality", "HIGH")}
+        qualities.update({f"playlist_quality.{k}": v for k,v in cls.CONFIG.get("playlist_quality", {}).items()})
+        for key, quality in qualities.items():
+            if quality not in QUALITIES:
+                raise click.ClickException(f"{key} in config is {quality}, expected one of {', '.join(QUALITIES)}")
 
     @classmethod
     def get_db_path(cls):
@@ -76,6 +119,617 @@ class MyMelody:
         return cls.CONFIG.get("track_path")
 
 
+################################################################################
+# Metrics                                                                      #
+################################################################################
+
+class MetricsTimer:
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        Metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+class Metrics:
+    """
+    Counters and latency histograms for the hot paths, written as a Prometheus
+    textfile and a JSON summary when a command finishes
+    """
+    LOCK = threading.Lock()
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+    COUNTERS = {}
+    HISTOGRAMS = {}
+    # Names being timed by decorated functions on each thread
+    TIMING = threading.local()
+
+    @classmethod
+    def count(cls, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with cls.LOCK:
+            cls.COUNTERS[key] = cls.COUNTERS.get(key, 0) + value
+
+    @classmethod
+    def observe(cls, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with cls.LOCK:
+            histogram = cls.HISTOGRAMS.get(key)
+            if histogram is None:
+                # The last bucket counts everything above BUCKETS
+                histogram = cls.HISTOGRAMS[key] = {"buckets": [0] * (len(cls.BUCKETS) + 1), "count": 0, "sum": 0.0, "max": 0.0}
+            histogram["buckets"][bisect.bisect_left(cls.BUCKETS, seconds)] += 1
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+            histogram["max"] = max(histogram["max"], seconds)
+
+    @classmethod
+    def time(cls, name, **labels):
+        return MetricsTimer(name, labels)
+
+    @classmethod
+    def timed(cls, name):
+        """
+        Decorates a function so every call is observed in name, labelled with
+        the function's name. Calls made while another decorated function is
+        timing the same name are part of its time, so aren't observed again
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not hasattr(cls.TIMING, "names"):
+                    cls.TIMING.names = set()
+                timing = cls.TIMING.names
+                if name in timing:
+                    return func(*args, **kwargs)
+                timing.add(name)
+                try:
+                    with MetricsTimer(name, {"op": func.__name__}):
+                        return func(*args, **kwargs)
+                finally:
+                    timing.discard(name)
+            return wrapper
+        return decorator
+
+    @classmethod
+    def get_quantile(cls, histogram, quantile):
+        """
+        Upper bound of the bucket holding the quantile, or the max if it is
+        above every bucket
+        """
+        seen = 0
+        for bound, count in zip(cls.BUCKETS, histogram["buckets"]):
+            seen += count
+            if seen >= quantile * histogram["count"]:
+                return min(bound, histogram["max"])
+        return histogram["max"]
+
+    @staticmethod
+    def format_labels(labels):
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k,v in labels) + "}"
+
+    @classmethod
+    def to_prometheus(cls):
+        lines = [
+            "# TYPE mdb_last_run_timestamp_seconds gauge",
+            f"mdb_last_run_timestamp_seconds {time.time():.0f}",
+        ]
+        for name in sorted({x for x, _ in cls.COUNTERS}):
+            lines.append(f"# TYPE mdb_{name}_total counter")
+            for (_, labels), value in sorted(x for x in cls.COUNTERS.items() if x[0][0] == name):
+                lines.append(f"mdb_{name}_total{cls.format_labels(labels)} {value}")
+        for name in sorted({x for x, _ in cls.HISTOGRAMS}):
+            lines.append(f"# TYPE mdb_{name}_seconds histogram")
+            for (_, labels), histogram in sorted(x for x in cls.HISTOGRAMS.items() if x[0][0] == name):
+                cumulative = 0
+                for bound, count in zip((*cls.BUCKETS, "+Inf"), histogram["buckets"]):
+                    cumulative += count
+                    lines.append(f"mdb_{name}_seconds_bucket{cls.format_labels((*labels, ('le', bound)))} {cumulative}")
+                lines.append(f"mdb_{name}_seconds_sum{cls.format_labels(labels)} {histogram['sum']}")
+                lines.append(f"mdb_{name}_seconds_count{cls.format_labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    @classmethod
+    def to_summary(cls):
+        return {
+            "counters": {name + cls.format_labels(labels): value for (name, labels), value in sorted(cls.COUNTERS.items())},
+            "timings": {name + cls.format_labels(labels): {
+                "count": x["count"],
+                "total": round(x["sum"], 6),
+                "mean": round(x["sum"] / x["count"], 6),
+                "p50": round(cls.get_quantile(x, 0.5), 6),
+                "p95": round(cls.get_quantile(x, 0.95), 6),
+                "max": round(x["max"], 6),
+            } for (name, labels), x in sorted(cls.HISTOGRAMS.items())},
+        }
+
+    @classmethod
+    def save(cls):
+        if not cls.COUNTERS and not cls.HISTOGRAMS:
+            return
+        with cls.LOCK:
+            outputs = {
+                MyMelody.CONFIG.get("metrics_textfile_path", "metrics.prom"): cls.to_prometheus(),
+                MyMelody.CONFIG.get("metrics_summary_path", "metrics.json"): json.dumps(cls.to_summary(), indent=2),
+            }
+        for path, content in outputs.items():
+            with open(path + ".tmp", "w") as fh:
+                fh.write(content)
+            os.replace(path + ".tmp", path)
+
+
+################################################################################
+# Progress                                                                     #
+################################################################################
+
+class Progress:
+    """
+    Reports download progress as tqdm bars, or with jsonl as one JSON event
+    per line on stdout for headless runs. Byte updates are rate limited in
+    both modes
+    """
+    MODE = "bar"
+    STREAM = None
+    INTERVALS = {"bar": 0.1, "jsonl": 1}
+    LOCK = threading.Lock()
+    TRACKS = {}
+
+    @classmethod
+    def configure(cls, mode):
+        cls.MODE = mode
+        cls.STREAM = sys.stdout
+        if mode == "jsonl":
+            # Keep stdout for events, everything else is printed to stderr
+            sys.stdout = sys.stderr
+
+    @classmethod
+    def emit(cls, event, **fields):
+        with cls.LOCK:
+            cls.STREAM.write(json.dumps({"event": event, "time": round(time.time(), 3), **fields}) + "\n")
+            cls.STREAM.flush()
+
+    @classmethod
+    def track_started(cls, track, total):
+        state = {"start": time.perf_counter(), "last": 0, "bytes": 0, "total": total, "bar": None}
+        if cls.MODE == "jsonl":
+            cls.emit("track_started", id=track.id, name=get_track_description(track), bytes_total=total)
+        else:
+            from tqdm import tqdm
+            state["bar"] = tqdm(total=total, desc="  "+get_track_description(track), unit="B", unit_scale=True)
+        cls.TRACKS[track.id] = state
+
+    @classmethod
+    def track_bytes(cls, track, downloaded):
+        state = cls.TRACKS[track.id]
+        now = time.perf_counter()
+        if now - state["last"] < cls.INTERVALS[cls.MODE] and downloaded < state["total"]:
+            return
+        state["last"] = now
+        if cls.MODE == "jsonl":
+            seconds = now - state["start"]
+            cls.emit("bytes", id=track.id, bytes=downloaded, bytes_total=state["total"], bytes_per_second=round(downloaded / seconds) if seconds else None)
+        else:
+            state["bar"].update(downloaded - state["bytes"])
+        state["bytes"] = downloaded
+
+    @classmethod
+    def track_finished(cls, track, result):
+        state = cls.TRACKS.pop(track.id, None)
+        if cls.MODE == "jsonl":
+            fields = {"bytes": state["bytes"], "seconds": round(time.perf_counter() - state["start"], 3)} if state else {}
+            cls.emit("track_finished", id=track.id, result=result, **fields)
+        elif state:
+            state["bar"].close()
+        elif result == "skipped":
+            print(f"  Skipping {get_track_description(track)}")
+        elif result == "claimed":
+            print(f"  Skipping {get_track_description(track)}, another worker has it")
+
+    @classmethod
+    def track_failed(cls, track, error):
+        state = cls.TRACKS.pop(track.id, None)
+        if cls.MODE == "jsonl":
+            cls.emit("track_failed", id=track.id, error=error)
+            return
+        if state:
+            state["bar"].close()
+        print(f"  Failed {get_track_description(track)}: {error}")
+
+    @classmethod
+    def artwork_failed(cls, track, error):
+        if cls.MODE == "jsonl":
+            cls.emit("artwork_failed", id=track.id, error=error)
+            return
+        print(f"  No artwork for {get_track_description(track)}: {error}")
+
+    @classmethod
+    def throttled(cls, seconds, reason):
+        if cls.MODE == "jsonl":
+            cls.emit("throttled", seconds=seconds, reason=reason)
+        elif reason == "rate_limited":
+            print(f"  Rate limited, retrying in {seconds:.0f} second(s)...")
+
+
+################################################################################
+# Profiling                                                                    #
+################################################################################
+
+class Profiler:
+    """
+    Wraps a command in cProfile, writing stats sorted by cumulative time
+    """
+    PROFILE = None
+    PATH = None
+
+    @classmethod
+    def start(cls, path):
+        import cProfile
+        cls.PATH = path
+        cls.PROFILE = cProfile.Profile()
+        cls.PROFILE.enable()
+
+    @classmethod
+    def save(cls):
+        import pstats
+        if not cls.PROFILE:
+            return
+        cls.PROFILE.disable()
+        with open(cls.PATH, "w") as fh:
+            pstats.Stats(cls.PROFILE, stream=fh).sort_stats("cumulative").print_stats()
+        cls.PROFILE.dump_stats(cls.PATH + ".prof")
+        print(f"Profile written to {cls.PATH}")
+
+
+class MemoryTracer:
+    """
+    Takes tracemalloc snapshots at phase boundaries and reports what each
+    phase allocated
+    """
+    ENABLED = False
+    TOP = 10
+    SNAPSHOTS = []
+
+    @classmethod
+    def start(cls):
+        import tracemalloc
+        tracemalloc.start()
+        cls.ENABLED = True
+        cls.snapshot("start")
+
+    @classmethod
+    def snapshot(cls, phase):
+        if not cls.ENABLED:
+            return
+        import tracemalloc
+        cls.SNAPSHOTS.append((phase, tracemalloc.take_snapshot(), tracemalloc.get_traced_memory()))
+
+    @classmethod
+    def report(cls):
+        if not cls.ENABLED:
+            return
+        import tracemalloc
+        cls.snapshot("end")
+        print("Memory by phase:")
+        for (_, previous, _), (phase, snapshot, (current, peak)) in zip(cls.SNAPSHOTS, cls.SNAPSHOTS[1:]):
+            print(f"  {phase}: {format_size(current)} current, {format_size(peak)} peak")
+            for stat in snapshot.compare_to(previous, "lineno")[:cls.TOP]:
+                if stat.size_diff <= 0:
+                    continue
+                frame = stat.traceback[0]
+                print(f"    +{format_size(stat.size_diff)} {frame.filename}:{frame.lineno}")
+        tracemalloc.stop()
+
+
+################################################################################
+# Backends                                                                     #
+################################################################################
+
+class LiveBackend:
+    """
+    Talks to Spotify using the credentials file
+    """
+    def __init__(self, credentials):
+        self.credentials = credentials
+
+    def create_session(self, credentials=None):
+        from librespot.core import Session
+        conf = Session.Configuration.Builder().set_store_credentials(False).build()
+        return Session.Builder(conf).stored_file(credentials or self.credentials).create()
+
+    def create_client(self):
+        from spotipy import Spotify, SpotifyOAuth
+        with open(self.credentials, "r") as fh:
+            cred_data = json.load(fh)
+        params = {k: cred_data[k] for k in ("client_id", "client_secret", "redirect_uri", "scope")}
+        return Spotify(auth_manager=SpotifyOAuth(**params), requests_session=create_requests_session())
+
+
+def create_requests_session():
+    """
+    Returns a requests Session that retries server errors but hands 429s
+    straight back, so the RequestScheduler backs off for them rather than
+    urllib3 sleeping on Retry-After inside spotipy
+    """
+    import requests
+    from urllib3.util.retry import Retry
+    retry = Retry(
+        total=3,
+        connect=None,
+        read=False,
+        status=3,
+        allowed_methods=frozenset(["GET", "POST", "PUT", "DELETE"]),
+        status_forcelist=(500, 502, 503, 504),
+        backoff_factor=0.3,
+        respect_retry_after_header=False,
+    )
+    adapter = requests.adapters.HTTPAdapter(max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+################################################################################
+# Scheduler                                                                    #
+################################################################################
+
+def get_retry_after(error):
+    """
+    Returns the seconds to back off for if error is a 429, otherwise None
+    """
+    status = getattr(error, "http_status", None)
+    headers = getattr(error, "headers", None)
+    response = getattr(error, "response", None)
+    if status is None and response is not None:
+        status = getattr(response, "status_code", None)
+        headers = getattr(response, "headers", None)
+    if status != 429:
+        return None
+    try:
+        return float((headers or {}).get("Retry-After", 1))
+    except ValueError:
+        return 1.0
+
+
+class RequestScheduler:
+    """
+    Every Web API and librespot request goes through submit, which shares one
+    request budget between them, backs off for Retry-After on a 429, and
+    adapts concurrency with AIMD (additive increase, multiplicative decrease).
+    Waiting requests are served lowest priority class first
+    """
+    INTERACTIVE = 0
+    BULK = 1
+
+    LOCK = threading.Condition()
+    WAITING = []
+    SEQUENCE = itertools.count()
+    IN_FLIGHT = 0
+    BLOCKED_UNTIL = 0
+    TOKENS = 0
+    LAST_REFILL = 0
+
+    RATE = 10
+    LIMIT = 4
+    MIN_LIMIT = 1
+    MAX_LIMIT = 16
+    MAX_RETRIES = 5
+
+    @classmethod
+    def configure(cls, rate=10, concurrency=4, max_concurrency=16, max_retries=5):
+        cls.RATE = rate
+        cls.LIMIT = concurrency
+        cls.MAX_LIMIT = max_concurrency
+        cls.MAX_RETRIES = max_retries
+        cls.TOKENS = rate
+        cls.LAST_REFILL = time.monotonic()
+
+    @classmethod
+    def get_wait(cls, ticket):
+        if cls.WAITING[0] != ticket or cls.IN_FLIGHT >= int(cls.LIMIT):
+            return None
+        now = time.monotonic()
+        cls.TOKENS = min(cls.RATE, cls.TOKENS + (now - cls.LAST_REFILL) * cls.RATE)
+        cls.LAST_REFILL = now
+        if now < cls.BLOCKED_UNTIL:
+            return cls.BLOCKED_UNTIL - now
+        if cls.TOKENS < 1:
+            return (1 - cls.TOKENS) / cls.RATE
+        return 0
+
+    @classmethod
+    def acquire(cls, priority):
+        with cls.LOCK:
+            ticket = (priority, next(cls.SEQUENCE))
+            heapq.heappush(cls.WAITING, ticket)
+            while (wait := cls.get_wait(ticket)) != 0:
+                cls.LOCK.wait(timeout=wait)
+            heapq.heappop(cls.WAITING)
+            cls.IN_FLIGHT += 1
+            cls.TOKENS -= 1
+            cls.LOCK.notify_all()
+
+    @classmethod
+    def release(cls, success=True, retry_after=None):
+        with cls.LOCK:
+            cls.IN_FLIGHT -= 1
+            if retry_after is not None:
+                cls.BLOCKED_UNTIL = max(cls.BLOCKED_UNTIL, time.monotonic() + retry_after)
+                cls.LIMIT = max(cls.MIN_LIMIT, cls.LIMIT / 2)
+            elif success:
+                cls.LIMIT = min(cls.MAX_LIMIT, cls.LIMIT + 1 / cls.LIMIT)
+            cls.LOCK.notify_all()
+
+    @classmethod
+    def submit(cls, priority, func, *args, **kwargs):
+        for attempt in range(cls.MAX_RETRIES + 1):
+            cls.acquire(priority)
+            try:
+                resp = func(*args, **kwargs)
+            except Exception as e:
+                retry_after = get_retry_after(e)
+                cls.release(success=False, retry_after=retry_after)
+                if retry_after is None or attempt == cls.MAX_RETRIES:
+                    raise
+                Metrics.count("rate_limited")
+                Progress.throttled(retry_after, "rate_limited")
+                continue
+            cls.release()
+            return resp
+
+
+class ScheduledClient:
+    """
+    Sends every call on a Spotify client through the RequestScheduler
+    """
+    def __init__(self, client, priority=RequestScheduler.INTERACTIVE):
+        self.client = client
+        self.priority = priority
+
+    def __getattr__(self, method):
+        func = getattr(self.client, method)
+        if not callable(func):
+            return func
+        def call(*args, **kwargs):
+            with Metrics.time("api_request", method=method):
+                return RequestScheduler.submit(self.priority, func, *args, **kwargs)
+        return call
+
+
+################################################################################
+# Session pool                                                                 #
+################################################################################
+
+# What librespot raises for tracks that can't be played on any session
+CONTENT_ERRORS = (
+    "Cannot get alternative track",
+    "Content has no audio file!",
+    "Content is restricted!",
+    "Content is unrecognized!",
+)
+
+
+def is_content_error(error):
+    from librespot.audio import FeederException
+    return isinstance(error, FeederException) or (type(error) is RuntimeError and str(error) in CONTENT_ERRORS)
+
+
+class PooledSession:
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self.session = None
+        self.failures = 0
+        self.retry_at = 0
+        self.next_load = 0
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if self.session is None:
+                self.session = MyMelody.BACKEND.create_session(self.credentials)
+            return self.session
+
+
+class SessionPool:
+    """
+    One librespot session per credentials file. Each session has its own
+    budget of stream loads per second, and a session that keeps failing is
+    recreated after a backoff while its loads fail over to the others
+    """
+    LOCK = threading.Lock()
+    SESSIONS = []
+    RATE = None
+    MAX_FAILURES = 2
+    BACKOFF = 60
+
+    @classmethod
+    def configure(cls, credentials, rate=None, max_failures=2, backoff=60):
+        cls.SESSIONS = [PooledSession(x) for x in credentials]
+        cls.RATE = rate
+        cls.MAX_FAILURES = max_failures
+        cls.BACKOFF = backoff
+
+    @classmethod
+    def pick(cls, preferred=None, exclude=()):
+        """
+        Returns preferred if it is healthy, otherwise the healthy session
+        that can load soonest, or the one that recovers soonest
+        """
+        now = time.monotonic()
+        candidates = [x for x in cls.SESSIONS if x not in exclude]
+        if not candidates:
+            return None
+        if preferred in candidates and preferred.retry_at <= now:
+            return preferred
+        healthy = [x for x in candidates if x.retry_at <= now]
+        if healthy:
+            return min(healthy, key=lambda x: x.next_load)
+        return min(candidates, key=lambda x: x.retry_at)
+
+    @classmethod
+    def wait(cls, pooled):
+        with cls.LOCK:
+            start = max(time.monotonic(), pooled.retry_at, pooled.next_load)
+            if cls.RATE:
+                pooled.next_load = start + 1 / cls.RATE
+        time.sleep(max(0, start - time.monotonic()))
+
+    @classmethod
+    def report_failure(cls, pooled, error, session=None):
+        with pooled.lock:
+            # Recreate the session on its next use, unless another worker's
+            # failure already has
+            if pooled.session is session:
+                pooled.session = None
+            else:
+                session = None
+        with cls.LOCK:
+            pooled.failures += 1
+            if pooled.failures >= cls.MAX_FAILURES:
+                pooled.retry_at = time.monotonic() + cls.BACKOFF * 2 ** (pooled.failures - cls.MAX_FAILURES)
+        Metrics.count("session_failures", credentials=pooled.credentials)
+        print(f"  Session {pooled.credentials} failed: {error}")
+        # Closed outside the locks, as it waits on its connection, and only
+        # at best, as it has already failed
+        if session is not None:
+            try:
+                session.close()
+            except Exception:
+                pass
+
+    @classmethod
+    def load(cls, content_id, audio_quality, preferred=None):
+        """
+        Loads the stream on preferred, failing over to the other sessions.
+        Errors for the track itself are raised without counting against the
+        session
+        """
+        tried = []
+        error = RuntimeError("No sessions in the pool")
+        while pooled := cls.pick(preferred, exclude=tried):
+            cls.wait(pooled)
+            session = None
+            try:
+                session = pooled.get()
+                stream = RequestScheduler.submit(RequestScheduler.BULK, session.content_feeder().load, content_id, audio_quality, False, None)
+            except Exception as e:
+                if is_content_error(e):
+                    raise
+                cls.report_failure(pooled, e, session)
+                tried.append(pooled)
+                error = e
+                continue
+            pooled.failures = 0
+            return stream
+        raise error
+
+
 ################################################################################
 # Database                                                                     #
 ################################################################################
@@ -90,11 +744,28 @@ CREATE TABLE IF NOT EXISTS tracks (
     track_number INTEGER,
     hidden INTEGER,
     explicit INTEGER,
+    duration_ms INTEGER,
+    path TEXT,
+    isrc TEXT,
+    audio_hash TEXT,
+    quality TEXT,
+    source_size INTEGER,
+    requested_quality TEXT,
     PRIMARY KEY (id, album_id, artist_id)
     FOREIGN KEY (album_id) REFERENCES albums(id)
     FOREIGN KEY (artist_id) REFERENCES artists(id)
 )
 """
+# Columns added since the table was first created
+TRACKS_COLUMNS = {
+    "duration_ms": "INTEGER",
+    "path": "TEXT",
+    "isrc": "TEXT",
+    "audio_hash": "TEXT",
+    "quality": "TEXT",
+    "source_size": "INTEGER",
+    "requested_quality": "TEXT",
+}
 CREATE_ALBUMS_TABLE = """
 CREATE TABLE IF NOT EXISTS albums (
     id TEXT,
@@ -129,10 +800,183 @@ CREATE TABLE IF NOT EXISTS playlists (
     FOREIGN KEY (track_id) REFERENCES tracks(id)
 )
 """
+# content_id holds the comma separated ids of the job, and options the JSON
+# of the command line options it was queued with
+CREATE_JOBS_TABLE = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_type TEXT,
+    content_id TEXT,
+    download INTEGER,
+    options TEXT,
+    status TEXT DEFAULT 'queued',
+    progress INTEGER DEFAULT 0,
+    total INTEGER DEFAULT 0,
+    error TEXT,
+    created_at REAL,
+    updated_at REAL
+)
+"""
+# Columns added since the table was first created
+JOBS_COLUMNS = {
+    "options": "TEXT",
+}
+# Why and when each track waiting to download was queued, its priority
+# adjustment, and whether it replaces a file already downloaded
+CREATE_DOWNLOAD_QUEUE_TABLE = """
+CREATE TABLE IF NOT EXISTS download_queue (
+    track_id TEXT,
+    source TEXT,
+    priority REAL DEFAULT 0,
+    added_at REAL,
+    redownload INTEGER DEFAULT 0,
+    PRIMARY KEY (track_id)
+)
+"""
+# Columns added since the table was first created
+DOWNLOAD_QUEUE_COLUMNS = {
+    "redownload": "INTEGER DEFAULT 0",
+}
+# Measured cost of each transcoded download, for plan's estimates
+CREATE_DOWNLOADS_TABLE = """
+CREATE TABLE IF NOT EXISTS downloads (
+    track_id TEXT,
+    quality TEXT,
+    duration_ms INTEGER,
+    source_size INTEGER,
+    stream_seconds REAL,
+    encode_seconds REAL,
+    finished_at REAL
+)
+"""
+# Kept apart from tracks and albums, whose rows are replaced when re-added
+CREATE_LOUDNESS_TABLE = """
+CREATE TABLE IF NOT EXISTS loudness (
+    id TEXT,
+    loudness REAL,
+    gain REAL,
+    peak REAL,
+    blocks TEXT,
+    PRIMARY KEY (id)
+)
+"""
+
+################################################################################
+# Records                                                                      #
+################################################################################
+
+def get_release_date(album):
+    match album["release_date_precision"]:
+        case "day":
+            return album["release_date"]
+        case "month":
+            return album["release_date"] + "-01"
+        case "year":
+            return album["release_date"] + "-01-01"
+
+
+def get_artwork_url(content):
+    if not content.get("images"):
+        return None
+    return sorted(content["images"], key=lambda i: i["height"] or 0, reverse=True)[0]["url"]
+
+
+@dataclass(slots=True)
+class Artist:
+    id: str
+    name: str
+    follow: bool = False
+    hidden: bool = False
+
+    @classmethod
+    def from_api(cls, artist):
+        return cls(artist["id"], artist["name"])
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(row["id"], row["name"], bool(row["follow"]), bool(row["hidden"]))
+
+
+@dataclass(slots=True)
+class Album:
+    id: str
+    name: str
+    album_type: str
+    total_tracks: int
+    release_date: str
+    artwork_url: str
+    artists: list
+    hidden: bool = False
+    # Only filled while scanning the catalog, never stored
+    tracks: list = field(default_factory=list, repr=False, compare=False)
+
+    @classmethod
+    def from_api(cls, album):
+        record = cls(
+            album["id"],
+            album["name"],
+            album["album_type"],
+            album["total_tracks"],
+            get_release_date(album),
+            get_artwork_url(album),
+            [Artist.from_api(x) for x in album["artists"]],
+        )
+        if "tracks" in album:
+            record.tracks = [Track.from_api(x, album=record) for x in album["tracks"]["items"] if x]
+        return record
+
+    @classmethod
+    def from_row(cls, row, artists):
+        return cls(row["id"], row["name"], row["album_type"], row["total_tracks"], row["release_date"], row["artwork_url"], artists, bool(row["hidden"]))
+
+
+@dataclass(slots=True)
+class Track:
+    id: str
+    name: str
+    disc_number: int
+    track_number: int
+    album: Album
+    artists: list
+    hidden: bool = False
+    explicit: bool = True
+    duration_ms: int = None
+    # Relative to the track path, set once downloaded
+    path: str = None
+    isrc: str = None
+    # Hash of the downloaded stream
+    audio_hash: str = None
+    # Quality of the downloaded stream, its size in bytes, and the quality
+    # requested, higher than it got when the track has no file at it
+    quality: str = None
+    source_size: int = None
+    requested_quality: str = None
+
+    @classmethod
+    def from_api(cls, track, album=None, explicit=True):
+        return cls(
+            track["id"],
+            track["name"],
+            track["disc_number"],
+            track["track_number"],
+            album or Album.from_api(track["album"]),
+            [Artist.from_api(x) for x in track["artists"]],
+            explicit=explicit,
+            duration_ms=track.get("duration_ms"),
+            isrc=track.get("external_ids", {}).get("isrc"),
+        )
+
+    @classmethod
+    def from_row(cls, row, album, artists):
+        return cls(row["id"], row["name"], row["disc_number"], row["track_number"], album, artists, bool(row["hidden"]), bool(row["explicit"]), row["duration_ms"], row["path"], row["isrc"], row["audio_hash"], row["quality"], row["source_size"], row["requested_quality"])
+
 
 class MusicDatabase:
+    PATH = None
     CONNECTION = None
     CURSOR = None
+    # Held by download workers, which share the cursor
+    LOCK = threading.RLock()
 
     # def __init__(self):
     #     pass
@@ -140,13 +984,24 @@ class MusicDatabase:
     @classmethod
     def create_db(cls, db_path):
         pathlib.Path(os.path.dirname(db_path)).mkdir(parents=True, exist_ok=True)
-        cls.CONNECTION = sqlite3.connect(db_path)
+        cls.PATH = db_path
+        # The daemon creates the database on startup and uses it from its worker
+        cls.CONNECTION = sqlite3.connect(db_path, check_same_thread=False)
         cls.CONNECTION.row_factory = sqlite3.Row
         cls.CURSOR = cls.CONNECTION.cursor()
         cls.CURSOR.execute(CREATE_ARTISTS_TABLE)
         cls.CURSOR.execute(CREATE_ALBUMS_TABLE)
         cls.CURSOR.execute(CREATE_TRACKS_TABLE)
         cls.CURSOR.execute(CREATE_PLAYLISTS_TABLE)
+        cls.CURSOR.execute(CREATE_JOBS_TABLE)
+        cls.CURSOR.execute(CREATE_LOUDNESS_TABLE)
+        cls.CURSOR.execute(CREATE_DOWNLOADS_TABLE)
+        cls.CURSOR.execute(CREATE_DOWNLOAD_QUEUE_TABLE)
+        for table, columns in (("tracks", TRACKS_COLUMNS), ("jobs", JOBS_COLUMNS), ("download_queue", DOWNLOAD_QUEUE_COLUMNS)):
+            existing_columns = [x["name"] for x in cls.CURSOR.execute(f"PRAGMA table_info({table})").fetchall()]
+            for column, column_type in columns.items():
+                if column not in existing_columns:
+                    cls.CURSOR.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
         cls.CONNECTION.commit()
 
     @classmethod
@@ -160,137 +1015,260 @@ class MusicDatabase:
     def get_track(cls, track_id):
         tracks_by_artist = cls.CURSOR.execute("SELECT * FROM tracks WHERE id = ?", (track_id,)).fetchall()
         if not tracks_by_artist:
-            return []
-        tracks_by_artist = [dict(x) for x in tracks_by_artist]
-        track = tracks_by_artist[0]
-        track["album"] = MusicDatabase.get_album(track.pop("album_id"))
-        track["artists"] = [MusicDatabase.get_artist(x["artist_id"]) for x in tracks_by_artist]
-        track.pop("artist_id")
-        return track
+            return None
+        return Track.from_row(
+            tracks_by_artist[0],
+            MusicDatabase.get_album(tracks_by_artist[0]["album_id"]),
+            [MusicDatabase.get_artist(x["artist_id"]) for x in tracks_by_artist],
+        )
 
     @classmethod
     def get_all_tracks(cls):
-        unique_ids = list(set([x["id"] for x in cls.CURSOR.execute("SELECT id FROM tracks").fetchall()]))
+        unique_ids = list(dict.fromkeys([x["id"] for x in cls.CURSOR.execute("SELECT id FROM tracks").fetchall()]))
         return [MusicDatabase.get_track(x) for x in unique_ids]
 
     @classmethod
+    @Metrics.timed("db_write")
     def add_track(cls, track, replace=False):
-        existing_track = MusicDatabase.get_track(track["id"])
-        if existing_track:
-            if replace or (not existing_track["explicit"] and track.get("explicit", True)):
-                track = existing_track
-            else:
-                return existing_track
+        existing_track = MusicDatabase.get_track(track.id)
+        if existing_track and not (replace or (not existing_track.explicit and track.explicit)):
+            return existing_track
 
-        MusicDatabase.add_album(track["album"])
-        for track_artist in [MusicDatabase.add_artist(x) for x in track["artists"]]:
+        track_path = track.path or (existing_track.path if existing_track else None)
+        isrc = track.isrc or (existing_track.isrc if existing_track else None)
+        audio_hash = track.audio_hash or (existing_track.audio_hash if existing_track else None)
+        quality = track.quality or (existing_track.quality if existing_track else None)
+        source_size = track.source_size or (existing_track.source_size if existing_track else None)
+        requested_quality = track.requested_quality or (existing_track.requested_quality if existing_track else None)
+        MusicDatabase.add_album(track.album)
+        for track_artist in [MusicDatabase.add_artist(x) for x in track.artists]:
             cls.CURSOR.execute(
-                "INSERT OR REPLACE INTO tracks (id, album_id, artist_id, name, disc_number, track_number, hidden, explicit) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                "INSERT OR REPLACE INTO tracks (id, album_id, artist_id, name, disc_number, track_number, hidden, explicit, duration_ms, path, isrc, audio_hash, quality, source_size, requested_quality) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
                 (
-                    track["id"],
-                    track["album"]["id"],
-                    track_artist["id"],
-                    track["name"],
-                    track["disc_number"],
-                    track["track_number"],
-                    int(track.get("hidden", False)),
-                    int(track.get("explicit", True)),
+                    track.id,
+                    track.album.id,
+                    track_artist.id,
+                    track.name,
+                    track.disc_number,
+                    track.track_number,
+                    int(track.hidden),
+                    int(track.explicit),
+                    track.duration_ms,
+                    track_path,
+                    isrc,
+                    audio_hash,
+                    quality,
+                    source_size,
+                    requested_quality,
                 )
             )
 
         cls.CONNECTION.commit()
-        return MusicDatabase.get_track(track["id"])
+        return MusicDatabase.get_track(track.id)
 
     @classmethod
-    def remove_track(cls, track_id, delete=False):
-        try:
-            if delete:
-                cls.CURSOR.execute("DELETE FROM tracks WHERE id = ?", (track_id,))
-                # Check and cleanup artists and albums
-            else:
-                MusicDatabase.add_track({"id": track_id, "hidden": True}, replace=True)
-            return True
-        except:
-            return False
-
+    @Metrics.timed("db_write")
+    def set_track_path(cls, track_id, track_path):
+        cls.CURSOR.execute("UPDATE tracks SET path = ? WHERE id = ?", (os.path.relpath(track_path, MyMelody.get_track_path()), track_id))
+        cls.CONNECTION.commit()
 
-    # ALBUMS
     @classmethod
-    def get_album(cls, album_id):
-        albums_by_artist = cls.CURSOR.execute("SELECT * FROM albums WHERE id = ?", (album_id,)).fetchall()
-        if not albums_by_artist:
-            return []
-        albums_by_artist = [dict(x) for x in albums_by_artist]
-        album = albums_by_artist[0]
-        album["artists"] = [MusicDatabase.get_artist(x["artist_id"]) for x in albums_by_artist]
-        album.pop("artist_id")
-        return album
+    @Metrics.timed("db_write")
+    def set_track_audio_hash(cls, track_id, audio_hash):
+        cls.CURSOR.execute("UPDATE tracks SET audio_hash = ? WHERE id = ?", (audio_hash, track_id))
+        cls.CONNECTION.commit()
 
     @classmethod
-    def get_all_albums(cls):
-        return [MusicDatabase.get_album(x["id"]) for x in cls.CURSOR.execute("SELECT id FROM albums").fetchall()]
+    @Metrics.timed("db_write")
+    def set_track_source(cls, track_id, quality, source_size, requested_quality):
+        cls.CURSOR.execute("UPDATE tracks SET quality = ?, source_size = ?, requested_quality = ? WHERE id = ?", (quality, source_size, requested_quality, track_id))
+        cls.CONNECTION.commit()
 
     @classmethod
-    def get_all_album_tracks(cls, album_id):
-        album = MusicDatabase.get_album(album_id)
-        if not album:
-            return []
-        track_ids = list(set([dict(x) for x in cls.CURSOR.execute("SELECT id from tracks WHERE album_id = ?", (album_id,)).fetchall()]))
-        return sorted([MusicDatabase.get_track(x) for x in track_ids], key=lambda x: x["track_number"])
+    @Metrics.timed("db_write")
+    def set_loudness(cls, content_id, loudness, gain, peak, blocks=None):
+        cls.CURSOR.execute(
+            "INSERT OR REPLACE INTO loudness (id, loudness, gain, peak, blocks) VALUES (?, ?, ?, ?, ?)",
+            (content_id, loudness, gain, peak, blocks and json.dumps(blocks)),
+        )
+        cls.CONNECTION.commit()
 
     @classmethod
-    def add_album(cls, album, hidden=False, replace=False):
-        existing_album = MusicDatabase.get_album(album["id"])
-        if existing_album and not replace:
-            return existing_album
-
-        match album["release_date_precision"]:
-            case "day":
-                release_date = album["release_date"]
-            case "month":
-                release_date = album["release_date"] + "-01"
-            case "year":
-                release_date = album["release_date"] + "-01-01"
-
-        for album_artist in [MusicDatabase.add_artist(x) for x in album["artists"]]:
-            cls.CURSOR.execute(
-                "INSERT OR REPLACE INTO albums (id, artist_id, name, album_type, total_tracks, release_date, artwork_url, hidden) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                (
-                    album["id"],
-                    album_artist["id"],
-                    album["name"],
-                    album["album_type"],
-                    album["total_tracks"],
-                    release_date,
-                    sorted(album["images"], key=lambda i: i["height"], reverse=True)[0]["url"],
-                    int(hidden),
-                )
-            )
+    def get_loudness(cls, content_id):
+        row = cls.CURSOR.execute("SELECT * FROM loudness WHERE id = ?", (content_id,)).fetchone()
+        if not row:
+            return None
+        return {**dict(row), "blocks": row["blocks"] and json.loads(row["blocks"])}
 
+    @classmethod
+    @Metrics.timed("db_write")
+    def add_download(cls, track, quality, source_size, stream_seconds, encode_seconds):
+        cls.CURSOR.execute(
+            "INSERT INTO downloads (track_id, quality, duration_ms, source_size, stream_seconds, encode_seconds, finished_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (track.id, quality, track.duration_ms, source_size, stream_seconds, encode_seconds, time.time()),
+        )
         cls.CONNECTION.commit()
-        return MusicDatabase.get_album(album["id"])
 
     @classmethod
-    def hide_album(cls, album):
-        hidden_album = MusicDatabase.add_album(album, hidden=True, replace=True)
-
+    def get_download_throughput(cls):
+        """
+        Returns the totals of the download history for each quality
+        """
+        return {x["quality"]: dict(x) for x in cls.CURSOR.execute(
+            "SELECT quality, COUNT(*) AS downloads, SUM(duration_ms) AS duration_ms, SUM(source_size) AS source_size, "
+            "SUM(stream_seconds) AS stream_seconds, SUM(encode_seconds) AS encode_seconds FROM downloads "
+            "WHERE duration_ms > 0 GROUP BY quality"
+        ).fetchall()}
 
-    # ARTISTS
     @classmethod
-    def get_artist(cls, artist_id):
-        artist = cls.CURSOR.execute("SELECT * FROM artists WHERE id = ?", (artist_id,)).fetchone()
-        if not artist:
-            return []
-        artist = dict(artist)
-        return artist
+    def get_source_rates(cls):
+        """
+        Returns the stream bytes per millisecond of audio of the downloaded
+        tracks at each quality
+        """
+        return {x["quality"]: x["source_size"] / x["duration_ms"] for x in cls.CURSOR.execute(
+            "SELECT quality, SUM(source_size) AS source_size, SUM(duration_ms) AS duration_ms FROM "
+            "(SELECT DISTINCT id, quality, source_size, duration_ms FROM tracks WHERE source_size > 0 AND duration_ms > 0) GROUP BY quality"
+        ).fetchall()}
 
     @classmethod
-    def get_all_artists(cls):
-        return [MusicDatabase.get_artist(x["id"]) for x in cls.CURSOR.execute("SELECT id FROM artists").fetchall()]
+    def get_download_queue(cls):
+        return {x["track_id"]: dict(x) for x in cls.CURSOR.execute("SELECT * FROM download_queue").fetchall()}
 
-    # TODO
     @classmethod
-    def get_all_artist_tracks(cls, album_id):
+    @Metrics.timed("db_write")
+    def set_download_queue(cls, entries):
+        cls.CURSOR.executemany(
+            "INSERT OR REPLACE INTO download_queue (track_id, source, priority, added_at, redownload) VALUES (?, ?, ?, ?, ?)",
+            [(x["track_id"], x["source"], x["priority"], x["added_at"], x.get("redownload") or 0) for x in entries],
+        )
+        cls.CONNECTION.commit()
+
+    @classmethod
+    def get_redownload_track_ids(cls):
+        return {x["track_id"] for x in cls.CURSOR.execute("SELECT track_id FROM download_queue WHERE redownload = 1").fetchall()}
+
+    @classmethod
+    def is_redownload(cls, track_id):
+        return bool(cls.CURSOR.execute("SELECT 1 FROM download_queue WHERE track_id = ? AND redownload = 1", (track_id,)).fetchone())
+
+    @classmethod
+    @Metrics.timed("db_write")
+    def remove_download_queue(cls, track_id):
+        cls.CURSOR.execute("DELETE FROM download_queue WHERE track_id = ?", (track_id,))
+        cls.CONNECTION.commit()
+
+    @classmethod
+    def get_artist_track_ids(cls, artist_id):
+        return [x["id"] for x in cls.CURSOR.execute("SELECT DISTINCT id FROM tracks WHERE artist_id = ?", (artist_id,)).fetchall()]
+
+    @classmethod
+    def get_existing_track_ids(cls, track_ids):
+        placeholders = ",".join("?" * len(track_ids))
+        return {x["id"] for x in cls.CURSOR.execute(f"SELECT DISTINCT id FROM tracks WHERE id IN ({placeholders})", track_ids).fetchall()}
+
+    @classmethod
+    def get_track_ids_without_isrc(cls):
+        return [x["id"] for x in cls.CURSOR.execute("SELECT DISTINCT id FROM tracks WHERE isrc IS NULL AND NOT hidden").fetchall()]
+
+    @classmethod
+    @Metrics.timed("db_write")
+    def set_track_isrcs(cls, isrcs):
+        cls.CURSOR.executemany("UPDATE tracks SET isrc = ? WHERE id = ?", [(v, k) for k,v in isrcs.items()])
+        cls.CONNECTION.commit()
+
+    @classmethod
+    def get_duplicate_track_ids(cls, track_id, isrc=None, audio_hash=None):
+        return [x["id"] for x in cls.CURSOR.execute(
+            "SELECT DISTINCT id FROM tracks WHERE id != ? AND ((isrc IS NOT NULL AND isrc = ?) OR (audio_hash IS NOT NULL AND audio_hash = ?))",
+            (track_id, isrc, audio_hash),
+        ).fetchall()]
+
+    @classmethod
+    def get_hidden_track_ids(cls):
+        return [x["id"] for x in cls.CURSOR.execute("SELECT DISTINCT id FROM tracks WHERE hidden = 1").fetchall()]
+
+    @classmethod
+    @Metrics.timed("db_write")
+    def remove_track(cls, track_id, delete=False):
+        try:
+            if delete:
+                cls.CURSOR.execute("DELETE FROM tracks WHERE id = ?", (track_id,))
+                cls.CONNECTION.commit()
+                # Check and cleanup artists and albums
+            else:
+                MusicDatabase.add_track(dataclasses.replace(MusicDatabase.get_track(track_id), hidden=True), replace=True)
+            return True
+        except:
+            return False
+
+
+    # ALBUMS
+    @classmethod
+    def get_album(cls, album_id):
+        albums_by_artist = cls.CURSOR.execute("SELECT * FROM albums WHERE id = ?", (album_id,)).fetchall()
+        if not albums_by_artist:
+            return None
+        return Album.from_row(albums_by_artist[0], [MusicDatabase.get_artist(x["artist_id"]) for x in albums_by_artist])
+
+    @classmethod
+    def get_all_albums(cls):
+        return [MusicDatabase.get_album(x["id"]) for x in cls.CURSOR.execute("SELECT DISTINCT id FROM albums").fetchall()]
+
+    @classmethod
+    def get_all_album_tracks(cls, album_id):
+        album = MusicDatabase.get_album(album_id)
+        if not album:
+            return []
+        track_ids = [x["id"] for x in cls.CURSOR.execute("SELECT DISTINCT id from tracks WHERE album_id = ?", (album_id,)).fetchall()]
+        return sorted([MusicDatabase.get_track(x) for x in track_ids], key=lambda x: (x.disc_number, x.track_number))
+
+    @classmethod
+    @Metrics.timed("db_write")
+    def add_album(cls, album, replace=False):
+        existing_album = MusicDatabase.get_album(album.id)
+        if existing_album and not replace:
+            return existing_album
+
+        for album_artist in [MusicDatabase.add_artist(x) for x in album.artists]:
+            cls.CURSOR.execute(
+                "INSERT OR REPLACE INTO albums (id, artist_id, name, album_type, total_tracks, release_date, artwork_url, hidden) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    album.id,
+                    album_artist.id,
+                    album.name,
+                    album.album_type,
+                    album.total_tracks,
+                    album.release_date,
+                    album.artwork_url,
+                    int(album.hidden),
+                )
+            )
+
+        cls.CONNECTION.commit()
+        return MusicDatabase.get_album(album.id)
+
+    @classmethod
+    @Metrics.timed("db_write")
+    def hide_album(cls, album):
+        return MusicDatabase.add_album(dataclasses.replace(album, hidden=True), replace=True)
+
+
+    # ARTISTS
+    @classmethod
+    def get_artist(cls, artist_id):
+        artist = cls.CURSOR.execute("SELECT * FROM artists WHERE id = ?", (artist_id,)).fetchone()
+        if not artist:
+            return None
+        return Artist.from_row(artist)
+
+    @classmethod
+    def get_all_artists(cls):
+        return [Artist.from_row(x) for x in cls.CURSOR.execute("SELECT * FROM artists").fetchall()]
+
+    # TODO
+    @classmethod
+    def get_all_artist_tracks(cls, album_id):
         album = MusicDatabase.get_album(album_id)
         if not album:
             return []
@@ -307,23 +1285,24 @@ class MusicDatabase:
         return sorted([MusicDatabase.get_track(x) for x in track_ids], key=lambda x: x["track_number"])
 
     @classmethod
-    def add_artist(cls, artist, hidden=False, follow=False, replace=False):
-        existing_artist = MusicDatabase.get_artist(artist["id"])
+    @Metrics.timed("db_write")
+    def add_artist(cls, artist, replace=False):
+        existing_artist = MusicDatabase.get_artist(artist.id)
         if existing_artist and not replace:
             return existing_artist
         
         cls.CURSOR.execute(
             "INSERT OR REPLACE INTO artists (id, name, follow, hidden) VALUES (?, ?, ?, ?)",
             (
-                artist["id"],
-                artist["name"],
-                int(follow),
-                int(hidden),
+                artist.id,
+                artist.name,
+                int(artist.follow),
+                int(artist.hidden),
             )
         )
 
         cls.CONNECTION.commit()
-        return MusicDatabase.get_artist(artist["id"])
+        return MusicDatabase.get_artist(artist.id)
 
     
     # PLAYLISTS
@@ -331,9 +1310,8 @@ class MusicDatabase:
     def get_playlist(cls, playlist_id):
         playlist_tracks = cls.CURSOR.execute("SELECT * FROM playlists WHERE id = ?", (playlist_id,)).fetchall()
         if not playlist_tracks:
-            return []
+            return None
         playlist_tracks = sorted([dict(x) for x in playlist_tracks], key=lambda x: x["track_order"])
-        # track_ids = list(set([dict(x) for x in cls.CURSOR.execute("SELECT track_id, order from tracks WHERE album_id = ?", (album_id,))]))
         playlist = {
             "id": playlist_id,
             "name": playlist_tracks[0]["name"],
@@ -343,28 +1321,57 @@ class MusicDatabase:
         return playlist
     
     @classmethod
-    def add_playlist(cls, playlist):
+    @Metrics.timed("db_write")
+    def add_playlist(cls, playlist, replace=False):
         existing_playlist = MusicDatabase.get_playlist(playlist["id"])
         if existing_playlist and replace:
-            MusicDatabase.remove_playlist(playlist["id"])
+            MusicDatabase.remove_playlist(playlist["id"], delete=True)
         
-        tracks = playlist["tracks"]
-        for track in tracks:
-            track["explicit"] = False
-        tracks = [MusicDatabase.add_track(x) for x in tracks]
+        tracks = [MusicDatabase.add_track(x) for x in playlist["tracks"]]
         for i in range(len(tracks)):
             cls.CURSOR.execute(
                 "INSERT OR REPLACE INTO playlists (id, track_id, track_order, name, artwork_url) VALUES (?, ?, ?, ?, ?)",
                 (
                     playlist["id"],
-                    tracks[i]["id"],
+                    tracks[i].id,
                     i+1,
                     playlist["name"],
-                    sorted(playlist["images"], key=lambda i: i["height"], reverse=True)[0]["url"],
+                    playlist["artwork_url"],
                 )
             )
 
+        cls.CONNECTION.commit()
+        return MusicDatabase.get_playlist(playlist["id"])
+
+    @classmethod
+    def get_track_playlist_ids(cls, track_id):
+        return [x["id"] for x in cls.CURSOR.execute("SELECT DISTINCT id FROM playlists WHERE track_id = ?", (track_id,)).fetchall()]
+
+    @classmethod
+    def get_all_playlist_ids(cls):
+        return [x["id"] for x in cls.CURSOR.execute("SELECT DISTINCT id FROM playlists").fetchall()]
+
     @classmethod
+    def iter_playlist_entries(cls, playlist_id):
+        """
+        Yields a row per track of the playlist in order, with only what a
+        playlist file needs, without building track records
+        """
+        yield from cls.CONNECTION.execute(
+            """
+            SELECT playlists.name AS playlist_name, tracks.id, tracks.name, tracks.duration_ms, tracks.path, tracks.hidden, GROUP_CONCAT(artists.name, '; ') AS artists
+            FROM playlists
+            JOIN tracks ON tracks.id = playlists.track_id
+            JOIN artists ON artists.id = tracks.artist_id
+            WHERE playlists.id = ?
+            GROUP BY playlists.track_order, tracks.id
+            ORDER BY playlists.track_order
+            """,
+            (playlist_id,),
+        )
+
+    @classmethod
+    @Metrics.timed("db_write")
     def remove_playlist(cls, playlist_id, delete=False):
         try:
             if delete:
@@ -379,10 +1386,6 @@ class MusicDatabase:
             return False
 
 
-        cls.CONNECTION.commit()
-        return MusicDatabase.get_playlist(playlist["id"])
-
-
 ################################################################################
 # Utilities                                                                    #
 ################################################################################
@@ -394,7 +1397,62 @@ def sanitize_name(name):
     return name
 
 
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+SPOTIFY_URI_REGEX = re.compile(r"^spotify:(track|album|artist|playlist):([0-9A-Za-z]+)$")
+SPOTIFY_URL_REGEX = re.compile(r"^https?://open\.spotify\.com/(?:intl-[\w-]+/)?(track|album|artist|playlist)/([0-9A-Za-z]+)/?(?:\?.*)?$")
+SPOTIFY_ID_REGEX = re.compile(r"^[0-9A-Za-z]+$")
+
+
+def parse_content_id(value, content_type):
+    """
+    Returns the content type and id of a raw id, spotify: URI or
+    open.spotify.com URL, raw ids being content_type, or None if it is none
+    of them
+    """
+    if regex := SPOTIFY_URI_REGEX.match(value) or SPOTIFY_URL_REGEX.match(value):
+        return f"{regex.group(1)}s", regex.group(2)
+    if SPOTIFY_ID_REGEX.match(value):
+        return content_type, value
+    return None
+
+
+def read_content_ids(ids, from_file, content_type):
+    """
+    Yields the content type and id of each comma or whitespace separated
+    entry in ids then from_file, reading a line at a time. Lines starting
+    with # are skipped
+    """
+    for line in itertools.chain([ids] if ids else [], from_file or []):
+        if line.lstrip().startswith("#"):
+            continue
+        for value in re.split(r"[\s,]+", line.strip()):
+            if not value:
+                continue
+            if content := parse_content_id(value, content_type):
+                yield content
+            else:
+                print(f"  Skipping {value}, not a Spotify id, URI or URL")
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
 def antiban_wait(seconds=5):
+    Metrics.count("antiban_wait_seconds", seconds)
+    Progress.throttled(seconds, "antiban")
+    if Progress.MODE == "jsonl":
+        time.sleep(seconds)
+        return
     for i in range(seconds)[::-1]:
         print(f"\r  Sleep for {i + 1} second(s)...", end="")
         time.sleep(1)
@@ -402,10 +1460,10 @@ def antiban_wait(seconds=5):
 
 
 def get_track_description(track, album=False, album_artists=False, artists=True):
-    track_name = track["name"]
-    track_album = track["album"]["name"]
-    track_album_artists = "; ".join(x["name"] for x in track["album"]["artists"])
-    track_artists = "; ".join([x["name"] for x in track["artists"]])
+    track_name = track.name
+    track_album = track.album.name
+    track_album_artists = "; ".join(x.name for x in track.album.artists)
+    track_artists = "; ".join([x.name for x in track.artists])
     track_string = track_name
     if album:
         track_string += f" from {track_album}"
@@ -418,134 +1476,1843 @@ def get_track_description(track, album=False, album_artists=False, artists=True)
 
 def get_track_path(track):
     track_path = MyMelody.get_track_path()
-    track_path += f"/{sanitize_name(track['album']['artists'][0]['name'])} [{track['album']['artists'][0]['id']}]"
-    track_path += f"/{sanitize_name(track['album']['name'])} [{track['album']['id']}]"
-    track_path += f"/{sanitize_name(track['name'])} [{track['id']}].mp3"
+    track_path += f"/{sanitize_name(track.album.artists[0].name)} [{track.album.artists[0].id}]"
+    track_path += f"/{sanitize_name(track.album.name)} [{track.album.id}]"
+    track_path += f"/{sanitize_name(track.name)} [{track.id}].mp3"
     return track_path
 
 
+################################################################################
+# Library index                                                                #
+################################################################################
+
+TRACK_FILENAME = re.compile(r"\[([0-9A-Za-z]{22})\]\.mp3$")
+
+class LibraryIndex:
+    """
+    Maps the [id] suffix of every track file under the track path to its
+    path. Directories are cached between runs along with their mtime, and
+    only rescanned when it has changed. Files rewritten in place don't
+    change that mtime, so only paths are indexed and anything needing a
+    file's size or mtime stats it
+    """
+    # Download workers add to the index while others read it
+    LOCK = threading.RLock()
+    LOADED = False
+    DIRECTORIES = {}
+    TRACKS = {}
+
+    @classmethod
+    def get_index_path(cls):
+        return MyMelody.CONFIG.get("index_path", "library_index.json")
+
+    @classmethod
+    def scan(cls, directory, cached_directories, directories):
+        try:
+            mtime = os.stat(directory).st_mtime
+        except FileNotFoundError:
+            return
+        entry = cached_directories.get(directory)
+        if not entry or entry["mtime"] != mtime:
+            entry = {"mtime": mtime, "subdirs": [], "files": {}, "others": 0}
+            with os.scandir(directory) as it:
+                for dir_entry in it:
+                    if dir_entry.is_dir(follow_symlinks=False):
+                        entry["subdirs"].append(dir_entry.name)
+                    elif regex := TRACK_FILENAME.search(dir_entry.name):
+                        entry["files"][regex.group(1)] = dir_entry.name
+                    else:
+                        entry["others"] += 1
+        directories[directory] = entry
+        for subdir in entry["subdirs"]:
+            cls.scan(os.path.join(directory, subdir), cached_directories, directories)
+
+    @classmethod
+    def load(cls):
+        cached_directories = {}
+        if os.path.exists(cls.get_index_path()):
+            with open(cls.get_index_path(), "r") as fh:
+                cached_directories = json.load(fh)
+        directories = {}
+        cls.scan(MyMelody.get_track_path(), cached_directories, directories)
+        tracks = {}
+        for directory, entry in directories.items():
+            for track_id, name in entry["files"].items():
+                # Older indexes stored [name, size, mtime]
+                if isinstance(name, list):
+                    name = name[0]
+                tracks[track_id] = os.path.join(directory, name)
+        with cls.LOCK:
+            cls.DIRECTORIES = directories
+            cls.TRACKS = tracks
+            cls.LOADED = True
+
+    @classmethod
+    def save(cls):
+        with cls.LOCK:
+            if not cls.LOADED:
+                return
+            with open(cls.get_index_path() + ".tmp", "w") as fh:
+                json.dump(cls.DIRECTORIES, fh)
+            os.replace(cls.get_index_path() + ".tmp", cls.get_index_path())
+
+    @classmethod
+    def check_loaded(cls):
+        if cls.LOADED:
+            return
+        with cls.LOCK:
+            if not cls.LOADED:
+                cls.load()
+
+    @classmethod
+    def get(cls, track_id):
+        """
+        Returns the path of the track's file, or None
+        """
+        cls.check_loaded()
+        with cls.LOCK:
+            return cls.TRACKS.get(track_id)
+
+    @classmethod
+    def add(cls, track_id, track_path):
+        cls.check_loaded()
+        with cls.LOCK:
+            cls.TRACKS[track_id] = track_path
+            cls.invalidate(os.path.dirname(track_path))
+
+    @classmethod
+    def remove(cls, track_id):
+        cls.check_loaded()
+        with cls.LOCK:
+            track_path = cls.TRACKS.pop(track_id, None)
+            if track_path:
+                cls.invalidate(os.path.dirname(track_path))
+
+    @classmethod
+    def invalidate(cls, directory):
+        # Marks the directory and its parents to be rescanned on the next run
+        subdir = None
+        with cls.LOCK:
+            while directory.startswith(MyMelody.get_track_path()):
+                entry = cls.DIRECTORIES.setdefault(directory, {"mtime": None, "subdirs": [], "files": {}, "others": 0})
+                entry["mtime"] = None
+                if subdir and subdir not in entry["subdirs"]:
+                    entry["subdirs"].append(subdir)
+                if directory == MyMelody.get_track_path():
+                    break
+                subdir = os.path.basename(directory)
+                directory = os.path.dirname(directory)
+
+
+################################################################################
+# Artwork                                                                      #
+################################################################################
+
+class ArtworkCache:
+    """
+    Keeps every artwork fetched in artwork_cache_path, and the most recently
+    used in memory, so each album's artwork is only downloaded once
+    """
+    LOCK = threading.Lock()
+    URL_LOCKS = {}
+    ARTWORK = collections.OrderedDict()
+    # Tracks download album by album, so only a few artworks are in use at once
+    MEMORY_SIZE = 32
+    TIMEOUT = 30
+
+    @classmethod
+    def get_cache_path(cls, url):
+        cache_path = MyMelody.CONFIG.get("artwork_cache_path", "artwork_cache")
+        return f"{cache_path}/{hashlib.sha1(url.encode()).hexdigest()}.jpg"
+
+    @classmethod
+    def get(cls, url):
+        import requests
+        if not url:
+            return None
+        with cls.LOCK:
+            url_lock = cls.URL_LOCKS.setdefault(url, threading.Lock())
+        with url_lock:
+            with cls.LOCK:
+                artwork = cls.ARTWORK.get(url)
+                if artwork is not None:
+                    cls.ARTWORK.move_to_end(url)
+            if artwork is not None:
+                Metrics.count("artwork_requests", source="memory")
+                return artwork
+            cache_path = cls.get_cache_path(url)
+            if os.path.exists(cache_path):
+                Metrics.count("artwork_requests", source="disk")
+                with open(cache_path, "rb") as fh:
+                    artwork = fh.read()
+            else:
+                Metrics.count("artwork_requests", source="network")
+                with Metrics.time("artwork_fetch"):
+                    resp = requests.get(url, timeout=cls.TIMEOUT)
+                resp.raise_for_status()
+                # Never cache an error page as the album's artwork
+                content_type = resp.headers.get("Content-Type", "")
+                if not content_type.startswith("image/"):
+                    raise ValueError(f"Artwork {url} has content type {content_type or 'none'}")
+                artwork = resp.content
+                Metrics.count("artwork_bytes", len(artwork))
+                pathlib.Path(os.path.dirname(cache_path)).mkdir(parents=True, exist_ok=True)
+                with open(cache_path + ".tmp", "wb") as fh:
+                    fh.write(artwork)
+                os.replace(cache_path + ".tmp", cache_path)
+            with cls.LOCK:
+                cls.ARTWORK[url] = artwork
+                while len(cls.ARTWORK) > cls.MEMORY_SIZE:
+                    cls.URL_LOCKS.pop(cls.ARTWORK.popitem(last=False)[0], None)
+            return artwork
+
+
+def get_track_artwork(track):
+    """
+    Returns the artwork of track's album, or None if it can't be fetched, so
+    a broken image never costs a track its audio. retag adds it later
+    """
+    import requests
+    try:
+        return ArtworkCache.get(track.album.artwork_url)
+    except (requests.RequestException, ValueError) as e:
+        Metrics.count("artwork_failures")
+        Progress.artwork_failed(track, f"{type(e).__name__}: {e}")
+        return None
+
+
+################################################################################
+# Loudness                                                                     #
+################################################################################
+
+# ReplayGain 2.0 targets -18 LUFS
+REPLAYGAIN_REFERENCE = -18
+# EBU R128 gating, in LUFS and LU below the ungated loudness
+LOUDNESS_ABSOLUTE_GATE = -70
+LOUDNESS_RELATIVE_GATE = -10
+# Block loudnesses are kept as a histogram of bins this many LU wide, enough
+# to gate an album's blocks without the tracks' audio
+LOUDNESS_BIN = 0.1
+# FFT size and overlap of the K-weighting filter, the overlap well past the
+# few milliseconds its response takes to decay
+LOUDNESS_FILTER_SIZE = 1 << 16
+LOUDNESS_FILTER_WARMUP = 1 << 13
+# Windows filtered at once, bounding the memory analysis takes to tens of MB
+# whatever the length of the track
+LOUDNESS_FILTER_WINDOWS = 8
+
+
+def get_k_weighting(numpy, frequencies, sample_rate):
+    """
+    Returns the response of BS.1770's K-weighting filter at frequencies, its
+    high shelf and high pass biquads designed for sample_rate
+    """
+    z = numpy.exp(-2j * numpy.pi * frequencies / sample_rate)
+
+    K = math.tan(math.pi * 1681.974450955533 / sample_rate)
+    Q = 0.7071752369554196
+    Vh = 10 ** (3.999843853973347 / 20)
+    Vb = Vh ** 0.4996667741545416
+    a0 = 1 + K / Q + K * K
+    shelf = (
+        ((Vh + Vb * K / Q + K * K) + 2 * (K * K - Vh) * z + (Vh - Vb * K / Q + K * K) * z ** 2)
+        / (a0 + 2 * (K * K - 1) * z + (1 - K / Q + K * K) * z ** 2)
+    )
+
+    K = math.tan(math.pi * 38.13547087602444 / sample_rate)
+    Q = 0.5003270373238773
+    a0 = 1 + K / Q + K * K
+    high_pass = (a0 - 2 * a0 * z + a0 * z ** 2) / (a0 + 2 * (K * K - 1) * z + (1 - K / Q + K * K) * z ** 2)
+    return shelf * high_pass
+
+
+def get_block_loudness(power):
+    return -0.691 + 10 * math.log10(power)
+
+
+def analyze_loudness(segment):
+    """
+    Measures a decoded pydub AudioSegment as EBU R128 does, returning its
+    integrated loudness, sample peak and block histogram, or None without
+    numpy or for audio shorter than a block
+    """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    sample_rate = segment.frame_rate
+    channels = segment.channels
+    # The decoded integers, without copying them, only scaled to floats a
+    # chunk at a time
+    samples = numpy.frombuffer(segment.raw_data, dtype=f"i{segment.sample_width}").reshape(-1, channels)
+    scale = 2 ** (8 * segment.sample_width - 1)
+    length = samples.shape[0]
+    step = int(0.1 * sample_rate)
+    block = 4 * step
+    if length < block:
+        return None
+
+    # Filter in the frequency domain by overlap-save, each window starting
+    # LOUDNESS_FILTER_WARMUP samples early so the filters' tails have decayed
+    # by the samples kept. Only LOUDNESS_FILTER_WINDOWS windows are filtered
+    # at once, keeping the energy of each 100 ms step
+    response = get_k_weighting(numpy, numpy.fft.rfftfreq(LOUDNESS_FILTER_SIZE, 1 / sample_rate), sample_rate)
+    chunk = LOUDNESS_FILTER_SIZE - LOUDNESS_FILTER_WARMUP
+    span = LOUDNESS_FILTER_WINDOWS * chunk
+    step_energies = []
+    remainder = numpy.zeros(0)
+    peak = 0.0
+    for start in range(0, length, span):
+        end = min(start + span, length)
+        first = max(start - LOUDNESS_FILTER_WARMUP, 0)
+        padded = numpy.zeros((LOUDNESS_FILTER_WARMUP + span, channels))
+        padded[LOUDNESS_FILTER_WARMUP - (start - first):LOUDNESS_FILTER_WARMUP + end - start] = samples[first:end]
+        padded /= scale
+        peak = max(peak, float(numpy.abs(padded[LOUDNESS_FILTER_WARMUP:]).max()))
+        windows = numpy.lib.stride_tricks.sliding_window_view(padded, LOUDNESS_FILTER_SIZE, axis=0)[::chunk]
+        weighted = numpy.fft.irfft(numpy.fft.rfft(windows, axis=2) * response, n=LOUDNESS_FILTER_SIZE, axis=2)
+        energy = numpy.square(weighted[:, :, LOUDNESS_FILTER_WARMUP:]).sum(axis=1).reshape(-1)[:end - start]
+        energy = numpy.concatenate((remainder, energy))
+        steps = len(energy) // step
+        step_energies.append(energy[:steps * step].reshape(steps, step).sum(axis=1))
+        remainder = energy[steps * step:]
+
+    # Mean square of 400 ms blocks, four steps each, every 100 ms, summed
+    # over the channels
+    energy = numpy.concatenate(([0.0], numpy.cumsum(numpy.concatenate(step_energies))))
+    powers = (energy[4:] - energy[:-4]) / block
+    powers = powers[powers > 10 ** ((LOUDNESS_ABSOLUTE_GATE + 0.691) / 10)]
+
+    bins = ((-0.691 + 10 * numpy.log10(powers) - LOUDNESS_ABSOLUTE_GATE) / LOUDNESS_BIN).astype(int)
+    counts = numpy.bincount(bins)
+    sums = numpy.bincount(bins, weights=powers)
+    blocks = {str(x): [int(counts[x]), float(sums[x])] for x in numpy.flatnonzero(counts)}
+    return {
+        "loudness": get_integrated_loudness([blocks]),
+        "peak": peak,
+        "blocks": blocks,
+    }
+
+
+def get_integrated_loudness(histograms):
+    """
+    Gates the blocks of one or more block histograms, returning their
+    integrated loudness or None if they are all silent
+    """
+    blocks = {}
+    for histogram in histograms:
+        for index, (count, power) in histogram.items():
+            total = blocks.setdefault(int(index), [0, 0.0])
+            total[0] += count
+            total[1] += power
+    count = sum(x[0] for x in blocks.values())
+    if not count:
+        return None
+    gate = get_block_loudness(sum(x[1] for x in blocks.values()) / count) + LOUDNESS_RELATIVE_GATE
+    gated = [x for index, x in blocks.items() if LOUDNESS_ABSOLUTE_GATE + index * LOUDNESS_BIN >= gate]
+    return get_block_loudness(sum(x[1] for x in gated) / sum(x[0] for x in gated))
+
+
+def set_replaygain_tags(track_path, scope, gain, peak):
+    from mutagen.id3 import ID3, TXXX
+    values = {
+        f"REPLAYGAIN_{scope.upper()}_GAIN": f"{gain:.2f} dB",
+        f"REPLAYGAIN_{scope.upper()}_PEAK": f"{peak:.6f}",
+    }
+    track_tags = ID3(track_path)
+    # Files hardlinked by dedup stay linked while their tags agree
+    if all([x.text for x in track_tags.getall(f"TXXX:{k}")] == [[v]] for k,v in values.items()):
+        return
+    unshare_file(track_path)
+    for k,v in values.items():
+        track_tags.setall(f"TXXX:{k}", [TXXX(encoding=3, desc=k, text=v)])
+    track_tags.save()
+
+
+def get_track_loudness(track):
+    """
+    Returns the loudness measured for track, or for a duplicate it was linked
+    to
+    """
+    for track_id in [track.id] + MusicDatabase.get_duplicate_track_ids(track.id, isrc=track.isrc, audio_hash=track.audio_hash):
+        if loudness := MusicDatabase.get_loudness(track_id):
+            return loudness
+    return None
+
+
+def finalize_album_loudness(album_id):
+    """
+    Once every shown track of the album has been measured, gates their blocks
+    together and tags the album gain into their files
+    """
+    with MusicDatabase.LOCK:
+        tracks = [x for x in MusicDatabase.get_all_album_tracks(album_id) if not x.hidden]
+        track_loudness = [get_track_loudness(x) for x in tracks]
+        if not tracks or None in track_loudness:
+            return False
+        loudness = get_integrated_loudness([x["blocks"] for x in track_loudness if x["blocks"]])
+        if loudness is None:
+            return False
+        gain = REPLAYGAIN_REFERENCE - loudness
+        peak = max(x["peak"] for x in track_loudness)
+        MusicDatabase.set_loudness(album_id, loudness, gain, peak)
+        track_paths = [track_path for x in tracks if (track_path := LibraryIndex.get(x.id))]
+    # The files are tagged without holding up everything else on the database
+    for track_path in track_paths:
+        set_replaygain_tags(track_path, "album", gain, peak)
+    return True
+
+
+@Metrics.timed("loudness")
+def measure_track_loudness(track, track_path):
+    """
+    Measures a track downloaded without its loudness from its file, tagging
+    its track gain
+    """
+    import pydub
+    loudness = analyze_loudness(pydub.AudioSegment.from_mp3(track_path))
+    if not loudness or loudness["loudness"] is None:
+        return None
+    gain = REPLAYGAIN_REFERENCE - loudness["loudness"]
+    set_replaygain_tags(track_path, "track", gain, loudness["peak"])
+    with MusicDatabase.LOCK:
+        MusicDatabase.set_loudness(track.id, loudness["loudness"], gain, loudness["peak"], loudness["blocks"])
+    return loudness
+
+
+def measure_tracks_loudness(tracks, workers=None):
+    """
+    Measures the downloaded tracks that have no loudness yet across threads,
+    returning how many were measured
+    """
+    from tqdm import tqdm
+    with MusicDatabase.LOCK:
+        tracks = [(x, track_path) for x in tracks if not x.hidden and (track_path := LibraryIndex.get(x.id)) and not get_track_loudness(x)]
+    measured = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(measure_track_loudness, track, track_path) for track, track_path in tracks]
+        for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc="  Measuring", unit="file"):
+            if future.result():
+                measured += 1
+    return measured
+
+
+################################################################################
+# Download queue                                                               #
+################################################################################
+
+class DownloadQueue:
+    """
+    Orders the tracks waiting to download by why they were added, how long
+    they have waited and how recent their release is, keeping each album's
+    tracks from the same source together
+    """
+    # Priority of each source, playlists first and artist backfills last.
+    # Tracks queued before sources were recorded count as backfills
+    SOURCES = {
+        "playlist": 300,
+        "track": 200,
+        "artist": 100,
+    }
+    # Points gained per day waiting, so backfills are never starved
+    AGE_WEIGHT = 10
+    # Points for a release out today, falling to none over RECENCY_DAYS
+    RECENCY_WEIGHT = 50
+    RECENCY_DAYS = 365
+
+    @classmethod
+    def get_sources(cls):
+        return {**cls.SOURCES, **MyMelody.CONFIG.get("download_priorities", {})}
+
+    @classmethod
+    def add(cls, tracks, source):
+        """
+        Queues tracks from source, keeping the earlier time and the higher
+        priority source of tracks already queued
+        """
+        sources = cls.get_sources()
+        with MusicDatabase.LOCK:
+            queue = MusicDatabase.get_download_queue()
+            entries = {}
+            for track in filter(None, tracks):
+                entry = queue.get(track.id) or {"track_id": track.id, "source": None, "priority": 0, "added_at": time.time()}
+                if entry["source"] is None or sources.get(source, 0) > sources.get(entry["source"], 0):
+                    entries[track.id] = {**entry, "source": source}
+            if entries:
+                MusicDatabase.set_download_queue(entries.values())
+
+    @classmethod
+    def adjust(cls, track_ids, priority):
+        """
+        Sets the points added to the priority of track_ids
+        """
+        with MusicDatabase.LOCK:
+            queue = MusicDatabase.get_download_queue()
+            MusicDatabase.set_download_queue([
+                {**(queue.get(x) or {"track_id": x, "source": None, "added_at": time.time()}), "priority": priority}
+                for x in track_ids
+            ])
+
+    @classmethod
+    def redownload(cls, tracks):
+        """
+        Queues downloaded tracks to download again. Their files are kept until
+        the new downloads replace them
+        """
+        with MusicDatabase.LOCK:
+            queue = MusicDatabase.get_download_queue()
+            MusicDatabase.set_download_queue([
+                {**(queue.get(x.id) or {"track_id": x.id, "source": "track", "priority": 0, "added_at": time.time()}), "redownload": 1}
+                for x in tracks
+            ])
+
+    @classmethod
+    def get_release_age(cls, release_date, now):
+        """
+        Returns days since release_date, which may be just a year or a year
+        and month, or None if it has none
+        """
+        try:
+            parts = [int(x) for x in release_date.split("-")] + [1, 1]
+            release = datetime.datetime(*parts[:3], tzinfo=datetime.timezone.utc).timestamp()
+        except (AttributeError, ValueError):
+            return None
+        return max(0, now - release) / 86400
+
+    @classmethod
+    def get_priority(cls, track, entry, now, sources):
+        entry = entry or {"source": None, "priority": 0, "added_at": now}
+        priority = sources.get(entry["source"], sources["artist"]) + (entry["priority"] or 0)
+        priority += cls.AGE_WEIGHT * (now - (entry["added_at"] or now)) / 86400
+        release_age = cls.get_release_age(track.album.release_date, now)
+        if release_age is not None:
+            priority += cls.RECENCY_WEIGHT * max(0, 1 - release_age / cls.RECENCY_DAYS)
+        return priority
+
+    @classmethod
+    def order(cls, tracks):
+        """
+        Returns tracks with their priorities, highest first. Tracks of an
+        album queued from the same source and adjusted alike go together at
+        the highest of their priorities, in album order
+        """
+        now = time.time()
+        sources = cls.get_sources()
+        queue = MusicDatabase.get_download_queue()
+        groups = {}
+        for track in tracks:
+            entry = queue.get(track.id) or {}
+            group = groups.setdefault((track.album.id, entry.get("source"), entry.get("priority") or 0), [])
+            group.append((track, cls.get_priority(track, queue.get(track.id), now, sources)))
+        ordered = sorted(groups.items(), key=lambda x: (-max(y[1] for y in x[1]), x[0][0]))
+        return [x for _, group in ordered for x in sorted(group, key=lambda x: (x[0].disc_number, x[0].track_number))]
+
+
 ################################################################################
 # Download                                                                     #
 ################################################################################
 
 def tracks_to_download():
+    redownload = MusicDatabase.get_redownload_track_ids()
     download = []
     for track in MusicDatabase.get_all_tracks():
-        track_path = get_track_path(track)
-        if track["hidden"] or os.path.exists(track_path):
+        if track.hidden or (LibraryIndex.get(track.id) and track.id not in redownload):
             continue
         download.append(track)
-    return download
+    return [x for x, _ in DownloadQueue.order(download)]
 
-def set_track_tags(track):
-    track_path = get_track_path(track)
+def get_track_tags(track):
+    return {
+        "album": track.album.name,
+        "albumartist": "; ".join([x.name for x in track.album.artists]),
+        "artist": "; ".join([x.name for x in track.artists]),
+        "discnumber": str(track.disc_number),
+        "tracknumber": str(track.track_number),
+        "title": track.name,
+        "date": track.album.release_date,
+    }
+
+
+def update_track_tags(track, track_path):
+    """
+    Rewrites only the text tags that differ from the database, returning them
+    """
+    from mutagen.easyid3 import EasyID3
+    from mutagen.mp3 import MP3
+    track_tags = MP3(track_path, ID3=EasyID3)
+    if track_tags.tags is None:
+        track_tags.add_tags()
+    changed_tags = {k:v for k,v in get_track_tags(track).items() if track_tags.tags.get(k) != [v]}
+    if changed_tags:
+        unshare_file(track_path)
+        for k,v in changed_tags.items():
+            track_tags[k] = v
+        track_tags.save()
+    return changed_tags
+
+
+@Metrics.timed("tagging")
+def set_track_tags(track, track_path=None):
+    from mutagen.easyid3 import EasyID3
+    from mutagen.id3 import APIC, ID3
+    from mutagen.mp3 import MP3
+    track_path = track_path or get_track_path(track)
 
     track_tags = MP3(track_path, ID3=EasyID3)
-    track_tags["album"] = track["album"]["name"]
-    track_tags["albumartist"] = "; ".join([x["name"] for x in track["album"]["artists"]])
-    track_tags["artist"] = "; ".join([x["name"] for x in track["artists"]])
-    track_tags["discnumber"] = str(track["disc_number"])
-    track_tags["tracknumber"] = str(track["track_number"])
-    track_tags["title"] = track["name"]
-    track_tags["date"] = track["album"]["release_date"]
+    for k,v in get_track_tags(track).items():
+        track_tags[k] = v
     track_tags.save()
+    artwork = get_track_artwork(track)
+    if not artwork:
+        return
     track_tags = MP3(track_path, ID3=ID3)
     track_tags.tags["APIC"] = APIC(
         encoding=0,
         mime="image/jpeg",
         type=3,
         desc="Cover",
-        data=requests.get(track["album"]["artwork_url"]).content,
+        data=artwork,
     )
     track_tags.save()
 
 
-def download_track(track):
+@Metrics.timed("tagging")
+def retag_track(track, track_path):
+    """
+    Rewrites only the tags, including artwork, that differ from what
+    set_track_tags would write, returning them
+    """
+    from mutagen.id3 import APIC, ID3
+    changed_tags = update_track_tags(track, track_path)
+    artwork = get_track_artwork(track)
+    track_tags = ID3(track_path)
+    if artwork and [x.data for x in track_tags.getall("APIC")] != [artwork]:
+        unshare_file(track_path)
+        track_tags.delall("APIC")
+        track_tags["APIC"] = APIC(
+            encoding=0,
+            mime="image/jpeg",
+            type=3,
+            desc="Cover",
+            data=artwork,
+        )
+        track_tags.save()
+        changed_tags["artwork"] = track.album.artwork_url
+    return changed_tags
+
+
+def retag_tracks(tracks, workers=None):
+    """
+    Retags the files of tracks across threads, returning the changed tags of
+    each retagged track. A file that fails is reported and the rest carry on
+    """
+    from tqdm import tqdm
+    tracks = [(x, track_path) for x in tracks if not x.hidden and (track_path := LibraryIndex.get(x.id))]
+    retagged = {}
+    failed = 0
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(retag_track, track, track_path): track for track, track_path in tracks}
+        for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc="  Retagging", unit="file"):
+            try:
+                changed_tags = future.result()
+            except Exception as e:
+                failed += 1
+                Metrics.count("retags", result="failed")
+                Progress.track_failed(futures[future], f"{type(e).__name__}: {e}")
+                continue
+            Metrics.count("retags", result="retagged" if changed_tags else "unchanged")
+            if changed_tags:
+                retagged[futures[future].id] = changed_tags
+    elapsed = time.perf_counter() - start
+    print(f"Retagged {len(retagged)} of {len(tracks)} files, {failed} failed, in {elapsed:.1f}s ({len(tracks) / max(elapsed, 1e-6):.1f} files/s)")
+    return retagged
+
+
+# Vorbis stream qualities, lowest first, and their nominal bitrate in kbps
+QUALITIES = {
+    "NORMAL": 96,
+    "HIGH": 160,
+    "VERY_HIGH": 320,
+}
+# Highest source bitrate in kbps for each LAME VBR preset and CBR bitrate,
+# leaving headroom for the lossy to lossy transcode
+ENCODE_PRESETS = [
+    (112, "5", "128k"),
+    (192, "2", "192k"),
+    (math.inf, "0", "320k"),
+]
+
+
+def get_track_quality(track):
+    """
+    Returns the highest quality configured for the library or any playlist
+    the track is on
+    """
+    qualities = [MyMelody.CONFIG.get("quality", "HIGH")]
+    playlist_quality = MyMelody.CONFIG.get("playlist_quality", {})
+    if playlist_quality:
+        with MusicDatabase.LOCK:
+            qualities += [playlist_quality[x] for x in MusicDatabase.get_track_playlist_ids(track.id) if x in playlist_quality]
+    return max(qualities, key=list(QUALITIES).index)
+
+
+def get_stream_quality(stream, requested_quality):
+    """
+    Returns the quality of the file the stream was loaded from, which is
+    lower than requested_quality when the track has no file at it
+    """
+    from librespot.audio.decoders import AudioQuality
+    try:
+        audio_file = next(x for x in stream.track.file if x.file_id.hex() == stream.metrics.file_id)
+        quality = AudioQuality.get_quality(audio_file.format).name
+        return quality if quality in QUALITIES else requested_quality
+    except (AttributeError, StopIteration, RuntimeError):
+        # Recorded and synthetic streams don't say
+        return requested_quality
+
+
+def get_encode_parameters(track, quality, source_size):
+    """
+    Picks ffmpeg's MP3 settings from the source's bitrate, measured from its
+    size when the duration is known
+    """
+    source_kbps = source_size * 8 / track.duration_ms if track.duration_ms else QUALITIES[quality]
+    vbr_preset, cbr_bitrate = next((x[1], x[2]) for x in ENCODE_PRESETS if source_kbps <= x[0])
+    if MyMelody.CONFIG.get("encode_mode", "vbr") == "cbr":
+        return {"bitrate": cbr_bitrate}
+    return {"parameters": ["-q:a", vbr_preset]}
+
+
+def is_redownload(track):
+    with MusicDatabase.LOCK:
+        return MusicDatabase.is_redownload(track.id)
+
+
+def is_download_needed(track):
+    """
+    Whether download_track would stream the track, rather than skip or link it
+    """
+    if track.hidden:
+        return False
+    if LibraryIndex.get(track.id):
+        return is_redownload(track)
+    if MyMelody.CONFIG.get("dedup", False):
+        with MusicDatabase.LOCK:
+            return not find_duplicate_file(track)
+    return True
+
+
+def close_stream(stream):
+    try:
+        stream.input_stream.close()
+    except Exception:
+        pass
+
+
+class StreamPrefetcher:
+    """
+    Loads the streams of the next count tracks in the queue while earlier
+    ones download and encode. Streams are only started while the estimated
+    size of those waiting to be read stays within memory bytes
+    """
+    def __init__(self, tracks, count=2, memory=64 * 2**20):
+        self.tracks = tracks
+        self.count = count
+        self.memory = memory
+        self.lock = threading.Lock()
+        self.prefetched = {}
+        self.next_index = 0
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=count) if count else None
+
+    def get_size(self, track, quality):
+        return (track.duration_ms or 240000) * QUALITIES[quality] // 8
+
+    def fill(self, index):
+        from librespot.metadata import TrackId
+        with self.lock:
+            self.next_index = max(self.next_index, index + 1)
+            size = sum(x[1] for x in self.prefetched.values())
+            while self.next_index <= index + self.count and self.next_index < len(self.tracks):
+                track = self.tracks[self.next_index]
+                if is_download_needed(track):
+                    quality = get_track_quality(track)
+                    track_size = self.get_size(track, quality)
+                    if self.prefetched and size + track_size > self.memory:
+                        break
+                    future = self.executor.submit(MyMelody.get_content_stream, TrackId.from_uri(f"spotify:track:{track.id}"), None, quality)
+                    self.prefetched[self.next_index] = (future, track_size)
+                    size += track_size
+                self.next_index += 1
+
+    def cancel(self, future):
+        if not future.cancel() and not future.exception():
+            close_stream(future.result())
+
+    def take(self, index, track):
+        """
+        Returns the stream prefetched for the track at index, or None, and
+        starts prefetching the tracks after it
+        """
+        if not self.executor:
+            return None
+        with self.lock:
+            future = self.prefetched.pop(index, (None, 0))[0]
+        if future and not is_download_needed(track):
+            Metrics.count("prefetches", result="cancelled")
+            self.cancel(future)
+            future = None
+        self.fill(index)
+        if future is None:
+            return None
+        try:
+            stream = future.result()
+        except Exception:
+            # download_track loads the stream again itself
+            Metrics.count("prefetches", result="failed")
+            return None
+        Metrics.count("prefetches", result="used")
+        return stream
+
+    def close(self):
+        if not self.executor:
+            return
+        with self.lock:
+            prefetched, self.prefetched = self.prefetched, {}
+        for future, _ in prefetched.values():
+            self.cancel(future)
+        self.executor.shutdown(wait=False)
+
+
+class TrackLock:
+    """
+    Claims a track's path with its .lock file, so workers and hosts sharing a
+    library never download the same track. The file holds a token naming
+    its holder and is only removed by it. Where fcntl is available the
+    holder also keeps an flock on the file, which the kernel drops if the
+    holder dies, so a crash never leaves a track claimed. Elsewhere the
+    holder refreshes the file's mtime, and one not refreshed for
+    lock_timeout seconds is taken over
+    """
+    def __init__(self, track_path):
+        self.path = track_path + ".lock"
+        self.token = os.urandom(16).hex()
+        self.fd = None
+        self.released = threading.Event()
+
+    def get_timeout(self):
+        return MyMelody.CONFIG.get("lock_timeout", 3600)
+
+    def get_holder(self):
+        return json.dumps({"token": self.token, "host": socket.gethostname(), "pid": os.getpid(), "time": time.time()})
+
+    def read_token(self):
+        try:
+            with open(self.path, "r") as fh:
+                return json.load(fh).get("token")
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def acquire_flock(self):
+        while True:
+            fd = os.open(self.path, os.O_CREAT | os.O_RDWR, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                return False
+            # The holder before may have released it, removing the file that
+            # was opened
+            try:
+                if os.stat(self.path).st_ino == os.fstat(fd).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+        os.ftruncate(fd, 0)
+        os.write(fd, self.get_holder().encode())
+        self.fd = fd
+        return True
+
+    def acquire_file(self):
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+                break
+            except FileExistsError:
+                pass
+            try:
+                if time.time() - os.stat(self.path).st_mtime < self.get_timeout():
+                    return False
+            except FileNotFoundError:
+                continue
+            # Move the stale lock to a path of its own, then race the other
+            # workers taking it over to create a new one, which only one of
+            # them can
+            stale_path = f"{self.path}.{self.token}"
+            try:
+                os.rename(self.path, stale_path)
+            except FileNotFoundError:
+                continue
+            if time.time() - os.stat(stale_path).st_mtime < self.get_timeout():
+                # Another worker took it over first and this moved their new
+                # lock, so it is put back unless yet another was created
+                try:
+                    os.link(stale_path, self.path)
+                except FileExistsError:
+                    pass
+                os.remove(stale_path)
+                return False
+            os.remove(stale_path)
+        with os.fdopen(fd, "w") as fh:
+            fh.write(self.get_holder())
+        return True
+
+    def acquire(self):
+        if not (self.acquire_flock() if fcntl else self.acquire_file()):
+            return False
+        threading.Thread(target=self.heartbeat, daemon=True).start()
+        return True
+
+    def heartbeat(self):
+        while not self.released.wait(self.get_timeout() / 4):
+            try:
+                if self.read_token() == self.token:
+                    os.utime(self.path)
+            except FileNotFoundError:
+                pass
+
+    def release(self):
+        self.released.set()
+        if self.read_token() == self.token:
+            os.remove(self.path)
+        # Closed after the file is removed, so nobody locks it in between
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def commit_file(staging_path, path):
+    """
+    Flushes staging_path to disk and renames it over path, so path is either
+    missing or complete
+    """
+    with open(staging_path, "rb+") as fh:
+        os.fsync(fh.fileno())
+    os.replace(staging_path, path)
+    if hasattr(os, "O_DIRECTORY"):
+        fd = os.open(os.path.dirname(path), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def download_track(track, session=None, stream=None):
     track_path = get_track_path(track)
+    # Tracks queued to download again are replaced once their new file is
+    # committed, so a failed download keeps the old one
+    redownload = is_redownload(track)
 
-    if track["hidden"] or os.path.exists(track_path):
-        print(f"  Skipping {get_track_description(track)}")
+    if track.hidden or (LibraryIndex.get(track.id) and not redownload):
+        if stream:
+            close_stream(stream)
+        Metrics.count("tracks", result="skipped")
+        Progress.track_finished(track, "skipped")
         return False
 
     pathlib.Path(os.path.dirname(track_path)).mkdir(parents=True, exist_ok=True)
-    with tempfile.NamedTemporaryFile() as fh:
-        stream = MyMelody.get_content_stream(TrackId.from_uri(f"spotify:track:{track['id']}"))
-        total_size = stream.input_stream.size
-        progress = tqdm(total=total_size, desc="  "+get_track_description(track))
-        downloaded = 0
-        fail_count = 0
-        while downloaded < total_size:
-            remaining = total_size - downloaded
-            read_size = min(20000, remaining)
+    # Another worker or host may have claimed or finished it since the queue
+    # was built
+    track_lock = TrackLock(track_path)
+    if not track_lock.acquire():
+        if stream:
+            close_stream(stream)
+        Metrics.count("tracks", result="claimed")
+        Progress.track_finished(track, "claimed")
+        return False
+    if os.path.exists(track_path) and not redownload:
+        track_lock.release()
+        if stream:
+            close_stream(stream)
+        LibraryIndex.add(track.id, track_path)
+        Metrics.count("tracks", result="skipped")
+        Progress.track_finished(track, "skipped")
+        return False
+    try:
+        return download_claimed_track(track, track_path, session, stream, redownload=redownload)
+    finally:
+        track_lock.release()
+
 
+def download_claimed_track(track, track_path, session=None, stream=None, redownload=False):
+    from librespot.metadata import TrackId
+    import pydub
+    try:
+        # A duplicate's file is no better than the one being replaced
+        dedup = MyMelody.CONFIG.get("dedup", False) and not redownload
+        with MusicDatabase.LOCK:
+            source_path = dedup and find_duplicate_file(track)
+        if source_path:
+            if not link_duplicate_file(source_path, track, track_path):
+                return None
+            LibraryIndex.add(track.id, track_path)
+            with MusicDatabase.LOCK:
+                MusicDatabase.set_track_path(track.id, track_path)
+                MusicDatabase.remove_download_queue(track.id)
+            return True
+
+        requested_quality = get_track_quality(track)
+        with tempfile.NamedTemporaryFile() as fh:
             try:
-                data = stream.input_stream.stream().read(read_size)
-            except IndexError as e:
-                print(f"Stream download failed with id: {track['id']}")
+                stream = stream or MyMelody.get_content_stream(TrackId.from_uri(f"spotify:track:{track.id}"), session, requested_quality)
+            except Exception as e:
+                # Only this track is unavailable, the rest still download
+                if not is_content_error(e):
+                    raise
+                Metrics.count("tracks", result="unavailable")
+                Progress.track_failed(track, f"{type(e).__name__}: {e}")
+                return None
+            quality = get_stream_quality(stream, requested_quality)
+            stream_start = time.perf_counter()
+            audio_hash = read_stream(track, stream, fh)
+            # The audio is in fh, so free the stream's buffers before encoding
+            close_stream(stream)
+            if audio_hash is None:
                 return None
+            stream_seconds = time.perf_counter() - stream_start
+            source_size = fh.tell()
+            loudness = None
+            encode_seconds = None
+            with MusicDatabase.LOCK:
+                source_path = dedup and find_duplicate_file(track, audio_hash=audio_hash)
+            if source_path:
+                if not link_duplicate_file(source_path, track, track_path):
+                    return None
+            else:
+                # Encode and tag next to track_path, so a crash never leaves a
+                # partial file where the library index would count it as done
+                staging_path = track_path + ".part"
+                try:
+                    encode_start = time.perf_counter()
+                    with Metrics.time("transcode"):
+                        segment = pydub.AudioSegment.from_ogg(fh.name)
+                        segment.export(staging_path, format="mp3", **get_encode_parameters(track, quality, source_size))
+                    # Measure the samples the transcode already decoded, so
+                    # players never have to scan the file for them
+                    if MyMelody.CONFIG.get("replaygain", True):
+                        with Metrics.time("loudness"):
+                            loudness = analyze_loudness(segment)
+                    del segment
+                    set_track_tags(track, staging_path)
+                    if loudness and loudness["loudness"] is not None:
+                        set_replaygain_tags(staging_path, "track", REPLAYGAIN_REFERENCE - loudness["loudness"], loudness["peak"])
+                    commit_file(staging_path, track_path)
+                    encode_seconds = time.perf_counter() - encode_start
+                except Exception as e:
+                    if os.path.exists(staging_path):
+                        os.remove(staging_path)
+                    # Only this track failed, it stays queued and the rest of
+                    # the batch carries on
+                    Metrics.count("tracks", result="failed")
+                    Progress.track_failed(track, f"{type(e).__name__}: {e}")
+                    return None
+                Metrics.count("tracks", result="downloaded")
+                Progress.track_finished(track, "downloaded")
 
-            if not data:
-                fail_count += 1
-                if fail_count > 10: # Config var
-                    break
+        old_path = LibraryIndex.get(track.id)
+        if old_path and old_path != track_path:
+            # The track was downloaded again after its path changed
+            try:
+                os.remove(old_path)
+            except FileNotFoundError:
+                pass
+            LibraryIndex.remove(track.id)
+            prune_directories([old_path], added_paths=[track_path])
+        LibraryIndex.add(track.id, track_path)
+        with MusicDatabase.LOCK:
+            MusicDatabase.set_track_path(track.id, track_path)
+            MusicDatabase.set_track_audio_hash(track.id, audio_hash)
+            MusicDatabase.set_track_source(track.id, quality, source_size, requested_quality)
+            MusicDatabase.remove_download_queue(track.id)
+            if encode_seconds is not None:
+                MusicDatabase.add_download(track, quality, source_size, stream_seconds, encode_seconds)
+            if loudness and loudness["loudness"] is not None:
+                MusicDatabase.set_loudness(track.id, loudness["loudness"], REPLAYGAIN_REFERENCE - loudness["loudness"], loudness["peak"], loudness["blocks"])
+        return True
+    finally:
+        # However the download ends, a stream it was handed or opened is done
+        if stream:
+            close_stream(stream)
+
+
+def link_duplicate_file(source_path, track, track_path):
+    """
+    Links track to the file of its duplicate at source_path instead of
+    downloading it, returning False if that failed
+    """
+    print(f"  Linking {get_track_description(track)} to {source_path}")
+    try:
+        link_track_file(source_path, track, track_path)
+    except Exception as e:
+        Metrics.count("tracks", result="failed")
+        Progress.track_failed(track, f"{type(e).__name__}: {e}")
+        return False
+    Metrics.count("tracks", result="linked")
+    Progress.track_finished(track, "linked")
+    return True
+
+
+def read_stream(track, stream, fh):
+    """
+    Copies the stream into fh, returning the hash of its data or None if it
+    failed or ended early
+    """
+    total_size = stream.input_stream.size
+    Progress.track_started(track, total_size)
+    stream_hash = hashlib.sha1()
+    downloaded = 0
+    fail_count = 0
+    stream_start = time.perf_counter()
+    while downloaded < total_size:
+        remaining = total_size - downloaded
+        read_size = min(20000, remaining)
+
+        try:
+            data = stream.input_stream.stream().read(read_size)
+        except IndexError as e:
+            Metrics.count("tracks", result="failed")
+            Progress.track_failed(track, "stream download failed")
+            return None
+
+        if not data:
+            fail_count += 1
+            if fail_count > 10: # Config var
+                break
+        else:
+            fail_count = 0  # reset fail_count on successful data read
+
+        fh.write(data)
+        stream_hash.update(data)
+        downloaded += len(data)
+        Progress.track_bytes(track, downloaded)
+    Metrics.observe("stream_read", time.perf_counter() - stream_start)
+    Metrics.count("stream_bytes", downloaded)
+    # A stream that stopped short would encode to a truncated file, so the
+    # track stays queued for another try instead
+    if downloaded < total_size:
+        Metrics.count("tracks", result="failed")
+        Progress.track_failed(track, f"stream ended after {downloaded} of {total_size} bytes")
+        return None
+    return stream_hash.hexdigest()
+
+
+def find_duplicate_file(track, audio_hash=None):
+    """
+    Returns the file of another downloaded track with the same ISRC or stream
+    """
+    for track_id in MusicDatabase.get_duplicate_track_ids(track.id, isrc=track.isrc, audio_hash=audio_hash):
+        if track_path := LibraryIndex.get(track_id):
+            return track_path
+    return None
+
+
+def clone_file(source_path, track_path):
+    """
+    Copies source_path to track_path, sharing its data blocks if the
+    filesystem supports reflinks. Returns whether it did
+    """
+    FICLONE = 0x40049409
+    with open(source_path, "rb") as src, open(track_path, "wb") as dst:
+        if fcntl:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return True
+            except OSError:
+                pass
+        shutil.copyfileobj(src, dst)
+    return False
+
+
+def supports_reflinks(directory):
+    with tempfile.TemporaryDirectory(dir=directory) as temp_dir:
+        source_path = os.path.join(temp_dir, "source")
+        with open(source_path, "wb") as fh:
+            fh.write(bytes(4096))
+        return clone_file(source_path, os.path.join(temp_dir, "clone"))
+
+
+def unshare_file(track_path):
+    """
+    Gives track_path a file of its own if it is hardlinked to another
+    track's, so tags written to it aren't written to both
+    """
+    if os.stat(track_path).st_nlink > 1:
+        clone_file(track_path, track_path + ".link")
+        commit_file(track_path + ".link", track_path)
+
+
+def load_track_isrcs():
+    """
+    Stores the ISRCs of tracks added through albums or artists, as only full
+    track records have them
+    """
+    for track_ids in batched(MusicDatabase.get_track_ids_without_isrc(), IMPORT_BATCH_SIZE):
+        tracks = MetadataLoader.load("tracks", track_ids)
+        MetadataLoader.clear()
+        with MusicDatabase.LOCK:
+            MusicDatabase.set_track_isrcs({x.id: x.isrc for x in tracks if x.isrc})
+
+
+def link_track_file(source_path, track, track_path, shared_only=False):
+    """
+    Puts a copy of source_path tagged for track at track_path. The copy is a
+    reflink when the filesystem supports it, or a hardlink when the tags come
+    out identical, as a hardlink can't have tags of its own. Returns how it
+    was linked, or None if shared_only and the copy couldn't share any data
+    """
+    temp_path = track_path + ".link"
+    try:
+        link = "reflink" if clone_file(source_path, temp_path) else "copy"
+        set_track_tags(track, temp_path)
+        if link == "copy" and filecmp.cmp(source_path, temp_path, shallow=False):
+            try:
+                os.remove(temp_path)
+                os.link(source_path, temp_path)
+                link = "hardlink"
+            except OSError:
+                shutil.copyfile(source_path, temp_path)
+        if shared_only and link == "copy":
+            os.remove(temp_path)
+            return None
+        commit_file(temp_path, track_path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return link
+
+
+def dedup_tracks(dry_run=False):
+    """
+    Replaces downloaded tracks with the same ISRC or stream as another with
+    links to its file, returning the bytes saved
+    """
+    load_track_isrcs()
+    # A hardlink can't have tags of its own, so without reflinks only
+    # duplicates tagged identically can share a file
+    reflinks = supports_reflinks(MyMelody.get_track_path())
+    if not reflinks:
+        print("Reflinks aren't supported, only duplicates with identical tags can be linked")
+    files = [(x, track_path) for x in MusicDatabase.get_all_tracks() if not x.hidden and (track_path := LibraryIndex.get(x.id))]
+
+    # Group tracks sharing either an ISRC or stream hash
+    parents = {}
+    def find(key):
+        while parents.setdefault(key, key) != key:
+            key = parents[key]
+        return key
+    for track, _ in files:
+        for key in (track.isrc and f"isrc:{track.isrc}", track.audio_hash and f"hash:{track.audio_hash}"):
+            if key:
+                parents[find(key)] = find(track.id)
+    groups = {}
+    for track, track_path in files:
+        groups.setdefault(find(track.id), []).append((track, track_path))
+    duplicates = [x for x in groups.values() if len(x) > 1]
+
+    saved = 0
+    unshareable = 0
+    print("Would link tracks:" if dry_run else "Linking tracks:")
+    for group in duplicates:
+        (source, source_path), *others = sorted(group, key=lambda x: (not x[0].explicit, x[1]))
+        source_inode = os.stat(source_path).st_ino
+        for track, track_path in others:
+            track_stat = os.stat(track_path)
+            if track_stat.st_ino == source_inode:
+                continue
+            if not reflinks and (get_track_tags(track), track.album.artwork_url) != (get_track_tags(source), source.album.artwork_url):
+                unshareable += 1
+                continue
+            if dry_run:
+                link = "link"
+            elif link := link_track_file(source_path, track, track_path, shared_only=True):
+                LibraryIndex.add(track.id, track_path)
             else:
-                fail_count = 0  # reset fail_count on successful data read
+                unshareable += 1
+                continue
+            saved += track_stat.st_size
+            print(f"  {link} {track_path}")
+            print(f"    -> {source_path}")
+    if unshareable:
+        print(f"Skipped {unshareable} duplicates tagged differently from the file they would share")
+    print(f"{'Would save up to' if dry_run else 'Saved'} {format_size(saved)}")
+    return saved
+
+
+def iter_playlist_lines(playlist_id, export_path):
+    """
+    Yields the path of the playlist's extended M3U file, then its lines
+    """
+    for i, entry in enumerate(MusicDatabase.iter_playlist_entries(playlist_id)):
+        if i == 0:
+            yield f"{export_path}/{sanitize_name(entry['playlist_name'])} [{playlist_id}].m3u8"
+            yield "#EXTM3U\n"
+            yield f"#PLAYLIST:{entry['playlist_name']}\n"
+        if entry["hidden"]:
+            continue
+        if entry["path"]:
+            track_path = os.path.join(MyMelody.get_track_path(), entry["path"])
+        elif not (track_path := LibraryIndex.get(entry["id"])):
+            continue
+        # -1 is the extended M3U duration for unknown
+        duration = entry["duration_ms"] // 1000 if entry["duration_ms"] is not None else -1
+        yield f"#EXTINF:{duration},{entry['artists']} - {entry['name']}\n{os.path.relpath(track_path, export_path)}\n"
+
+
+def export_playlist(playlist_id, export_path, export_hashes):
+    """
+    Writes the playlist as an extended M3U file with paths relative to it,
+    unless its content hash is unchanged since the last export. Returns the
+    file written, or None if skipped
+    """
+    lines = iter_playlist_lines(playlist_id, export_path)
+    playlist_file = next(lines, None)
+    if not playlist_file:
+        return None
+    playlist_hash = hashlib.sha1(playlist_file.encode())
+    for line in lines:
+        playlist_hash.update(line.encode())
+
+    previous_hash, previous_file = export_hashes.get(playlist_id, (None, None))
+    if previous_hash == playlist_hash.hexdigest() and os.path.exists(playlist_file):
+        return None
+    # Only changed playlists are read again to be written
+    with tempfile.NamedTemporaryFile(mode="w", encoding="utf-8", dir=export_path, suffix=".m3u8", delete=False) as fh:
+        fh.writelines(itertools.islice(iter_playlist_lines(playlist_id, export_path), 1, None))
+    os.replace(fh.name, playlist_file)
+    if previous_file and previous_file != playlist_file and os.path.exists(previous_file):
+        os.remove(previous_file)
+    export_hashes[playlist_id] = (playlist_hash.hexdigest(), playlist_file)
+    return playlist_file
+
+
+def export_playlists(playlist_ids, export_path):
+    pathlib.Path(export_path).mkdir(parents=True, exist_ok=True)
+    hashes_path = f"{export_path}/.export_hashes.json"
+    export_hashes = {}
+    if os.path.exists(hashes_path):
+        with open(hashes_path, "r") as fh:
+            export_hashes = json.load(fh)
+
+    exported = 0
+    for playlist_id in playlist_ids:
+        if playlist_file := export_playlist(playlist_id, export_path, export_hashes):
+            print(f"  {playlist_file}")
+            exported += 1
+
+    with open(hashes_path + ".tmp", "w") as fh:
+        json.dump(export_hashes, fh)
+    os.replace(hashes_path + ".tmp", hashes_path)
+    print(f"Exported {exported} playlists, {len(playlist_ids) - exported} unchanged")
+
+
+def relocate_tracks(tracks, dry_run=False):
+    """
+    Moves the files of tracks whose path has changed since they were
+    downloaded, rewriting only the tags that changed, instead of downloading
+    them again
+    """
+    moves = []
+    for track in tracks:
+        if track.hidden:
+            continue
+        new_path = get_track_path(track)
+        # The stored path is where the file was last put, so only tracks
+        # whose path changed or that were downloaded before paths were stored
+        # are looked up in the library index
+        if track.path and os.path.join(MyMelody.get_track_path(), track.path) == new_path:
+            continue
+        old_path = LibraryIndex.get(track.id)
+        if not old_path:
+            continue
+        if old_path == new_path:
+            if not dry_run:
+                MusicDatabase.set_track_path(track.id, new_path)
+            continue
+        if os.path.exists(new_path):
+            print(f"  Not moving {old_path}, {new_path} already exists")
+            continue
+        moves.append((track, old_path, new_path))
+
+    if not moves:
+        return []
+    print("Would move tracks:" if dry_run else "Moving tracks:")
+    for track, old_path, new_path in moves:
+        print(f"  {old_path}")
+        print(f"    -> {new_path}")
+        if dry_run:
+            continue
+        pathlib.Path(os.path.dirname(new_path)).mkdir(parents=True, exist_ok=True)
+        os.rename(old_path, new_path)
+        changed_tags = update_track_tags(track, new_path)
+        if changed_tags:
+            print(f"    Retagged {', '.join(changed_tags)}")
+        LibraryIndex.remove(track.id)
+        LibraryIndex.add(track.id, new_path)
+        MusicDatabase.set_track_path(track.id, new_path)
+    print()
+
+    deleted = prune_directories([x[1] for x in moves], dry_run=dry_run, added_paths=[x[2] for x in moves])
+    if deleted:
+        print("Would delete directories:" if dry_run else "Deleting directories:")
+        for directory in deleted:
+            print("  " + directory)
+        print()
+    return moves
+
+
+# Pause after every this many downloads, for this many seconds, the longest
+# pause that applies winning
+ANTIBAN_SCHEDULE = [
+    (100, 60),
+    (50, 30),
+    (25, 10),
+    (5, 5),
+]
+
+
+def get_antiban_seconds(downloaded):
+    if downloaded == 0:
+        return 0
+    for every, seconds in ANTIBAN_SCHEDULE:
+        if downloaded % every == 0:
+            return seconds
+    return 0
+
+
+def download_tracks_safely(tracks, on_progress=None):
+    """
+    Downloads tracks with one worker per session in the SessionPool, each
+    pausing on its own schedule to avoid bans, while the streams of the next
+    tracks are prefetched. on_progress is called with the number of tracks
+    handled so far before each one
+    """
+    # Duplicates are only found by ISRC once the tracks have them
+    if MyMelody.CONFIG.get("dedup", False):
+        load_track_isrcs()
+    pending = iter(enumerate(tracks))
+    pending_lock = threading.Lock()
+    album_ids = set()
+    prefetcher = StreamPrefetcher(tracks, **MyMelody.CONFIG.get("prefetch", {}))
+
+    def download_worker(session):
+        downloaded = 0
+        while True:
+            with pending_lock:
+                i, track = next(pending, (None, None))
+            if track is None:
+                return
+            if on_progress:
+                on_progress(i, len(tracks))
+            if seconds := get_antiban_seconds(downloaded):
+                antiban_wait(seconds=seconds)
+            # Pick up tracks hidden since the queue was built
+            with MusicDatabase.LOCK:
+                track = MusicDatabase.get_track(track.id) or track
+            download_resp = download_track(track, session, prefetcher.take(i, track))
+            if download_resp:
+                downloaded += 1
+                with pending_lock:
+                    album_ids.add(track.album.id)
+
+    try:
+        if len(SessionPool.SESSIONS) <= 1:
+            download_worker(None)
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(SessionPool.SESSIONS)) as executor:
+                for future in [executor.submit(download_worker, x) for x in SessionPool.SESSIONS]:
+                    future.result()
+    finally:
+        prefetcher.close()
+        # An album's gain needs all its tracks, so it's tagged once per batch
+        for album_id in sorted(album_ids):
+            finalize_album_loudness(album_id)
+    if on_progress:
+        on_progress(len(tracks), len(tracks))
+
+
+def get_parent_directories(paths):
+    # Every directory under the track path holding one of paths
+    root = MyMelody.get_track_path()
+    directories = set()
+    for path in paths:
+        directory = os.path.dirname(path)
+        while directory != root and directory.startswith(root):
+            directories.add(directory)
+            directory = os.path.dirname(directory)
+    return directories
+
+
+def prune_directories(removed_paths, dry_run=False, added_paths=()):
+    """
+    Deletes the directories that held removed_paths, and their parents, if
+    they are left empty. Directories that will hold added_paths are kept,
+    so a dry run matches what would happen. Returns the deleted directories
+    """
+    # Deepest first, so parents see their emptied subdirectories as removed
+    directories = get_parent_directories(removed_paths) - get_parent_directories(added_paths)
+
+    removed = set(removed_paths)
+    deleted = []
+    for directory in sorted(directories, key=lambda x: x.count(os.sep), reverse=True):
+        if not os.path.isdir(directory):
+            continue
+        if all(os.path.join(directory, x) in removed for x in os.listdir(directory)):
+            removed.add(directory)
+            deleted.append(directory)
+            if not dry_run:
+                os.rmdir(directory)
+                LibraryIndex.invalidate(os.path.dirname(directory))
+    return deleted
+
+
+def cleanup_tracks(dry_run=False):
+    """
+    Deletes the files of hidden tracks, then prunes only the directories
+    those files were in if they are left empty
+    """
+    track_files = [(x, track_path, os.path.getsize(track_path)) for x in MusicDatabase.get_hidden_track_ids() if (track_path := LibraryIndex.get(x))]
+    if track_files:
+        print("Would delete tracks:" if dry_run else "Deleting tracks:")
+        for track_id, track_path, _ in sorted(track_files, key=lambda x: x[1]):
+            if not dry_run:
+                os.remove(track_path)
+                LibraryIndex.remove(track_id)
+            print("  " + track_path)
+        print()
+
+    deleted = prune_directories([x[1] for x in track_files], dry_run=dry_run)
+    if deleted:
+        print("Would delete directories:" if dry_run else "Deleting directories:")
+        for directory in deleted:
+            print("  " + directory)
+        print()
+
+    reclaimed = sum(x[2] for x in track_files)
+    print(f"{'Would reclaim' if dry_run else 'Reclaimed'} {format_size(reclaimed)} from {len(track_files)} tracks and {len(deleted)} directories")
+
+
+################################################################################
+# Plan                                                                         #
+################################################################################
+
+# Assumed until downloads have been measured, in seconds of audio encoded per
+# second and stream bytes per second
+PLAN_ENCODE_SPEED = 30
+PLAN_STREAM_RATE = 1024 * 1024
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds < 3600:
+        return f"{seconds // 60}m {seconds % 60:02d}s"
+    return f"{seconds // 3600}h {seconds // 60 % 60:02d}m"
+
+
+def get_download_estimates():
+    """
+    Returns, for each quality, the stream bytes per millisecond of audio and
+    the seconds spent streaming a byte and encoding a millisecond, measured
+    from past downloads where there are any
+    """
+    source_rates = MusicDatabase.get_source_rates()
+    throughput = MusicDatabase.get_download_throughput()
+    history = {k: sum(x[k] or 0 for x in throughput.values()) for k in ("duration_ms", "source_size", "stream_seconds", "encode_seconds")}
+    estimates = {}
+    for quality, bitrate in QUALITIES.items():
+        measured = throughput.get(quality) or history
+        estimates[quality] = {
+            "bytes_per_ms": source_rates.get(quality, bitrate / 8),
+            "stream_seconds_per_byte": measured["stream_seconds"] / measured["source_size"] if measured["source_size"] else 1 / PLAN_STREAM_RATE,
+            "encode_seconds_per_ms": measured["encode_seconds"] / measured["duration_ms"] if measured["duration_ms"] else 1 / PLAN_ENCODE_SPEED / 1000,
+            "measured": bool(measured["duration_ms"]),
+        }
+    return estimates
+
+
+def plan_downloads(tracks):
+    """
+    Estimates the stream bytes and the streaming and encoding seconds of each
+    track, and the antiban and rate limit waits of the workers downloading
+    them, from the database alone
+    """
+    estimates = get_download_estimates()
+    track_plans = []
+    for track in tracks:
+        estimate = estimates[get_track_quality(track)]
+        duration_ms = track.duration_ms or 0
+        size = duration_ms * estimate["bytes_per_ms"]
+        track_plans.append({
+            "track": track,
+            "bytes": size,
+            "stream_seconds": size * estimate["stream_seconds_per_byte"],
+            "encode_seconds": duration_ms * estimate["encode_seconds_per_ms"],
+        })
+
+    # Workers take tracks in turn, each pausing on its own schedule and
+    # loading no faster than its session's rate
+    workers = max(1, len(SessionPool.SESSIONS))
+    worker_seconds = []
+    wait_seconds = 0
+    for worker in range(workers):
+        worker_plans = track_plans[worker::workers]
+        antiban_seconds = sum(get_antiban_seconds(x) for x in range(1, len(worker_plans)))
+        wait_seconds += antiban_seconds
+        worker_seconds.append(antiban_seconds + sum(
+            max(x["stream_seconds"] + x["encode_seconds"], 1 / SessionPool.RATE if SessionPool.RATE else 0) for x in worker_plans
+        ))
+    return {
+        "tracks": track_plans,
+        "workers": workers,
+        "wait_seconds": wait_seconds,
+        "seconds": max(worker_seconds, default=0),
+        "measured": all(x["measured"] for x in estimates.values()),
+    }
+
+
+def get_plan_breakdown(track_plans, key):
+    """
+    Totals track_plans by the name key returns for each track, key returning
+    a list of names for tracks in several groups, largest first
+    """
+    totals = {}
+    for track_plan in track_plans:
+        for name in key(track_plan["track"]):
+            total = totals.setdefault(name, {"tracks": 0, "duration_ms": 0, "bytes": 0, "encode_seconds": 0})
+            total["tracks"] += 1
+            total["duration_ms"] += track_plan["track"].duration_ms or 0
+            total["bytes"] += track_plan["bytes"]
+            total["encode_seconds"] += track_plan["encode_seconds"]
+    return sorted(totals.items(), key=lambda x: x[1]["bytes"], reverse=True)
+
+
+def print_plan(plan, top=10):
+    from tabulate import tabulate
+    track_plans = plan["tracks"]
+    print(f"{len(track_plans)} tracks to download:")
+    print(f"  Audio: {format_duration(sum(x['track'].duration_ms or 0 for x in track_plans) / 1000)}")
+    print(f"  Stream: {format_size(sum(x['bytes'] for x in track_plans))} in {format_duration(sum(x['stream_seconds'] for x in track_plans))}")
+    print(f"  Encode: {format_duration(sum(x['encode_seconds'] for x in track_plans))} of CPU time")
+    print(f"  Antiban waits: {format_duration(plan['wait_seconds'])} across {plan['workers']} worker(s)")
+    print(f"  Estimated time: {format_duration(plan['seconds'])}")
+    if not plan["measured"]:
+        print(f"  Some qualities have no download history, assuming {PLAN_ENCODE_SPEED}x realtime encoding and {format_size(PLAN_STREAM_RATE)}/s streams")
+
+    track_playlists = {}
+    for row in MusicDatabase.CURSOR.execute("SELECT DISTINCT track_id, name FROM playlists").fetchall():
+        track_playlists.setdefault(row["track_id"], []).append(row["name"])
+    breakdowns = {
+        "artist": lambda x: [x.album.artists[0].name],
+        "album": lambda x: [f"{x.album.name} - {x.album.artists[0].name}"],
+        "playlist": lambda x: track_playlists.get(x.id, []),
+    }
+    for name, key in breakdowns.items():
+        breakdown = get_plan_breakdown(track_plans, key)
+        if not breakdown:
+            continue
+        print()
+        print(f"By {name}" + (f", largest {top} of {len(breakdown)}:" if len(breakdown) > top else ":"))
+        rows = [[k, v["tracks"], format_duration(v["duration_ms"] / 1000), format_size(v["bytes"]), format_duration(v["encode_seconds"])] for k, v in breakdown[:top]]
+        print(tabulate(rows, headers=[name, "tracks", "audio", "stream", "encode"]))
+
+
+################################################################################
+# Verify                                                                       #
+################################################################################
+
+MP3_BITRATES = {
+    3: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MP3_SAMPLE_RATES = {
+    3: [44100, 48000, 32000],
+    2: [22050, 24000, 16000],
+    0: [11025, 12000, 8000],
+}
+
+def check_mp3_frames(data):
+    """
+    Walks every MPEG layer III frame header between the tags, returning a
+    problem if a frame is corrupt or the last one is cut short
+    """
+    start = 0
+    end = len(data)
+    if data[:3] == b"ID3":
+        start = 10 + ((data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9])
+        if data[5] & 0x10:
+            start += 10
+    if data[-128:-125] == b"TAG":
+        end -= 128
+
+    position = start
+    frames = 0
+    while position + 4 <= end:
+        header = data[position:position+4]
+        version = (header[1] >> 3) & 3
+        bitrate_index = header[2] >> 4
+        sample_rate_index = (header[2] >> 2) & 3
+        if header[0] != 0xFF or header[1] & 0xE0 != 0xE0 or version == 1 or (header[1] >> 1) & 3 != 1 or bitrate_index in (0, 15) or sample_rate_index == 3:
+            return f"corrupt frame {frames} at byte {position}"
+        bitrate = MP3_BITRATES[3 if version == 3 else 2][bitrate_index] * 1000
+        sample_rate = MP3_SAMPLE_RATES[version][sample_rate_index]
+        position += (144 if version == 3 else 72) * bitrate // sample_rate + ((header[2] >> 1) & 1)
+        frames += 1
+    if not frames:
+        return "no audio frames"
+    if position != end:
+        return f"truncated frame {frames} ({position - end} bytes missing)"
+    return None
+
+
+def verify_track_file(track_path, duration_ms, tags):
+    """
+    Checks the file's duration, frames and tags, returning a list of problems
+    """
+    from mutagen.easyid3 import EasyID3
+    from mutagen.id3 import ID3
+    from mutagen.mp3 import MP3
+    try:
+        track_file = MP3(track_path, ID3=EasyID3)
+        track_apic = ID3(track_path).getall("APIC")
+        with open(track_path, "rb") as fh:
+            frame_problem = check_mp3_frames(fh.read())
+    except Exception as e:
+        return [f"unreadable: {e}"]
+
+    problems = []
+    if duration_ms and abs(track_file.info.length * 1000 - duration_ms) > 2000:
+        problems.append(f"duration {track_file.info.length:.1f}s, expected {duration_ms / 1000:.1f}s")
+    if frame_problem:
+        problems.append(frame_problem)
+    for k,v in tags.items():
+        if (track_file.tags or {}).get(k) != [v]:
+            problems.append(f"{k} tag is {(track_file.tags or {}).get(k)}, expected {v}")
+    if not track_apic:
+        problems.append("missing artwork")
+    return problems
+
+
+def verify_tracks(tracks, workers=None):
+    """
+    Verifies the files of the tracks across processes, returning a dict of
+    broken tracks to their problems. Results are cached by the file's path,
+    its current size and mtime, and what it is expected to contain
+    """
+    from tqdm import tqdm
+    cache_path = MyMelody.CONFIG.get("verify_cache_path", "verify_cache.json")
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, "r") as fh:
+            cache = json.load(fh)
+
+    results = {}
+    to_verify = []
+    for track in tracks:
+        track_path = LibraryIndex.get(track.id)
+        # Retagging rewrites files in place, which the index doesn't notice
+        try:
+            track_stat = os.stat(track_path)
+        except FileNotFoundError:
+            results[track.id] = ["missing"]
+            continue
+        size, mtime = track_stat.st_size, track_stat.st_mtime_ns
+        tags = get_track_tags(track)
+        expected = hashlib.sha1(json.dumps([track.duration_ms, tags], sort_keys=True).encode()).hexdigest()
+        cached = cache.get(track_path)
+        if cached and cached[:3] == [size, mtime, expected]:
+            results[track.id] = cached[3]
+            continue
+        to_verify.append((track, track_path, size, mtime, tags, expected))
+
+    if to_verify:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            problems = executor.map(
+                verify_track_file,
+                [x[1] for x in to_verify],
+                [x[0].duration_ms for x in to_verify],
+                [x[4] for x in to_verify],
+                chunksize=16,
+            )
+            for (track, track_path, size, mtime, tags, expected), track_problems in tqdm(zip(to_verify, problems), total=len(to_verify), desc="  Verifying"):
+                results[track.id] = track_problems
+                cache[track_path] = [size, mtime, expected, track_problems]
+
+    with open(cache_path + ".tmp", "w") as fh:
+        json.dump(cache, fh)
+    os.replace(cache_path + ".tmp", cache_path)
+    print(f"Verified {len(to_verify)} tracks, {len(results) - len(to_verify)} unchanged since last run")
+    return {k:v for k,v in results.items() if v}
+
 
-            fh.write(data)
-            downloaded += len(data)
-            progress.update(len(data))
-        progress.close()
-        pydub.AudioSegment.from_ogg(fh.name).export(track_path, format="mp3", bitrate="160k")
+################################################################################
+# Metadata loader                                                              #
+################################################################################
 
-    set_track_tags(track)
-    return True
+class MetadataLoader:
+    BATCH_SIZES = {"tracks": 50, "albums": 20, "artists": 50}
+    RECORDS = {"tracks": Track, "albums": Album, "artists": Artist}
+    CACHE = {"tracks": {}, "albums": {}, "artists": {}}
+    PENDING = {"tracks": {}, "albums": {}, "artists": {}}
+    STATS = {x: {"requested": 0, "fetched": 0, "calls": 0, "naive_calls": 0} for x in ("tracks", "albums", "artists")}
 
+    @classmethod
+    def queue(cls, content_type, content_ids):
+        for content_id in content_ids:
+            if content_id not in cls.CACHE[content_type]:
+                cls.PENDING[content_type][content_id] = None
 
-def download_tracks_safely(tracks):
-    downloaded = 0
-    for i in range(len(tracks)):
-        if downloaded != 0:
-            if downloaded % 100 == 0:
-                antiban_wait(seconds=60)
-            elif downloaded % 50 == 0:
-                antiban_wait(seconds=30)
-            elif downloaded % 25 == 0:
-                antiban_wait(seconds=10)
-            elif downloaded % 5 == 0:
-                antiban_wait(seconds=5)
-        download_resp = download_track(tracks[i])
-        if download_resp:
-            downloaded += 1
-
-
-def cleanup_tracks():
-    tracks = [x for x in MusicDatabase.get_all_tracks() if x["ignore"]]
-    if tracks:
-        print("Deleting tracks:")
-        for track in tracks:
-            track_path = get_track_path(track)
-            if os.path.exists(track_path):
-                os.remove(track_path)
-                print("  " + track_path)
-        print()
+    @classmethod
+    def flush(cls, content_type):
+        pending = list(cls.PENDING[content_type])
+        cls.PENDING[content_type].clear()
+        chunk_size = cls.BATCH_SIZES[content_type]
+        for chunk in [pending[i:i+chunk_size] for i in range(0, len(pending), chunk_size)]:
+            resp = getattr(MyMelody.get_client(), content_type)(chunk)[content_type]
+            cls.STATS[content_type]["calls"] += 1
+            cls.STATS[content_type]["fetched"] += len(chunk)
+            for content_id, content in zip(chunk, resp):
+                cls.CACHE[content_type][content_id] = cls.RECORDS[content_type].from_api(content) if content else None
 
-    deleted = set()
-    for current_dir, subdirs, files in os.walk(MyMelody.get_track_path(), topdown=False):
-        still_has_subdirs = False
-        for subdir in subdirs:
-            if os.path.join(current_dir, subdir) not in deleted:
-                still_has_subdirs = True
-                break
-    
-        if not any(files) and not still_has_subdirs:
-            deleted.add(current_dir)
+    @classmethod
+    def load(cls, content_type, content_ids):
+        """
+        Returns the metadata of the given ids, fetching every queued id that
+        hasn't been loaded yet in as few batch calls as possible
+        """
+        content_ids = list(content_ids)
+        stats = cls.STATS[content_type]
+        stats["requested"] += len(content_ids)
+        stats["naive_calls"] += math.ceil(len(content_ids) / cls.BATCH_SIZES[content_type])
+        cls.queue(content_type, content_ids)
+        cls.flush(content_type)
+        content = [cls.CACHE[content_type].get(x) for x in content_ids]
+        return [x for x in content if x]
 
-    if deleted:
-        print("Deleting directories:")
-        for directory in deleted:
-            os.rmdir(directory)
-            print("  " + directory)
+    @classmethod
+    def clear(cls):
+        for content_type in cls.CACHE:
+            cls.CACHE[content_type].clear()
+
+    @classmethod
+    def print_stats(cls):
+        stats = [[k, v["requested"], v["fetched"], v["calls"], v["naive_calls"] - v["calls"]] for k,v in cls.STATS.items() if v["requested"]]
+        if not stats:
+            return
+        from tabulate import tabulate
         print()
+        print("Metadata requests:")
+        print(tabulate(stats, headers=["type", "requested", "fetched", "calls", "calls saved"]))
 
 
 ################################################################################
@@ -554,30 +3321,21 @@ def cleanup_tracks():
 
 def process_tracks(track_ids):
     tracks = []
-    chunk_size = 50
-    chunks = [track_ids[i:i+chunk_size] for i in range(0,len(track_ids),chunk_size)]
-
-    for chunk in chunks:
-        raw_tracks = MyMelody.CLIENT.tracks(chunk)
-        for raw_track in raw_tracks["tracks"]:
-            tracks.append(MusicDatabase.add_track(raw_track))
-            print("  " + get_track_description(raw_track))
+    for track in MetadataLoader.load("tracks", track_ids):
+        tracks.append(MusicDatabase.add_track(track))
+        print("  " + get_track_description(track))
+    DownloadQueue.add(tracks, "track")
     return tracks
 
 
 def process_albums(album_ids):
     tracks = []
-    chunk_size = 20
-    chunks = [album_ids[i:i+chunk_size] for i in range(0,len(album_ids),chunk_size)]
-    for chunk in chunks:        
-        albums = MyMelody.CLIENT.albums(chunk)
-        for album in albums["albums"]:
-            print("  " + album["name"] + " - " + "; ".join([x["name"] for x in album["artists"]]))
-            album_sans_tracks = {k:v for k,v in album.items() if k not in ("tracks")}
-            for track in album["tracks"]["items"]:
-                track["album"] = album_sans_tracks
-                tracks += MusicDatabase.add_track(track)
-                print("    " + get_track_description(track))
+    for album in MetadataLoader.load("albums", album_ids):
+        print("  " + album.name + " - " + "; ".join([x.name for x in album.artists]))
+        for track in album.tracks:
+            tracks.append(MusicDatabase.add_track(track))
+            print("    " + get_track_description(track))
+    DownloadQueue.add(tracks, "track")
     return tracks
 
 
@@ -585,182 +3343,310 @@ def track_prompt(track, skip=False):
     if skip:
         action = "skip"
     else:
-        action = "hide" if track.get("hidden", False) else "add"
+        action = "hide" if track.hidden else "add"
     values = {
         "action": action,
-        "id": track["id"],
-        "name": track["name"],
-        "artists": "; ".join([x["name"] for x in track["artists"]]),
-        "track_number": str(track["track_number"]),
-        "album": track["album"]["name"],
-        "album_artists": "; ".join([x["name"] for x in track["album"]["artists"]]),
-        "release_date": track["album"]["release_date"]
+        "id": track.id,
+        "name": track.name,
+        "artists": "; ".join([x.name for x in track.artists]),
+        "track_number": str(track.track_number),
+        "album": track.album.name,
+        "album_artists": "; ".join([x.name for x in track.album.artists]),
+        "release_date": track.album.release_date
     }
     return values.values()
 
 
-def process_artists(artist_ids):
-    SORT_ORDER = {
-        "album": 0,
-        "single": 1,
-        "compilation": 2,
+ALBUM_TYPE_ORDER = {
+    "album": 0,
+    "single": 1,
+    "compilation": 2,
+}
+
+
+def get_track_actions(artist_tracks, other_tracks, existing_tracks):
+    """
+    Decides which new tracks by an artist to add, hide or skip, and which
+    existing singles to hide now that an album has them
+    """
+    track_actions = {
+        "existing": [],
+        "add": [],
+        "skip": [],
     }
-    tracks = []
-    for artist_id in artist_ids:
-        artist_data = MusicDatabase.add_artist(MyMelody.CLIENT.artist(artist_id), follow=True, replace=True)
-        print("  " + artist_data["name"])
+    # Tracks are hidden on copies, as MetadataLoader shares its records
+    # between every artist in a run
+    hidden_ids = set()
+    for track in sorted(artist_tracks, key=lambda x: (ALBUM_TYPE_ORDER[x.album.album_type], x.album.release_date)):
+        if track.album.album_type in ("album", "compliation"):
+            # Hide previous singles to make way for album
+            for single_track in [x for x in existing_tracks if track.name == x.name and x.album.album_type == "single" and not x.hidden and x.id not in hidden_ids]:
+                hidden_ids.add(single_track.id)
+                track_actions["existing"].append(dataclasses.replace(single_track, hidden=True))
+        # Add single as hidden if already in existing album
+        elif track.album.album_type == "single" and track.name in [x.name for x in existing_tracks+track_actions["add"] if x.album.album_type in ("album", "compliation")]:
+            track = dataclasses.replace(track, hidden=True)
+        # Add single as hidden if already exists earlier
+        elif track.album.album_type == "single" and track.name in [x.name for x in existing_tracks+track_actions["add"] if x.album.album_type in ("single")]:
+            track = dataclasses.replace(track, hidden=True)
+        track_actions["add"].append(track)
 
-        existing_tracks = [x for x in MusicDatabase.get_all_tracks() if artist_data in x["artists"]]
-        existing_tracks_ids = [x["id"] for x in existing_tracks]
+    for track in sorted(other_tracks, key=lambda x: (ALBUM_TYPE_ORDER[x.album.album_type], x.album.release_date)):
+        if track.name in [x.name for x in existing_tracks+track_actions["add"]]:
+            track_actions["skip"].append(track)
+            continue
+        track_actions["add"].append(track)
+
+    for taction, tdata in track_actions.items():
+        tdata.sort(key=lambda x: (x.album.release_date, x.album.name, x.track_number))
+    return track_actions
+
+
+def prompt_track_actions(artist_track_actions):
+    """
+    Lets the user confirm the tracks to add for every artist at once in
+    EDITOR, returning the action chosen for each track id kept
+    """
+    from tabulate import tabulate
+    chosen_actions = {}
+    with tempfile.NamedTemporaryFile(mode="w+") as fh:
+        fh.write("# Tracks to download by each artist\n")
+        fh.write("# List of actions:\n")
+        fh.write("#   add - adds track metadata and downloads\n")
+        fh.write("#   hide - adds track metadata but doesn't download\n")
+        fh.write("#   skip - ignores track and doesn't add metadata\n")
+        fh.write("\n")
+        for artist, track_actions in artist_track_actions:
+            if not any(track_actions.values()):
+                continue
+            fh.write(f"# {artist.name}\n")
+            for track_action, track_data in track_actions.items():
+                if not track_data:
+                    continue
+                if track_action == "existing":
+                    fh.write("Modify existing tracks:\n")
+                elif track_action == "add":
+                    fh.write("Add tracks:\n")
+                elif track_action == "skip":
+                    fh.write("Skip tracks:\n")
+                fh.write(tabulate([track_prompt(x, skip=track_action=="skip") for x in track_data], tablefmt="plain"))
+                fh.write("\n\n")
+        fh.flush()
+        subprocess.run([os.getenv("EDITOR"), fh.name])
+        fh.seek(0)
+        for line in fh.readlines():
+            regex = re.search("^(.*?) +(.*?) +.*", line)
+            if regex and regex.group(1) in ("add", "hide"):
+                chosen_actions[regex.group(2)] = regex.group(1)
+    return chosen_actions
 
-        artist_albums = []
-        artist_tracks = []
-        other_tracks = []
 
+def process_artists(artist_ids, prompt=True):
+    """
+    Adds artists and the tracks on their albums. With prompt, the tracks to
+    add for all the artists are confirmed in EDITOR, otherwise the suggested
+    actions are taken. Artists are only followed once their tracks are added
+    """
+    from tqdm import tqdm
+    tracks = []
+    artists = MetadataLoader.load("artists", artist_ids)
 
-        # Get all albums containing track by artist
+    # Get all albums containing track by artist, for every artist up front so
+    # that albums shared between artists are only fetched once
+    artist_albums = {}
+    for artist in artists:
+        artist_albums[artist.id] = []
         artist_albums_limit = 50
         artist_albums_offset = 0
-        artist_albums_total = MyMelody.CLIENT.artist_albums(artist_id, limit=1)["total"]
-        artist_albums_progress = tqdm(total=artist_albums_total, desc="  Albums")
+        artist_albums_total = MyMelody.get_client().artist_albums(artist.id, limit=1)["total"]
+        artist_albums_progress = tqdm(total=artist_albums_total, desc="  "+artist.name+" albums")
         while True:
-            artist_albums_resp = MyMelody.CLIENT.artist_albums(artist_id, limit=artist_albums_limit, offset=artist_albums_offset)["items"]
+            artist_albums_resp = MyMelody.get_client().artist_albums(artist.id, limit=artist_albums_limit, offset=artist_albums_offset)["items"]
             artist_albums_progress.update(len(artist_albums_resp))
-            artist_albums += artist_albums_resp
+            artist_albums[artist.id] += [x["id"] for x in artist_albums_resp]
             if len(artist_albums_resp) < artist_albums_limit:
                 break
             artist_albums_offset += artist_albums_limit
         artist_albums_progress.close()
+        MetadataLoader.queue("albums", artist_albums[artist.id])
+    MemoryTracer.snapshot("album paging")
+
+    artist_track_actions = []
+    for artist in artists:
+        artist_id = artist.id
+        print("  " + artist.name)
+
+        existing_tracks = [x for x in MusicDatabase.get_all_tracks() if artist_id in [y.id for y in x.artists]]
+        existing_tracks_ids = [x.id for x in existing_tracks]
+
+        artist_tracks = []
+        other_tracks = []
 
 
         # Get all tracks, from those albums, by artist
-        album_chunk_size = 20
-        album_ids = [x["id"] for x in artist_albums]
-        album_chunks = [album_ids[i:i+album_chunk_size] for i in range(0,len(album_ids),album_chunk_size)]
+        album_ids = artist_albums[artist_id]
         album_progress = tqdm(total=len(album_ids))
-        for chunk in album_chunks:
-            albums = MyMelody.CLIENT.albums(chunk)
-            for album in albums["albums"]:
-                album_progress.set_description("  "+album["name"])
-                album_sans_tracks = {k:v for k,v in album.items() if k not in ("tracks")}
-                tracks_by_artist = [x for x in album["tracks"]["items"] if artist_id in [y["id"] for y in x["artists"]]]
-                for track in tracks_by_artist:
-                    if track["id"] in existing_tracks_ids:
-                        continue
-                    track["album"] = album_sans_tracks
-                    if artist_id in [x["id"] for x in track["album"]["artists"]]:
-                        artist_tracks.append(track)
-                    else:
-                        other_tracks.append(track)
-                    
-                album_progress.update(1)
+        for album in MetadataLoader.load("albums", album_ids):
+            album_progress.set_description("  "+album.name)
+            tracks_by_artist = [x for x in album.tracks if artist_id in [y.id for y in x.artists]]
+            for track in tracks_by_artist:
+                if track.id in existing_tracks_ids:
+                    continue
+                if artist_id in [x.id for x in album.artists]:
+                    artist_tracks.append(track)
+                else:
+                    other_tracks.append(track)
+                
+            album_progress.update(1)
         album_progress.close()
+        MemoryTracer.snapshot(f"album fetch for {artist.name}")
 
 
         # Sort tracks and decide what to download
-        track_actions = {
-            "existing": [],
-            "add": [],
-            "skip": [],
-        }
-        for track in sorted(artist_tracks, key=lambda x: (SORT_ORDER[x["album"]["album_type"]], x["album"]["release_date"])):
-            if track["album"]["album_type"] in ("album", "compliation"):
-                # Hide previous singles to make way for album
-                for single_track in [x for x in existing_tracks if track["name"] == x["name"] and x["album"]["album_type"] == "single" and not x["hidden"]]:
-                    single_track["hidden"] = True
-                    track_actions["existing"].append(single_track)
-            # Add single as hidden if already in existing album
-            elif track["album"]["album_type"] == "single" and track["name"] in [x["name"] for x in existing_tracks+track_actions["add"] if x["album"]["album_type"] in ("album", "compliation")]:
-                track["hidden"] = True
-            # Add single as hidden if already exists earlier
-            elif track["album"]["album_type"] == "single" and track["name"] in [x["name"] for x in existing_tracks+track_actions["add"] if x["album"]["album_type"] in ("single")]:
-                track["hidden"] = True
-            track_actions["add"].append(track)
-
-        for track in sorted(other_tracks, key=lambda x: (SORT_ORDER[x["album"]["album_type"]], x["album"]["release_date"])):
-            if track["name"] in [x["name"] for x in existing_tracks+track_actions["add"]]:
-                track_actions["skip"].append(track)
-                continue
-            track_actions["add"].append(track)
+        track_actions = get_track_actions(artist_tracks, other_tracks, existing_tracks)
+        artist_track_actions.append((artist, artist_tracks, existing_tracks_ids, track_actions))
+        MemoryTracer.snapshot(f"dedup for {artist.name}")
 
-        for taction, tdata in track_actions.items():
-            tdata.sort(key=lambda x: (x["album"]["release_date"], x["album"]["name"], x["track_number"]))
-
-
-        # Prompt user to confirm choice
-        tracks_to_add = []
-        with tempfile.NamedTemporaryFile(mode="w+") as fh:
-            fh.write(f"# Tracks to download by {artist_data['name']}\n")
-            fh.write("# List of actions:\n")
-            fh.write("#   add - adds track metadata and downloads\n")
-            fh.write("#   hide - adds track metadata but doesn't download\n")
-            fh.write("#   skip - ignores track and doesn't add metadata\n")
-            fh.write("\n")
-            for track_action, track_data in track_actions.items():
-                if not track_data:
-                    continue
-                if track_action == "existing":
-                    fh.write("Modify existing tracks:\n")
-                elif track_action == "add":
-                    fh.write("Add tracks:\n")
-                elif track_action == "skip":
-                    fh.write("Skip tracks:\n")
-                fh.write(tabulate([track_prompt(x, skip=track_action=="skip") for x in track_data], tablefmt="plain"))
-                fh.write("\n\n")
-                fh.flush()
-            subprocess.run([os.getenv("EDITOR"), fh.name])
-            fh.seek(0)
-            for line in fh.readlines():
-                regex = re.search("^(.*?) +(.*?) +.*", line)
-                if regex and regex.group(1) in ("add", "hide"):
 
-                    tracks_to_add += [x|{"hidden":regex.group(1)=="hide"} for x in track_actions["add"] if x["id"] == regex.group(2)]
+    # Prompt user to confirm choice, once for every artist
+    if prompt:
+        chosen_actions = prompt_track_actions([(x[0], x[-1]) for x in artist_track_actions])
 
 
-        # Add the track metadata to database
+    # Add the track metadata to database
+    for artist, artist_tracks, existing_tracks_ids, track_actions in artist_track_actions:
+        if prompt:
+            tracks_to_add = [dataclasses.replace(x, hidden=chosen_actions[x.id]=="hide") for x in track_actions["add"]+track_actions["existing"] if x.id in chosen_actions]
+        else:
+            tracks_to_add = track_actions["add"] + track_actions["existing"]
         print()
-        print("  Tracks:")
+        print("  " + artist.name + " tracks:")
         if not artist_tracks:
             print("    No new tracks")
-            continue
+            tracks_to_add = []
         for track in tracks_to_add:
-            tracks.append(MusicDatabase.add_track(track, replace=hidden))
-            if track["id"] not in existing_tracks_ids and track.get("hidden", False):
+            tracks.append(MusicDatabase.add_track(track, replace=track.id in existing_tracks_ids))
+            if track.id not in existing_tracks_ids and track.hidden:
                 continue
-            modifier_str = "-" if track["id"] in existing_tracks_ids else "+"
+            modifier_str = "-" if track.id in existing_tracks_ids else "+"
             print(f"    {modifier_str}{get_track_description(track, album=True, artists=True)}")
+        MusicDatabase.add_artist(dataclasses.replace(artist, follow=True), replace=True)
+        # Each phase is reported as the change since the snapshot before it
+        MemoryTracer.snapshot(f"db write for {artist.name}")
+    DownloadQueue.add(tracks, "artist")
     return tracks
 
 def process_playlists(playlist_ids):
+    from tqdm import tqdm
     tracks = []
     for playlist_id in playlist_ids:
-        playlist = MyMelody.CLIENT.playlist(playlist_id)
+        playlist = MyMelody.get_client().playlist(playlist_id, fields="id,name,images")
 
         playlist_tracks = []
 
         # Get all tracks in playlist
         playlist_tracks_limit = 50
         playlist_tracks_offset = 0
-        playlist_tracks_total = MyMelody.CLIENT.playlist_items(playlist_id, limit=1)["total"]
+        playlist_tracks_total = MyMelody.get_client().playlist_items(playlist_id, limit=1)["total"]
         playlist_tracks_progress = tqdm(total=playlist_tracks_total, desc="  Playlist tracks")
         while True:
-            playlist_tracks_resp = MyMelody.CLIENT.playlist_items(playlist_id, limit=playlist_tracks_limit, offset=playlist_tracks_offset)["items"]
+            playlist_tracks_resp = MyMelody.get_client().playlist_items(playlist_id, limit=playlist_tracks_limit, offset=playlist_tracks_offset)["items"]
             playlist_tracks_progress.update(len(playlist_tracks_resp))
-            playlist_tracks += playlist_tracks_resp
+            # Allows for tracks only added by playlist to be removed when removed from playlist
+            playlist_tracks += [Track.from_api(x["track"], explicit=False) for x in playlist_tracks_resp if x["track"] and x["track"]["id"]]
             if len(playlist_tracks_resp) < playlist_tracks_limit:
                 break
             playlist_tracks_offset += playlist_tracks_limit
         playlist_tracks_progress.close()
 
-        # for track in playlist_tracks:
-        #     # Allows for tracks only added by playlist to be removed when removed from playlist
-        #     track["explicit"] = False
-        
-        playlist["tracks"] = [x["track"] for x in playlist_tracks]
+        playlist = {
+            "id": playlist["id"],
+            "name": playlist["name"],
+            "artwork_url": get_artwork_url(playlist),
+            "tracks": playlist_tracks,
+        }
         tracks += MusicDatabase.add_playlist(playlist)["tracks"]
+    DownloadQueue.add(tracks, "playlist")
     return tracks
 
 
+# Ids read from a file are processed, and downloaded, this many at a time
+IMPORT_BATCH_SIZE = 500
+
+
+def get_imported_ids(content_type, content_ids, download=False):
+    """
+    Returns which of content_ids an earlier import already added, and
+    downloaded if download. Tracks are added once in the database, albums
+    once they have all their tracks and artists once followed, which only
+    happens after their tracks are added. Playlists are always added again,
+    as that is how they are updated
+    """
+    imported_ids = set()
+    if content_type == "tracks":
+        imported_ids = MusicDatabase.get_existing_track_ids(content_ids)
+        return {x for x in imported_ids if not download or LibraryIndex.get(x)}
+    for content_id in content_ids:
+        if content_type == "albums":
+            album = MusicDatabase.get_album(content_id)
+            tracks = MusicDatabase.get_all_album_tracks(content_id)
+            if not album or len(tracks) < album.total_tracks:
+                continue
+        elif content_type == "artists":
+            artist = MusicDatabase.get_artist(content_id)
+            if not artist or not artist.follow:
+                continue
+            tracks = [MusicDatabase.get_track(x) for x in MusicDatabase.get_artist_track_ids(content_id)]
+        else:
+            continue
+        if download and any(not x.hidden and not LibraryIndex.get(x.id) for x in tracks):
+            continue
+        imported_ids.add(content_id)
+    return imported_ids
+
+
+def import_content(content_types, ids, from_file, download=False, prompt=True):
+    """
+    Streams ids given on the command line and in from_file through the
+    processor of their type in batches, each added and downloaded before the
+    next is read. Content from from_file already imported is skipped so an
+    interrupted import picks up where it stopped
+    """
+    processors = {
+        "tracks": process_tracks,
+        "albums": process_albums,
+        "artists": functools.partial(process_artists, prompt=prompt),
+        "playlists": process_playlists,
+    }
+    batches = batched(read_content_ids(ids, from_file, content_types[0]), IMPORT_BATCH_SIZE if from_file else None)
+    for batch_number, batch in enumerate(batches):
+        content_ids = {}
+        for content_type, content_id in batch:
+            if content_type not in content_types:
+                print(f"  Skipping {content_id}, not a {' or '.join(x[:-1] for x in content_types)}")
+                continue
+            content_ids.setdefault(content_type, {})[content_id] = None
+        if from_file:
+            for content_type, type_ids in content_ids.items():
+                imported_ids = get_imported_ids(content_type, list(type_ids), download=download)
+                content_ids[content_type] = {x: None for x in type_ids if x not in imported_ids}
+
+        for content_type, type_ids in content_ids.items():
+            if not type_ids:
+                continue
+            if Daemon.forward(content_type, list(type_ids), download=download):
+                continue
+            if from_file:
+                print(f"Processing batch {batch_number + 1} of {len(type_ids)} {content_type}...")
+            tracks = processors[content_type](list(type_ids))
+            # Keep memory flat however long the input is
+            MetadataLoader.clear()
+            if download:
+                print()
+                print(f"Downloading {len(tracks)} tracks:")
+                download_tracks_safely(tracks)
+
+
 def pull_artists():
     for artist_id, artist_data in MyMelody.get_data("artists").items():
         artist_tracks = process_artists([artist_id], update=False)
@@ -773,30 +3659,409 @@ def pull_artists():
             print("  " + get_track_description(track_id, album=True, artists=False))
 
 
+################################################################################
+# Daemon                                                                       #
+################################################################################
+
+class JobQueue:
+    """
+    Work queued on the daemon, kept in the jobs table so it survives restarts.
+    Has its own connection as it is shared by the server and worker threads
+    """
+    CONNECTION = None
+    LOCK = threading.Lock()
+    ADDED = threading.Event()
+    JOB_TYPES = ("tracks", "albums", "artists", "playlists", "download")
+
+    @classmethod
+    def open(cls, db_path):
+        cls.CONNECTION = sqlite3.connect(db_path, check_same_thread=False)
+        cls.CONNECTION.row_factory = sqlite3.Row
+
+    @classmethod
+    def add(cls, job_type, content_ids, download=False, options=None):
+        """
+        Queues one job for all of content_ids, so their metadata is loaded in
+        batches, returning its id
+        """
+        if job_type not in cls.JOB_TYPES:
+            raise ValueError(f"Unknown job type {job_type}")
+        now = time.time()
+        with cls.LOCK:
+            job_id = cls.CONNECTION.execute(
+                "INSERT INTO jobs (job_type, content_id, download, options, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_type, ",".join(content_ids) or None, download, json.dumps(options or {}), now, now),
+            ).lastrowid
+            cls.CONNECTION.commit()
+        cls.ADDED.set()
+        return job_id
+
+    @classmethod
+    def get_content_ids(cls, job):
+        return job["content_id"].split(",") if job["content_id"] else []
+
+    @classmethod
+    def get_description(cls, job):
+        content_ids = cls.get_content_ids(job)
+        if len(content_ids) > 1:
+            return f"{content_ids[0]} and {len(content_ids) - 1} more"
+        return content_ids[0] if content_ids else ""
+
+    @classmethod
+    def get(cls, job_ids=None):
+        with cls.LOCK:
+            if job_ids:
+                rows = cls.CONNECTION.execute(f"SELECT * FROM jobs WHERE id IN ({','.join('?' * len(job_ids))}) ORDER BY id", job_ids).fetchall()
+            else:
+                rows = cls.CONNECTION.execute("SELECT * FROM jobs ORDER BY id").fetchall()
+        return [dict(x) for x in rows]
+
+    @classmethod
+    def claim(cls):
+        with cls.LOCK:
+            row = cls.CONNECTION.execute("SELECT * FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1").fetchone()
+            if not row:
+                return None
+            cls.CONNECTION.execute("UPDATE jobs SET status = 'running', updated_at = ? WHERE id = ?", (time.time(), row["id"]))
+            cls.CONNECTION.commit()
+        return dict(row)
+
+    @classmethod
+    def update(cls, job_id, **values):
+        values["updated_at"] = time.time()
+        with cls.LOCK:
+            cls.CONNECTION.execute(f"UPDATE jobs SET {', '.join(f'{x} = ?' for x in values)} WHERE id = ?", (*values.values(), job_id))
+            cls.CONNECTION.commit()
+
+    @classmethod
+    def requeue_running(cls):
+        with cls.LOCK:
+            cls.CONNECTION.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'")
+            cls.CONNECTION.commit()
+
+
+class DaemonStopped(Exception):
+    pass
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    """
+    Answers one JSON object per line with one JSON object per line
+    """
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = Daemon.handle(json.loads(line))
+            except Exception as e:
+                response = {"error": f"{type(e).__name__}: {e}"}
+            self.wfile.write((json.dumps(response) + "\n").encode())
+
+
+class Daemon:
+    """
+    Keeps the Spotify session open and works through the JobQueue, taking
+    new jobs over a Unix socket. CLI commands forward their work to it when
+    it is running
+    """
+    FORWARD = True
+    STOP = threading.Event()
+
+    @classmethod
+    def get_socket_path(cls):
+        return MyMelody.CONFIG.get("daemon_socket", "mdb.sock")
+
+    @classmethod
+    def request(cls, message):
+        """
+        Sends message to the daemon, returning its response or None if it
+        isn't running
+        """
+        socket_path = cls.get_socket_path()
+        if not hasattr(socket, "AF_UNIX") or not os.path.exists(socket_path):
+            return None
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(socket_path)
+                with sock.makefile("rw") as fh:
+                    fh.write(json.dumps(message) + "\n")
+                    fh.flush()
+                    response = json.loads(fh.readline())
+        except (ConnectionRefusedError, FileNotFoundError):
+            return None
+        if "error" in response:
+            raise click.ClickException(response["error"])
+        return response
+
+    @classmethod
+    def is_running(cls):
+        return cls.FORWARD and cls.request({"action": "ping"}) is not None
+
+    @classmethod
+    def forward(cls, job_type, content_ids, download=False, options=None):
+        """
+        Queues a job on the daemon with the command's options, returning
+        whether it was running
+        """
+        if not cls.FORWARD:
+            return False
+        response = cls.request({"action": "enqueue", "type": job_type, "ids": content_ids, "download": download, "options": options})
+        if response is None:
+            return False
+        print(f"Queued job {response['job']} on the daemon")
+        return True
+
+    @classmethod
+    def handle(cls, message):
+        action = message.get("action")
+        if action == "enqueue":
+            return {"job": JobQueue.add(message["type"], message.get("ids") or [], bool(message.get("download")), message.get("options"))}
+        if action == "status":
+            return {"jobs": JobQueue.get(message.get("ids"))}
+        if action == "ping":
+            return {}
+        raise ValueError(f"Unknown action {action}")
+
+    @classmethod
+    def run_job(cls, job):
+        def on_progress(progress, total):
+            JobQueue.update(job["id"], progress=progress, total=total)
+            if cls.STOP.is_set():
+                raise DaemonStopped()
+
+        content_ids = JobQueue.get_content_ids(job)
+        options = json.loads(job["options"] or "{}")
+        # Options only apply to the job they were queued with
+        config = MyMelody.CONFIG
+        if options.get("dedup"):
+            MyMelody.CONFIG = {**config, "dedup": True}
+        try:
+            if job["job_type"] == "tracks":
+                tracks = process_tracks(content_ids)
+            elif job["job_type"] == "albums":
+                tracks = process_albums(content_ids)
+            elif job["job_type"] == "artists":
+                # Only queued with --no-prompt, as there is no EDITOR here
+                tracks = process_artists(content_ids, prompt=False)
+            elif job["job_type"] == "playlists":
+                tracks = process_playlists(content_ids)
+            elif job["job_type"] == "download":
+                relocate_tracks(MusicDatabase.get_all_tracks())
+                tracks = tracks_to_download()
+            if job["download"] or job["job_type"] == "download":
+                download_tracks_safely(tracks, on_progress=on_progress)
+        finally:
+            MyMelody.CONFIG = config
+            # Later jobs load metadata changed since
+            MetadataLoader.clear()
+
+    @classmethod
+    def work(cls):
+        while not cls.STOP.is_set():
+            job = JobQueue.claim()
+            if not job:
+                JobQueue.ADDED.wait(timeout=1)
+                JobQueue.ADDED.clear()
+                continue
+            print(f"Job {job['id']}: {job['job_type']} {JobQueue.get_description(job)}")
+            try:
+                cls.run_job(job)
+            except DaemonStopped:
+                JobQueue.update(job["id"], status="queued")
+                break
+            except Exception as e:
+                print(f"  Job {job['id']} failed: {e}")
+                JobQueue.update(job["id"], status="failed", error=f"{type(e).__name__}: {e}")
+            else:
+                JobQueue.update(job["id"], status="done")
+            # Rescan the library before the next job to pick up changes made
+            # by other commands
+            LibraryIndex.save()
+            LibraryIndex.LOADED = False
+            Metrics.save()
+
+    @classmethod
+    def serve(cls):
+        socket_path = cls.get_socket_path()
+        if cls.request({"action": "ping"}) is not None:
+            raise click.ClickException(f"A daemon is already listening on {socket_path}")
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        JobQueue.open(MusicDatabase.PATH)
+        JobQueue.requeue_running()
+        worker = threading.Thread(target=cls.work, daemon=True)
+        worker.start()
+        server = socketserver.ThreadingUnixStreamServer(socket_path, DaemonHandler)
+        server.daemon_threads = True
+        print(f"Listening on {socket_path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print("Stopping after the current track, unfinished jobs resume on restart")
+        finally:
+            cls.STOP.set()
+            server.server_close()
+            os.remove(socket_path)
+        worker.join()
+
+
 ################################################################################
 # CLI                                                                          #
 ################################################################################
 
 @click.group()
-def main():
+@click.option("--no-daemon", is_flag=True, default=False, help="Run commands here even if a daemon is running")
+@click.option("--progress", type=click.Choice(["bar", "jsonl"]), default="bar", help="Show progress bars, or print JSON events to stdout")
+@click.option("--profile", required=False, default=None, help="Profile the command, writing sorted stats to this file")
+@click.option("--trace-memory", is_flag=True, default=False, help="Report memory allocated in each phase of the command")
+@click.pass_context
+def main(ctx, no_daemon, progress, profile, trace_memory):
+    if trace_memory:
+        MemoryTracer.start()
+        ctx.call_on_close(MemoryTracer.report)
+    # Close callbacks run in reverse, so the profile stops before the report
+    if profile:
+        Profiler.start(profile)
+        ctx.call_on_close(Profiler.save)
     MyMelody()
+    Progress.configure(progress)
+    Daemon.FORWARD = not no_daemon
     MusicDatabase.create_db("z.db")
+    ctx.call_on_close(MetadataLoader.print_stats)
+    ctx.call_on_close(LibraryIndex.save)
+    ctx.call_on_close(Metrics.save)
 
 @main.command()
-def download():
+@click.option("--dedup", is_flag=True, default=False, help="Link tracks with the same ISRC or audio instead of downloading them again")
+def download(dedup):
     """
     Downloads all the tracks in the database
     """
+    if dedup:
+        MyMelody.CONFIG["dedup"] = True
+    if Daemon.forward("download", [], options={"dedup": dedup}):
+        MusicDatabase.close()
+        return
+    relocate_tracks(MusicDatabase.get_all_tracks())
     tracks = tracks_to_download()
     print(f"Downloading {len(tracks)} tracks:")
     download_tracks_safely(tracks)
     MusicDatabase.close()
 
+@main.command()
+@click.option("--top", default=10, help="Rows to show in each breakdown")
+def plan(top):
+    """
+    Estimates the size and duration of downloading all the tracks in the database
+    """
+    print_plan(plan_downloads(tracks_to_download()), top=top)
+    MusicDatabase.close()
+
+@main.command()
+@click.option("--ids", required=False, default="", help="Comma separated list of track ids")
+@click.option("--workers", required=False, default=None, type=int, help="Number of threads")
+@click.option("--replaygain", is_flag=True, default=False, help="Measure tracks downloaded without their loudness and tag their album gain")
+def retag(ids, workers, replaygain):
+    """
+    Rewrites the tags of downloaded tracks that differ from the database
+    """
+    if ids:
+        tracks = [MusicDatabase.get_track(x) for x in ids.split(",")]
+    else:
+        tracks = MusicDatabase.get_all_tracks()
+    tracks = [x for x in tracks if x]
+    retagged = retag_tracks(tracks, workers=workers)
+    for track_id, changed_tags in retagged.items():
+        print(f"  {LibraryIndex.get(track_id)}: {', '.join(changed_tags)}")
+    if replaygain:
+        measured = measure_tracks_loudness(tracks, workers=workers)
+        finalized = sum(finalize_album_loudness(x) for x in sorted({x.album.id for x in tracks}))
+        print(f"Measured {measured} tracks and tagged the gain of {finalized} albums")
+    MusicDatabase.close()
+
+@main.command()
+@click.option("--dry-run", is_flag=True, default=False, help="Only show what would be linked")
+def dedup(dry_run):
+    """
+    Links downloaded tracks with the same ISRC or audio to a single file
+    """
+    dedup_tracks(dry_run=dry_run)
+    MusicDatabase.close()
+
+@main.command()
+@click.option("--dry-run", is_flag=True, default=False, help="Only show what would be moved")
+def relocate(dry_run):
+    """
+    Moves downloaded tracks whose artist, album or name has changed
+    """
+    relocate_tracks(MusicDatabase.get_all_tracks(), dry_run=dry_run)
+    MusicDatabase.close()
+
+@main.command()
+@click.option("--dry-run", is_flag=True, default=False, help="Only show what would be deleted")
+def cleanup(dry_run):
+    """
+    Deletes the files of hidden tracks and the directories they leave empty
+    """
+    cleanup_tracks(dry_run=dry_run)
+    MusicDatabase.close()
+
+@main.command()
+@click.option("--workers", required=False, default=None, type=int, help="Number of processes, defaults to one per core")
+@click.option("--no-requeue", is_flag=True, default=False, help="Only report broken tracks")
+@click.option("--no-download", is_flag=True, default=False, help="Requeue broken tracks without downloading them")
+def verify(workers, no_requeue, no_download):
+    """
+    Checks downloaded tracks for truncated audio and tags that differ from the database
+    """
+    tracks = {x.id: x for x in MusicDatabase.get_all_tracks() if not x.hidden and LibraryIndex.get(x.id)}
+    broken = verify_tracks(tracks.values(), workers=workers)
+    if broken:
+        print("Broken tracks:")
+        for track_id, problems in broken.items():
+            print(f"  {get_track_description(tracks[track_id], album=True)}")
+            for problem in problems:
+                print(f"    {problem}")
+    if broken and not no_requeue:
+        DownloadQueue.redownload([tracks[x] for x in broken])
+        if not no_download:
+            print()
+            print(f"Downloading {len(broken)} tracks:")
+            download_tracks_safely([tracks[x] for x in broken])
+    MusicDatabase.close()
+
+@main.command()
+@click.option("--ids", required=False, default="", help="Comma separated list of track ids")
+@click.option("--dry-run", is_flag=True, default=False, help="Only show what would be downloaded again")
+@click.option("--no-download", is_flag=True, default=False, help="Requeue tracks without downloading them")
+def requeue(ids, dry_run, no_download):
+    """
+    Downloads tracks again that were downloaded below their configured quality
+    """
+    if ids:
+        tracks = [MusicDatabase.get_track(x) for x in ids.split(",")]
+    else:
+        tracks = MusicDatabase.get_all_tracks()
+    # Tracks downloaded before quality was recorded were all HIGH. Tracks are
+    # compared by what they requested, as those that got less have no file
+    # at a higher quality
+    upgrades = [x for x in tracks if x and not x.hidden and LibraryIndex.get(x.id) and list(QUALITIES).index(x.requested_quality or x.quality or "HIGH") < list(QUALITIES).index(get_track_quality(x))]
+    print(f"Requeueing {len(upgrades)} tracks:")
+    for track in upgrades:
+        print(f"  {get_track_description(track, album=True)}: {track.quality or 'HIGH'} to {get_track_quality(track)}")
+    if upgrades and not dry_run:
+        DownloadQueue.redownload(upgrades)
+        if not no_download:
+            print()
+            print(f"Downloading {len(upgrades)} tracks:")
+            download_tracks_safely(upgrades)
+    MusicDatabase.close()
+
 @main.command()
 def credentials():
     """
     Generates a credentials.json file when casting from a premium account
     """
+    from librespot.zeroconf import ZeroconfServer
     zs = ZeroconfServer.Builder().create()
     print("Transfer playback from desktop client to librespot-python via Spotify Connect in order to store session")
     while True:
@@ -808,6 +4073,14 @@ def credentials():
                 print("Session stored in credentials.json. Now you can Ctrl+C")
                 break
 
+@main.command()
+def daemon():
+    """
+    Keeps the Spotify session open and runs jobs queued by other commands
+    """
+    Daemon.serve()
+    MusicDatabase.close()
+
 @main.command()
 def test():
     """
@@ -839,43 +4112,43 @@ def tracks_cli_get(ids, show_ids):
     """
     Lists tracks
     """
+    from tabulate import tabulate
     if ids:
         tracks = [MusicDatabase.get_track(x) for x in ids.split(",")]
     else:
         tracks = MusicDatabase.get_all_tracks()
-    tracks = sorted([x for x in tracks if not x["hidden"]], key=lambda x: (x["album"]["release_date"], x["album"]["name"], x["track_number"]))
+    tracks = sorted([x for x in tracks if x and not x.hidden], key=lambda x: (x.album.release_date, x.album.name, x.track_number))
     track_headers = ["name", "artists", "track_number", "album"]
     if show_ids:
         track_headers = ["id"] + track_headers
     tracks_to_show = []
     for track in tracks:
         track_data = [
-            track["name"],
-            "; ".join([x["name"] for x in track["artists"]]),
-            track["track_number"],
-            track["album"]["name"],
+            track.name,
+            "; ".join([x.name for x in track.artists]),
+            track.track_number,
+            track.album.name,
         ]
         if show_ids:
-            track_data = [track["id"]] + track_data
+            track_data = [track.id] + track_data
         tracks_to_show.append(track_data)
     print(tabulate(tracks_to_show, headers=track_headers))
     MusicDatabase.close()
 
 @tracks_cli.command("add")
-@click.option("--ids", required=True, default="", help="Comma separated list of track ids")
+@click.option("--ids", required=False, default="", help="Comma separated list of track or album ids, URIs or URLs")
+@click.option("--from-file", type=click.File("r"), default=None, help="File of track or album ids, URIs or URLs, one or more per line, - for stdin")
 @click.option("--force", is_flag=True, default=False, help="Unhides track if previously hidden")
 @click.option("--no-download", is_flag=True, default=False, help="Only add tracks to database")
-def tracks_cli_add(ids, force, no_download):
+def tracks_cli_add(ids, from_file, force, no_download):
     """
-    Adds tracks
+    Adds tracks, and every track on albums
     """
     # TODO: Add force
+    if not ids and not from_file:
+        raise click.UsageError("Either --ids or --from-file is required")
     print("Processing tracks...")
-    tracks_to_add = process_tracks(ids.split(","))
-    if not no_download:
-        print()
-        print(f"Downloading {len(tracks_to_add)} tracks:")
-        download_tracks_safely(tracks_to_add)
+    import_content(["tracks", "albums"], ids, from_file, download=not no_download)
     MusicDatabase.close()
 
 @tracks_cli.command("remove")
@@ -904,15 +4177,25 @@ def artists_cli():
     pass
 
 @artists_cli.command("add")
-@click.option("--ids", required=True, default="", help="Comma separated list of artist ids")
+@click.option("--ids", required=False, default="", help="Comma separated list of artist ids, URIs or URLs")
+@click.option("--from-file", type=click.File("r"), default=None, help="File of artist ids, URIs or URLs, one or more per line, - for stdin")
 # @click.option("--force", is_flag=True, default=False, help="Unhides track if previously hidden")
 @click.option("--no-download", is_flag=True, default=False, help="Only add tracks to database")
-def artists_cli_add(ids, no_download):
+@click.option("--no-prompt", is_flag=True, default=False, help="Add the suggested tracks without reviewing them in EDITOR")
+def artists_cli_add(ids, from_file, no_download, no_prompt):
     """
     Adds artists and all their tracks
     """
+    if not ids and not from_file:
+        raise click.UsageError("Either --ids or --from-file is required")
+    # The daemon has no EDITOR to review tracks in
+    if not no_prompt and Daemon.is_running():
+        raise click.UsageError("A daemon is running, pass --no-prompt to queue artists on it or --no-daemon to review their tracks here")
+    # Nor would EDITOR have a terminal to read from with ids piped in
+    if not no_prompt and not sys.stdin.isatty():
+        raise click.UsageError("Reviewing tracks in EDITOR needs a terminal, pass --no-prompt to read ids from stdin")
     print("Processing artists...")
-    tracks_to_add = process_artists(ids.split(","))
+    import_content(["artists"], ids, from_file, prompt=not no_prompt)
     # if not no_download:
     #     print()
     #     print(f"Downloading {len(tracks_to_add)} tracks:")
@@ -940,12 +4223,13 @@ def playlists_cli_get(ids, show_ids):
     """
     Lists tracks in playlists
     """
+    from tabulate import tabulate
     # if ids:
     #     tracks = [MusicDatabase.get_track(x) for x in ids.split(",")]
     # else:
     #     tracks = MusicDatabase.get_all_tracks()
     playlist = MusicDatabase.get_playlist(ids)
-    tracks = [x for x in playlist["tracks"] if not x["hidden"]]
+    tracks = [x for x in playlist["tracks"] if not x.hidden]
     track_headers = ["order", "name", "artists", "album"]
     if show_ids:
         track_headers = ["id"] + track_headers
@@ -953,25 +4237,40 @@ def playlists_cli_get(ids, show_ids):
     for i in range(len(tracks)):
         track_data = [
             i+1,
-            tracks[i]["name"],
-            "; ".join([x["name"] for x in tracks[i]["artists"]]),
-            tracks[i]["album"]["name"],
+            tracks[i].name,
+            "; ".join([x.name for x in tracks[i].artists]),
+            tracks[i].album.name,
         ]
         if show_ids:
-            track_data = [track["id"]] + track_data
+            track_data = [tracks[i].id] + track_data
         tracks_to_show.append(track_data)
     print(tabulate(tracks_to_show, headers=track_headers))
     MusicDatabase.close()
 
 @playlists_cli.command("add")
-@click.option("--ids", required=True, default="", help="Comma separated list of playlist ids")
+@click.option("--ids", required=False, default="", help="Comma separated list of playlist ids, URIs or URLs")
+@click.option("--from-file", type=click.File("r"), default=None, help="File of playlist ids, URIs or URLs, one or more per line, - for stdin")
 @click.option("--no-download", is_flag=True, default=False, help="Only add tracks to database")
-def playlists_cli_add(ids, no_download):
+def playlists_cli_add(ids, from_file, no_download):
     """
     Adds playlists and all their tracks
     """
+    if not ids and not from_file:
+        raise click.UsageError("Either --ids or --from-file is required")
     print("Procesing playlists")
-    tracks_to_add = process_playlists(ids.split(","))
+    import_content(["playlists"], ids, from_file)
+    MusicDatabase.close()
+
+@playlists_cli.command("export")
+@click.option("--ids", required=False, default="", help="Comma separated list of playlist ids, defaults to all")
+@click.option("--output", required=False, default=None, help="Directory to write playlists to, defaults to playlist_path")
+def playlists_cli_export(ids, output):
+    """
+    Exports playlists as M3U files
+    """
+    playlist_ids = ids.split(",") if ids else MusicDatabase.get_all_playlist_ids()
+    print("Exporting playlists...")
+    export_playlists(playlist_ids, output or MyMelody.CONFIG.get("playlist_path", "playlists"))
     MusicDatabase.close()
 
 @playlists_cli.command("remove")
@@ -989,6 +4288,100 @@ def playlists_cli_remove(ids):
         MusicDatabase.CONNECTION.commit()
     MusicDatabase.close()
 
+################################################################################
+# CLI - Jobs                                                                   #
+################################################################################
+
+@main.group("jobs")
+def jobs_cli():
+    """
+    Manages jobs queued on the daemon
+    """
+    pass
+
+@jobs_cli.command("get")
+@click.option("--ids", required=False, default="", help="Comma separated list of job ids")
+def jobs_cli_get(ids):
+    """
+    Lists jobs and their progress
+    """
+    from tabulate import tabulate
+    job_ids = [int(x) for x in ids.split(",") if x]
+    response = Daemon.request({"action": "status", "ids": job_ids})
+    if response is not None:
+        jobs = response["jobs"]
+    else:
+        JobQueue.open(MusicDatabase.PATH)
+        jobs = JobQueue.get(job_ids)
+    jobs_to_show = [[x["id"], x["job_type"], JobQueue.get_description(x), x["status"], f"{x['progress']}/{x['total']}" if x["total"] else "", x["error"] or ""] for x in jobs]
+    print(tabulate(jobs_to_show, headers=["id", "type", "content", "status", "progress", "error"]))
+    MusicDatabase.close()
+
+################################################################################
+# CLI - Queue                                                                  #
+################################################################################
+
+@main.group("queue")
+def queue_cli():
+    """
+    Manages the order tracks are downloaded in
+    """
+    pass
+
+@queue_cli.command("get")
+@click.option("--top", default=20, help="Tracks to show, 0 for all")
+@click.option("--show-ids", is_flag=True, default=False, help="Show track id")
+def queue_cli_get(top, show_ids):
+    """
+    Lists tracks waiting to download, in the order they will be downloaded
+    """
+    from tabulate import tabulate
+    queue = MusicDatabase.get_download_queue()
+    tracks = DownloadQueue.order(tracks_to_download())
+    track_headers = ["priority", "source", "name", "artists", "album"]
+    if show_ids:
+        track_headers = ["id"] + track_headers
+    tracks_to_show = []
+    for track, priority in tracks[:top or None]:
+        track_data = [
+            f"{priority:.0f}",
+            (queue.get(track.id) or {}).get("source") or "",
+            track.name,
+            "; ".join([x.name for x in track.artists]),
+            track.album.name,
+        ]
+        if show_ids:
+            track_data = [track.id] + track_data
+        tracks_to_show.append(track_data)
+    print(tabulate(tracks_to_show, headers=track_headers))
+    if top and len(tracks) > top:
+        print(f"... and {len(tracks) - top} more")
+    MusicDatabase.close()
+
+@queue_cli.command("priority")
+@click.option("--ids", required=True, default="", help="Comma separated list of ids")
+@click.option("--type", "content_type", type=click.Choice(["tracks", "albums", "artists", "playlists"]), default="tracks", help="Type of the ids")
+@click.option("--priority", required=True, type=float, help="Points added to the tracks' priority, negative to lower it")
+def queue_cli_priority(ids, content_type, priority):
+    """
+    Raises or lowers the priority of tracks, or of every track of albums,
+    artists or playlists
+    """
+    track_ids = []
+    for content_id in ids.split(","):
+        if content_type == "tracks":
+            track_ids.append(content_id)
+        elif content_type == "albums":
+            track_ids += [x.id for x in MusicDatabase.get_all_album_tracks(content_id)]
+        elif content_type == "artists":
+            track_ids += MusicDatabase.get_artist_track_ids(content_id)
+        elif content_type == "playlists":
+            track_ids += [x.id for x in (MusicDatabase.get_playlist(content_id) or {"tracks": []})["tracks"] if x]
+    track_ids = list(dict.fromkeys(track_ids))
+    DownloadQueue.adjust(track_ids, priority)
+    print(f"Set the priority of {len(track_ids)} tracks to {priority:+g}")
+    MusicDatabase.close()
+
 if __name__ == "__main__":
     main()
 
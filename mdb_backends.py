@@ -0,0 +1,334 @@
+import hashlib
+import io
+import json
+import os
+import pathlib
+import random
+import struct
+import time
+import zlib
+
+################################################################################
+# Offline backends                                                             #
+################################################################################
+
+# Stand in for Spotify when backend.type in config isn't live, so mdb only
+# imports them then
+
+def get_fixture_key(method, args, kwargs):
+    key = json.dumps([args, kwargs], sort_keys=True, default=str)
+    return f"{method}/{hashlib.sha1(key.encode()).hexdigest()}"
+
+
+def get_content_track_id(content_id):
+    return content_id.to_spotify_uri().split(":")[-1]
+
+
+class FakeInputStream:
+    def __init__(self, data, bandwidth=None):
+        self.size = len(data)
+        self.bandwidth = bandwidth
+        self.buffer = io.BytesIO(data)
+
+    def stream(self):
+        return self
+
+    def read(self, size=-1):
+        data = self.buffer.read(size)
+        if self.bandwidth:
+            time.sleep(len(data) / self.bandwidth)
+        return data
+
+    def close(self):
+        self.buffer.close()
+
+
+class FakeStream:
+    def __init__(self, data, bandwidth=None):
+        self.input_stream = FakeInputStream(data, bandwidth=bandwidth)
+
+
+# Every synthetic track is served this recording of a tone, 5 s of Vorbis
+# encoded at 160 kbps, with its placeholder title replaced by the track's id
+SYNTHETIC_AUDIO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "testdata", "synthetic.ogg")
+SYNTHETIC_TITLE = b"title=0t00000000000000000000"
+BIT_REVERSED_BYTES = bytes(int(f"{x:08b}"[::-1], 2) for x in range(256))
+
+
+def get_ogg_crc(data):
+    """
+    Ogg's CRC-32 is unreflected with no inversion, so it is zlib's register
+    for the bit reversed bytes, reversed
+    """
+    crc = ~zlib.crc32(data.translate(BIT_REVERSED_BYTES), 0xFFFFFFFF) & 0xFFFFFFFF
+    return int(f"{crc:032b}"[::-1], 2)
+
+
+def set_synthetic_title(audio, track_id):
+    """
+    Writes track_id over the placeholder title in Ogg audio, so every track's
+    audio hashes differently, and updates the CRC of the page it is on.
+    Audio without the placeholder is returned unchanged
+    """
+    start = audio.find(SYNTHETIC_TITLE)
+    if start < 0:
+        return audio
+    page_start = audio.rfind(b"OggS", 0, start)
+    segments = audio[page_start + 26]
+    page_end = page_start + 27 + segments + sum(audio[page_start + 27:page_start + 27 + segments])
+    page = bytearray(audio[page_start:page_end])
+    title_start = start - page_start + len(SYNTHETIC_TITLE) - len(track_id)
+    page[title_start:title_start + len(track_id)] = track_id.encode()
+    page[22:26] = bytes(4)
+    page[22:26] = struct.pack("<I", get_ogg_crc(bytes(page)))
+    return audio[:page_start] + bytes(page) + audio[page_end:]
+
+
+class FakeSession:
+    """
+    Stands in for a librespot Session, serving audio from get_audio
+    """
+    def __init__(self, get_audio, latency=0, bandwidth=None):
+        self.get_audio = get_audio
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+    def content_feeder(self):
+        return self
+
+    def load(self, content_id, audio_quality_picker, preload, halt_listener):
+        time.sleep(self.latency)
+        return FakeStream(self.get_audio(get_content_track_id(content_id)), bandwidth=self.bandwidth)
+
+
+class RecordingClient:
+    """
+    Wraps a Spotify client, storing every response as a fixture
+    """
+    def __init__(self, client, fixtures_path):
+        self.client = client
+        self.fixtures_path = fixtures_path
+
+    def __getattr__(self, method):
+        def record(*args, **kwargs):
+            resp = getattr(self.client, method)(*args, **kwargs)
+            fixture_path = f"{self.fixtures_path}/metadata/{get_fixture_key(method, args, kwargs)}.json"
+            pathlib.Path(os.path.dirname(fixture_path)).mkdir(parents=True, exist_ok=True)
+            with open(fixture_path, "w") as fh:
+                json.dump(resp, fh)
+            return resp
+        return record
+
+
+class RecordingSession:
+    """
+    Wraps a librespot Session, storing every audio stream as a fixture
+    """
+    def __init__(self, session, fixtures_path):
+        self.session = session
+        self.fixtures_path = fixtures_path
+
+    def content_feeder(self):
+        return self
+
+    def load(self, content_id, audio_quality_picker, preload, halt_listener):
+        stream = self.session.content_feeder().load(content_id, audio_quality_picker, preload, halt_listener)
+        data = b""
+        while len(data) < stream.input_stream.size:
+            chunk = stream.input_stream.stream().read(stream.input_stream.size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        fixture_path = f"{self.fixtures_path}/audio/{get_content_track_id(content_id)}.ogg"
+        pathlib.Path(os.path.dirname(fixture_path)).mkdir(parents=True, exist_ok=True)
+        with open(fixture_path, "wb") as fh:
+            fh.write(data)
+        return FakeStream(data)
+
+
+class RecordingBackend:
+    """
+    Talks to Spotify through the live backend, recording responses to
+    fixtures_path
+    """
+    def __init__(self, live, fixtures_path="fixtures"):
+        self.live = live
+        self.fixtures_path = fixtures_path
+
+    def create_session(self, credentials=None):
+        return RecordingSession(self.live.create_session(credentials), self.fixtures_path)
+
+    def create_client(self):
+        return RecordingClient(self.live.create_client(), self.fixtures_path)
+
+
+class ReplayClient:
+    def __init__(self, fixtures_path, latency=0):
+        self.fixtures_path = fixtures_path
+        self.latency = latency
+
+    def __getattr__(self, method):
+        def replay(*args, **kwargs):
+            time.sleep(self.latency)
+            fixture_path = f"{self.fixtures_path}/metadata/{get_fixture_key(method, args, kwargs)}.json"
+            if not os.path.exists(fixture_path):
+                raise FileNotFoundError(f"No fixture recorded for {method}{args}: {fixture_path}")
+            with open(fixture_path, "r") as fh:
+                return json.load(fh)
+        return replay
+
+
+class ReplayBackend:
+    """
+    Serves the fixtures recorded by RecordingBackend without a connection
+    """
+    def __init__(self, live, fixtures_path="fixtures", latency=0, bandwidth=None):
+        self.fixtures_path = fixtures_path
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+    def get_audio(self, track_id):
+        with open(f"{self.fixtures_path}/audio/{track_id}.ogg", "rb") as fh:
+            return fh.read()
+
+    def create_session(self, credentials=None):
+        return FakeSession(self.get_audio, latency=self.latency, bandwidth=self.bandwidth)
+
+    def create_client(self):
+        return ReplayClient(self.fixtures_path, latency=self.latency)
+
+
+class SyntheticClient:
+    """
+    Generates a deterministic catalog, encoding each object's position in its
+    id. Ids start with 0 so they stay valid 128 bit base62 ids for TrackId
+      artist: 0r + artist
+      album:  0l + artist + album
+      track:  0t + artist + album + track
+    """
+    ALBUM_TYPES = ["album", "single", "single", "compilation"]
+
+    def __init__(self, artist_count=100, album_count=10, track_count=12, playlist_size=100, latency=0):
+        self.artist_count = artist_count
+        self.album_count = album_count
+        self.track_count = track_count
+        self.playlist_size = playlist_size
+        self.latency = latency
+
+    def get_artist(self, artist):
+        return {"id": f"0r{artist:020d}", "name": f"Artist {artist}", "type": "artist", "images": []}
+
+    def get_album(self, artist, album, simple=False):
+        album_type = self.ALBUM_TYPES[album % len(self.ALBUM_TYPES)]
+        total_tracks = 1 if album_type == "single" else self.track_count
+        data = {
+            "id": f"0l{artist:010d}{album:010d}",
+            "name": f"Album {artist}-{album}",
+            "album_type": album_type,
+            "total_tracks": total_tracks,
+            "release_date": f"{2000 + album % 25}-{album % 12 + 1:02d}-01",
+            "release_date_precision": "day",
+            "images": [{"url": f"https://i.scdn.co/image/{artist}-{album}", "height": 640, "width": 640}],
+            "artists": [self.get_artist(artist)] + ([self.get_artist((artist + 1) % self.artist_count)] if album_type == "compilation" else []),
+        }
+        if not simple:
+            data["tracks"] = {"items": [self.get_track(artist, album, x, simple=True) for x in range(total_tracks)], "total": total_tracks}
+        return data
+
+    def get_track(self, artist, album, track, simple=False):
+        artists = [self.get_artist(artist)]
+        # Every fourth track features the next artist
+        if track % 4 == 3:
+            artists.append(self.get_artist((artist + 1) % self.artist_count))
+        # Albums share track names with the single before them
+        data = {
+            "id": f"0t{artist:06d}{album:06d}{track:08d}",
+            "name": f"Track {artist}-{album // 2}-{track}",
+            "disc_number": 1,
+            "track_number": track + 1,
+            "duration_ms": 120000 + (artist * 7919 + album * 104729 + track * 15485863) % 240000,
+            "artists": artists,
+        }
+        if not simple:
+            data["album"] = self.get_album(artist, album, simple=True)
+            # The single and album tracks sharing a name are one recording
+            data["external_ids"] = {"isrc": f"ZZ{artist:04d}{album // 2:03d}{track:03d}"}
+        return data
+
+    def artist(self, artist_id):
+        time.sleep(self.latency)
+        return self.get_artist(int(artist_id[2:]))
+
+    def artists(self, artist_ids):
+        time.sleep(self.latency)
+        return {"artists": [self.get_artist(int(x[2:])) for x in artist_ids]}
+
+    def artist_albums(self, artist_id, limit=20, offset=0, **kwargs):
+        time.sleep(self.latency)
+        artist = int(artist_id[2:])
+        return {
+            "items": [self.get_album(artist, x, simple=True) for x in range(offset, min(offset + limit, self.album_count))],
+            "total": self.album_count,
+        }
+
+    def album(self, album_id):
+        time.sleep(self.latency)
+        return self.get_album(int(album_id[2:12]), int(album_id[12:]))
+
+    def albums(self, album_ids):
+        time.sleep(self.latency)
+        return {"albums": [self.get_album(int(x[2:12]), int(x[12:])) for x in album_ids]}
+
+    def track(self, track_id):
+        time.sleep(self.latency)
+        return self.get_track(int(track_id[2:8]), int(track_id[8:14]), int(track_id[14:]))
+
+    def tracks(self, track_ids):
+        time.sleep(self.latency)
+        return {"tracks": [self.get_track(int(x[2:8]), int(x[8:14]), int(x[14:])) for x in track_ids]}
+
+    def playlist(self, playlist_id, **kwargs):
+        time.sleep(self.latency)
+        playlist = int(playlist_id[2:])
+        return {"id": playlist_id, "name": f"Playlist {playlist}", "images": []}
+
+    def playlist_items(self, playlist_id, limit=100, offset=0, **kwargs):
+        time.sleep(self.latency)
+        rng = random.Random(playlist_id)
+        items = []
+        for i in range(self.playlist_size):
+            artist, album = rng.randrange(self.artist_count), rng.randrange(self.album_count)
+            album_type = self.ALBUM_TYPES[album % len(self.ALBUM_TYPES)]
+            track = 0 if album_type == "single" else rng.randrange(self.track_count)
+            items.append({"track": self.get_track(artist, album, track)})
+        return {"items": items[offset:offset+limit], "total": self.playlist_size}
+
+
+class SyntheticBackend:
+    """
+    Serves a generated catalog, and the Vorbis file at audio_path for every
+    track
+    """
+    def __init__(self, live, audio_path=SYNTHETIC_AUDIO_PATH, latency=0, bandwidth=None, **catalog):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.catalog = catalog
+        with open(audio_path, "rb") as fh:
+            self.audio = fh.read()
+
+    def get_audio(self, track_id):
+        return set_synthetic_title(self.audio, track_id)
+
+    def create_session(self, credentials=None):
+        return FakeSession(self.get_audio, latency=self.latency, bandwidth=self.bandwidth)
+
+    def create_client(self):
+        return SyntheticClient(latency=self.latency, **self.catalog)
+
+
+# Each is created with the live backend, which only recording talks to
+BACKENDS = {
+    "record": RecordingBackend,
+    "replay": ReplayBackend,
+    "synthetic": SyntheticBackend,
+}
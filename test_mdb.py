@@ -0,0 +1,453 @@
+import http.server
+import json
+import os
+import threading
+
+import pytest
+
+import mdb
+import mdb_backends
+
+
+class RateLimitedHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers the first request with a 429 and every later one with a track
+    """
+    requests = 0
+
+    def do_GET(self):
+        type(self).requests += 1
+        if type(self).requests == 1:
+            self.send_response(429)
+            self.send_header("Retry-After", "0")
+            self.end_headers()
+            return
+        body = json.dumps({"id": "0t00000000000000000000"}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def api_server():
+    RateLimitedHandler.requests = 0
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RateLimitedHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/v1/"
+    server.shutdown()
+
+
+def test_429_reaches_request_scheduler(api_server, monkeypatch):
+    from spotipy import Spotify
+    client = Spotify(auth="token", requests_session=mdb.create_requests_session())
+    client.prefix = api_server
+    mdb.RequestScheduler.configure(rate=100)
+
+    retry_afters = []
+    release = mdb.RequestScheduler.release.__func__
+    monkeypatch.setattr(mdb.RequestScheduler, "release", classmethod(lambda cls, success=True, retry_after=None: (retry_afters.append(retry_after), release(cls, success, retry_after))))
+
+    track = mdb.ScheduledClient(client).track("0t00000000000000000000")
+
+    assert track["id"] == "0t00000000000000000000"
+    # urllib3 handed the 429 back instead of retrying it, and submit retried
+    assert RateLimitedHandler.requests == 2
+    assert retry_afters == [0.0, None]
+
+
+def create_track(track_id, name, album_type, release_date):
+    artist = mdb.Artist("0r0", "Artist")
+    album = mdb.Album(id=f"0l{track_id}", name=name, album_type=album_type, total_tracks=1, release_date=release_date, artwork_url=None, artists=[artist])
+    return mdb.Track(id=track_id, name=name, disc_number=1, track_number=1, album=album, artists=[artist])
+
+
+def test_get_track_actions_leaves_tracks_unchanged():
+    album_track = create_track("0t1", "Song", "album", "2020")
+    single_track = create_track("0t2", "Song", "single", "2021")
+    existing_single = create_track("0t3", "Song", "single", "2019")
+
+    track_actions = mdb.get_track_actions([album_track, single_track], [], [existing_single])
+
+    assert [(x.id, x.hidden) for x in track_actions["add"]] == [("0t1", False), ("0t2", True)]
+    assert [(x.id, x.hidden) for x in track_actions["existing"]] == [("0t3", True)]
+    # The records may be shared with other artists through MetadataLoader
+    assert not single_track.hidden and not existing_single.hidden
+
+
+class ArtworkHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves an HTML error page for /error and a JPEG for anything else
+    """
+    def do_GET(self):
+        body, content_type = (b"<html>Rate limited</html>", "text/html") if self.path == "/error" else (b"\xff\xd8jpg", "image/jpeg")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_artwork_cache_rejects_error_pages(tmp_path, monkeypatch):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ArtworkHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    monkeypatch.setattr(mdb.MyMelody, "CONFIG", {"artwork_cache_path": str(tmp_path)})
+    monkeypatch.setattr(mdb.ArtworkCache, "ARTWORK", mdb.collections.OrderedDict())
+    monkeypatch.setattr(mdb.ArtworkCache, "MEMORY_SIZE", 2)
+
+    try:
+        with pytest.raises(ValueError):
+            mdb.ArtworkCache.get(f"{url}/error")
+        assert not list(tmp_path.iterdir())
+
+        for i in range(3):
+            assert mdb.ArtworkCache.get(f"{url}/{i}") == b"\xff\xd8jpg"
+        assert list(mdb.ArtworkCache.ARTWORK) == [f"{url}/1", f"{url}/2"]
+    finally:
+        server.shutdown()
+
+
+def test_replaygain_tags_unshare_hardlinked_files(tmp_path):
+    from mutagen.id3 import ID3
+    source_path, track_path = str(tmp_path / "source.mp3"), str(tmp_path / "track.mp3")
+    with open(source_path, "wb") as fh:
+        fh.write(bytes(4096))
+    ID3().save(source_path)
+    mdb.set_replaygain_tags(source_path, "album", -3, 0.5)
+    os.link(source_path, track_path)
+
+    mdb.set_replaygain_tags(track_path, "album", -3, 0.5)
+    assert os.path.samefile(source_path, track_path)
+
+    mdb.set_replaygain_tags(track_path, "album", -6, 0.5)
+    assert not os.path.samefile(source_path, track_path)
+    assert ID3(source_path).getall("TXXX:REPLAYGAIN_ALBUM_GAIN")[0].text == ["-3.00 dB"]
+    assert ID3(track_path).getall("TXXX:REPLAYGAIN_ALBUM_GAIN")[0].text == ["-6.00 dB"]
+
+
+def test_export_playlist_skips_unchanged_playlists(tmp_path, monkeypatch):
+    monkeypatch.setattr(mdb.MyMelody, "CONFIG", {"track_path": str(tmp_path / "tracks")})
+    mdb.MusicDatabase.create_db(str(tmp_path / "mdb.db"))
+    track = create_track("0t1", "Song", "album", "2020")
+    track = mdb.dataclasses.replace(track, duration_ms=None, path="Artist/Album/Song [0t1].mp3")
+    mdb.MusicDatabase.add_playlist({"id": "0p1", "name": "Mix", "artwork_url": None, "tracks": [track]})
+    export_path = str(tmp_path / "playlists")
+    os.mkdir(export_path)
+    export_hashes = {}
+
+    try:
+        playlist_file = mdb.export_playlist("0p1", export_path, export_hashes)
+        with open(playlist_file) as fh:
+            assert fh.read().splitlines() == [
+                "#EXTM3U",
+                "#PLAYLIST:Mix",
+                "#EXTINF:-1,Artist - Song",
+                "../tracks/Artist/Album/Song [0t1].mp3",
+            ]
+        inode = os.stat(playlist_file).st_ino
+
+        assert mdb.export_playlist("0p1", export_path, export_hashes) is None
+        assert os.stat(playlist_file).st_ino == inode
+        assert sorted(os.listdir(export_path)) == [os.path.basename(playlist_file)]
+    finally:
+        mdb.MusicDatabase.close()
+
+
+def test_timed_observes_only_the_outermost_call(monkeypatch):
+    monkeypatch.setattr(mdb.Metrics, "HISTOGRAMS", {})
+
+    @mdb.Metrics.timed("db_write")
+    def add_artist():
+        pass
+
+    @mdb.Metrics.timed("db_write")
+    def add_track():
+        add_artist()
+
+    add_track()
+    add_artist()
+
+    assert {dict(labels)["op"]: x["count"] for (_, labels), x in mdb.Metrics.HISTOGRAMS.items()} == {"add_track": 1, "add_artist": 1}
+
+
+class RestrictedFeeder:
+    loads = 0
+
+    def load(self, *args):
+        type(self).loads += 1
+        raise RuntimeError("Content is restricted!")
+
+
+class RestrictedSession:
+    def content_feeder(self):
+        return RestrictedFeeder()
+
+
+def test_content_errors_leave_sessions_healthy(monkeypatch):
+    sessions = [mdb.PooledSession("a.json"), mdb.PooledSession("b.json")]
+    for pooled in sessions:
+        pooled.session = RestrictedSession()
+    monkeypatch.setattr(mdb.SessionPool, "SESSIONS", sessions)
+    mdb.RequestScheduler.configure(rate=100)
+
+    with pytest.raises(RuntimeError, match="restricted"):
+        mdb.SessionPool.load("0t1", None)
+
+    # Failing over can't help a track no session can play
+    assert RestrictedFeeder.loads == 1
+    assert [(x.failures, x.session is not None) for x in sessions] == [(0, True), (0, True)]
+
+
+def test_stream_quality_is_the_quality_received():
+    from types import SimpleNamespace
+    from librespot.proto import Metadata_pb2 as Metadata
+    files = [
+        Metadata.AudioFile(file_id=b"\x01", format=Metadata.AudioFile.OGG_VORBIS_160),
+        Metadata.AudioFile(file_id=b"\x02", format=Metadata.AudioFile.OGG_VORBIS_96),
+    ]
+    stream = SimpleNamespace(track=SimpleNamespace(file=files), metrics=SimpleNamespace(file_id="01"))
+
+    assert mdb.get_stream_quality(stream, "VERY_HIGH") == "HIGH"
+    assert mdb.get_stream_quality(SimpleNamespace(), "VERY_HIGH") == "VERY_HIGH"
+
+
+def test_config_qualities_are_checked(monkeypatch):
+    monkeypatch.setattr(mdb.MyMelody, "CONFIG", {"quality": "HIGH", "playlist_quality": {"0p1": "LOSSLESS"}})
+
+    with pytest.raises(mdb.click.ClickException, match="playlist_quality.0p1"):
+        mdb.MyMelody.check_qualities()
+
+
+@pytest.mark.parametrize("flock", [True, False])
+def test_track_lock(tmp_path, monkeypatch, flock):
+    if not flock:
+        monkeypatch.setattr(mdb, "fcntl", None)
+    monkeypatch.setattr(mdb.MyMelody, "CONFIG", {"lock_timeout": 60})
+    track_path = str(tmp_path / "track.mp3")
+
+    first, second = mdb.TrackLock(track_path), mdb.TrackLock(track_path)
+    assert first.acquire()
+    assert not second.acquire()
+    first.release()
+    assert second.acquire()
+    # Releasing twice never removes a lock someone else holds
+    first.release()
+    assert os.path.exists(track_path + ".lock")
+    second.release()
+    assert not os.path.exists(track_path + ".lock")
+
+
+@pytest.mark.parametrize("flock", [True, False])
+def test_track_lock_takes_over_stale_locks(tmp_path, monkeypatch, flock):
+    if not flock:
+        monkeypatch.setattr(mdb, "fcntl", None)
+    monkeypatch.setattr(mdb.MyMelody, "CONFIG", {"lock_timeout": 60})
+    track_path = str(tmp_path / "track.mp3")
+    with open(track_path + ".lock", "w") as fh:
+        fh.write('{"token": "crashed"}')
+    os.utime(track_path + ".lock", (0, 0))
+
+    track_lock = mdb.TrackLock(track_path)
+    assert track_lock.acquire()
+    assert track_lock.read_token() == track_lock.token
+    assert os.listdir(tmp_path) == ["track.mp3.lock"]
+    track_lock.release()
+
+
+def test_loudness_is_measured_across_chunks():
+    numpy = pytest.importorskip("numpy")
+    import pydub
+    # A 997 Hz sine at full scale measures -3.01 LUFS, and this one is long
+    # enough to be filtered in a few chunks
+    sample_rate = 44100
+    samples = 0.5 * numpy.sin(2 * numpy.pi * 997 * numpy.arange(25 * sample_rate) / sample_rate)
+    segment = pydub.AudioSegment(data=(samples * 32767).astype("<i2").tobytes(), sample_width=2, frame_rate=sample_rate, channels=1)
+
+    loudness = mdb.analyze_loudness(segment)
+
+    assert loudness["loudness"] == pytest.approx(-3.01 + 20 * numpy.log10(0.5), abs=0.05)
+    assert loudness["peak"] == pytest.approx(0.5, abs=1e-3)
+    assert sum(x[0] for x in loudness["blocks"].values()) == 25 * 10 - 3
+
+
+def test_imported_ids_need_the_whole_album_and_a_followed_artist(tmp_path, monkeypatch):
+    monkeypatch.setattr(mdb.MyMelody, "CONFIG", {"track_path": str(tmp_path / "tracks")})
+    mdb.MusicDatabase.create_db(str(tmp_path / "mdb.db"))
+    track = create_track("0t1", "Song", "album", "2020")
+    track = mdb.dataclasses.replace(track, album=mdb.dataclasses.replace(track.album, total_tracks=2))
+
+    try:
+        mdb.MusicDatabase.add_track(track)
+        # Interrupted after the first of the album's tracks, before the artist
+        # was followed
+        assert mdb.get_imported_ids("albums", ["0l0t1"]) == set()
+        assert mdb.get_imported_ids("artists", ["0r0"]) == set()
+
+        mdb.MusicDatabase.add_track(mdb.dataclasses.replace(track, id="0t2", track_number=2))
+        mdb.MusicDatabase.add_artist(mdb.dataclasses.replace(track.artists[0], follow=True), replace=True)
+        assert mdb.get_imported_ids("albums", ["0l0t1"]) == {"0l0t1"}
+        assert mdb.get_imported_ids("artists", ["0r0"]) == {"0r0"}
+        assert mdb.get_imported_ids("artists", ["0r0"], download=True) == set()
+    finally:
+        mdb.MusicDatabase.close()
+
+
+def test_synthetic_audio_is_titled_with_the_track_id():
+    backend = mdb_backends.SyntheticBackend(None)
+
+    audio = backend.get_audio("0t000000000000000000ab")
+
+    assert b"title=0t000000000000000000ab" in audio and len(audio) == len(backend.audio)
+    # Every page, the retitled one included, still has a valid CRC
+    start = 0
+    while start < len(audio):
+        segments = audio[start + 26]
+        end = start + 27 + segments + sum(audio[start + 27:start + 27 + segments])
+        page = audio[start:end]
+        assert mdb_backends.get_ogg_crc(page[:22] + bytes(4) + page[26:]) == int.from_bytes(page[22:26], "little")
+        start = end
+
+
+def create_mp3(path):
+    # A few silent 128 kbps 44.1 kHz MPEG-1 Layer III frames
+    with open(path, "wb") as fh:
+        fh.write((b"\xff\xfb\x90\x64" + bytes(413)) * 8)
+
+
+def test_tracks_are_tagged_without_artwork_that_fails(tmp_path, monkeypatch):
+    from mutagen.id3 import ID3
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ArtworkHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(mdb.MyMelody, "CONFIG", {"artwork_cache_path": str(tmp_path / "artwork")})
+    monkeypatch.setattr(mdb.ArtworkCache, "ARTWORK", mdb.collections.OrderedDict())
+    track = create_track("0t1", "Song", "album", "2020")
+    track = mdb.dataclasses.replace(track, album=mdb.dataclasses.replace(track.album, artwork_url=f"http://127.0.0.1:{server.server_address[1]}/error"))
+    track_paths = {"0t1": str(tmp_path / "song.mp3"), "0t2": str(tmp_path / "missing.mp3")}
+    create_mp3(track_paths["0t1"])
+    monkeypatch.setattr(mdb.LibraryIndex, "get", classmethod(lambda cls, track_id: track_paths.get(track_id)))
+
+    try:
+        mdb.set_track_tags(track, track_paths["0t1"])
+        assert ID3(track_paths["0t1"]).getall("TIT2")[0].text == ["Song"]
+        assert not ID3(track_paths["0t1"]).getall("APIC")
+
+        # The missing file fails alone
+        retagged = mdb.retag_tracks([track, mdb.dataclasses.replace(track, id="0t2", name="Other")], workers=2)
+        assert retagged == {}
+    finally:
+        server.shutdown()
+
+
+class BrokenSession:
+    def __init__(self):
+        self.closed = 0
+
+    def content_feeder(self):
+        raise ConnectionError("Connection reset")
+
+    def close(self):
+        self.closed += 1
+
+
+def test_failed_sessions_are_closed(monkeypatch):
+    sessions = [mdb.PooledSession("a.json"), mdb.PooledSession("b.json")]
+    broken = [BrokenSession(), BrokenSession()]
+    for pooled, session in zip(sessions, broken):
+        pooled.session = session
+    monkeypatch.setattr(mdb.SessionPool, "SESSIONS", sessions)
+    mdb.RequestScheduler.configure(rate=100)
+
+    with pytest.raises(ConnectionError):
+        mdb.SessionPool.load("0t1", None)
+
+    assert [x.closed for x in broken] == [1, 1]
+    assert [(x.failures, x.session) for x in sessions] == [(1, None), (1, None)]
+    # A late report for a session already replaced leaves the new one alone
+    replacement = sessions[0].session = BrokenSession()
+    mdb.SessionPool.report_failure(sessions[0], ConnectionError("late"), broken[0])
+    assert sessions[0].session is replacement and replacement.closed == 0 and broken[0].closed == 1
+
+
+class FailingInputStream(mdb_backends.FakeInputStream):
+    def read(self, size=-1):
+        raise IndexError("Stream ended")
+
+
+def test_streams_are_closed_however_downloads_end(tmp_path, monkeypatch):
+    monkeypatch.setattr(mdb.MyMelody, "CONFIG", {"track_path": str(tmp_path / "tracks")})
+    mdb.MusicDatabase.create_db(str(tmp_path / "mdb.db"))
+    track = create_track("0t1", "Song", "album", "2020")
+
+    try:
+        hidden = mdb_backends.FakeStream(b"audio")
+        assert mdb.download_track(mdb.dataclasses.replace(track, hidden=True), stream=hidden) is False
+        assert hidden.input_stream.buffer.closed
+
+        failing = mdb_backends.FakeStream(b"audio")
+        failing.input_stream.__class__ = FailingInputStream
+        assert mdb.download_claimed_track(track, str(tmp_path / "song.mp3"), stream=failing) is None
+        assert failing.input_stream.buffer.closed
+    finally:
+        mdb.MusicDatabase.close()
+
+
+class StalledInputStream(mdb_backends.FakeInputStream):
+    def read(self, size=-1):
+        # Half the audio arrives, then nothing more
+        if self.buffer.tell() >= self.size // 2:
+            return b""
+        return self.buffer.read(min(size, self.size // 2 - self.buffer.tell()))
+
+
+def test_truncated_streams_fail_and_stay_queued(tmp_path, monkeypatch):
+    monkeypatch.setattr(mdb.MyMelody, "CONFIG", {"track_path": str(tmp_path / "tracks")})
+    mdb.MusicDatabase.create_db(str(tmp_path / "mdb.db"))
+    track = mdb.MusicDatabase.add_track(create_track("0t1", "Song", "album", "2020"))
+    mdb.DownloadQueue.add([track], "track")
+    stream = mdb_backends.FakeStream(bytes(100000))
+    stream.input_stream.__class__ = StalledInputStream
+    track_path = str(tmp_path / "song.mp3")
+    failures = []
+    monkeypatch.setattr(mdb.Progress, "track_failed", classmethod(lambda cls, track, error: failures.append(error)))
+
+    try:
+        assert mdb.download_claimed_track(track, track_path, stream=stream) is None
+        # Failed before anything was encoded
+        assert failures == ["stream ended after 50000 of 100000 bytes"]
+        assert not os.path.exists(track_path) and not os.path.exists(track_path + ".part")
+        assert [x.id for x in mdb.tracks_to_download()] == ["0t1"]
+    finally:
+        mdb.MusicDatabase.close()
+
+
+def test_track_lock_takeover_race(tmp_path, monkeypatch):
+    monkeypatch.setattr(mdb, "fcntl", None)
+    monkeypatch.setattr(mdb.MyMelody, "CONFIG", {"lock_timeout": 60})
+    track_path = str(tmp_path / "track.mp3")
+    with open(track_path + ".lock", "w") as fh:
+        fh.write('{"token": "crashed"}')
+    os.utime(track_path + ".lock", (0, 0))
+    first, second = mdb.TrackLock(track_path), mdb.TrackLock(track_path)
+
+    # The first worker takes over the stale lock after the second has found
+    # it stale, but before the second moves it aside
+    rename = os.rename
+    def interleaved_rename(source, destination):
+        monkeypatch.setattr(mdb.os, "rename", rename)
+        assert first.acquire()
+        rename(source, destination)
+    monkeypatch.setattr(mdb.os, "rename", interleaved_rename)
+
+    assert not second.acquire()
+    assert first.read_token() == first.token
+    assert os.listdir(tmp_path) == ["track.mp3.lock"]
+    first.release()